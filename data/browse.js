@@ -26,9 +26,54 @@ function log(msg) {
   // console.debug(msg);
 }
 
+// messages to Python, posted in batches (see WebView.on_script_message)
+var message_queue = [];
+var message_timeout;
+var coalesced_messages = 0;
+// actions where a message replaces the one queued right before it, if of the same action
+var COALESCED_ACTIONS = ['ojo-select', 'ojo-priority', 'ojo-priority-folders'];
+
 function python(command) {
-  log('Python command: ' + command);
-  window.alert(new Date().getTime() + '|' + command);
+  var index = command.indexOf(':');
+  send_message(command.substring(0, index), command.substring(index + 1));
+}
+
+function send_message(action, argument) {
+  log('Python message: ' + action);
+  // only the last queued message is replaced, to keep the order relative to other actions
+  var last = _.last(message_queue);
+  if (last && last.action === action && _.contains(COALESCED_ACTIONS, action)) {
+    message_queue.pop();
+    coalesced_messages++;
+  }
+  message_queue.push({
+    action: action,
+    argument: argument,
+    time: new Date().getTime(),
+  });
+  if (!message_timeout) {
+    // whatever else the current event sends goes in the same batch
+    message_timeout = setTimeout(flush_messages, 0);
+  }
+}
+
+function flush_messages() {
+  message_timeout = undefined;
+  var batch = { messages: message_queue, coalesced: coalesced_messages };
+  message_queue = [];
+  coalesced_messages = 0;
+  window.webkit.messageHandlers.ojo.postMessage(JSON.stringify(batch));
+}
+
+function apply_batch(calls) {
+  // calls queued by WebView.call() on the Python side, [[function name, args], ...]
+  for (var i = 0; i < calls.length; i++) {
+    try {
+      window[calls[i][0]].apply(null, calls[i][1]);
+    } catch (e) {
+      console.error(e);
+    }
+  }
 }
 
 function set_mode(new_mode) {
@@ -40,11 +85,13 @@ function set_mode(new_mode) {
 
 function set_font_size(root_font_size) {
   $('html').css('font-size', root_font_size);
+  grid_invalidate_all();
 }
 
 function set_thumb_height(new_thumb_height) {
   log('Setting thumb height: ' + new_thumb_height);
   thumb_height = new_thumb_height;
+  grid_invalidate_all();
 }
 
 function toggle_fullscreen(fullscreen) {
@@ -213,15 +260,8 @@ function add_folderthumb(path, thumb_path) {
 }
 
 function add_group(label, is_first) {
-  $(
-    '<h2 class="group ' +
-      (is_first ? 'first' : 'non-first') +
-      '" label="' +
-      esc(label) +
-      '">' +
-      esc(label) +
-      '</h2>'
-  ).appendTo($('#images'));
+  // which group comes first is up to the grid layout, as searching hides groups
+  grid_add({ type: 'group', label: label, match: true });
 }
 
 function add_image_div(
@@ -232,48 +272,31 @@ function add_image_div(
   show_caption,
   group,
   thumb,
-  thumb_width
+  thumb_width,
+  position
 ) {
   if (intended_folder != folder || file.indexOf(folder) !== 0) {
     return;
   }
 
-  var html = _.template(
-    '<div ' +
-      "   class='item selectable match' " +
-      "   file='<%= file %>' " +
-      "   filename='<%= name %>' " +
-      "   group='<%= group %>' " +
-      (thumb ? 'with_thumb=true ' : '') +
-      "   style='width: <%= thumb_width %>; height: <%= thumb_height %>px'>" +
-      "   <div class='holder' style='height: <%= thumb_height %>px'>" +
-      (thumb
-        ? "<img src='<%= thumb %>' style='max-height: <%= thumb_height %>px'/>"
-        : '') +
-      '   </div>' +
-      "<div class='caption <%= caption_z %>'><%= name %></div>" +
-      '</div>'
-  )({
-    file: encode_path(file),
-    name: esc(name),
-    group: esc(group || ''),
-    thumb: thumb ? encode_path(thumb) : '',
-    thumb_width: thumb
-      ? 'initial'
-      : thumb_width
-      ? thumb_width + 'px'
-      : (thumb_height * 3) / 2 + 'px',
-    thumb_height: thumb_height,
-    caption_z: show_caption ? 'caption_above' : '',
-  });
-
-  var elem = $(html).toggleClass('selected', selected);
-  if (search && !matches_search(elem)) {
-    elem.addClass('nonmatch');
-    elem.removeClass('match');
+  var entry = {
+    type: 'item',
+    file: file,
+    name: name,
+    filename: name,
+    group: group || '',
+    thumb: thumb || '',
+    width: thumb_width || (thumb_height * 3) / 2,
+  };
+  entry.match =
+    !search || matches_search_fields(entry.filename, entry.file, entry.group);
+  grid.show_captions = show_caption;
+  if (thumb) {
+    grid.thumbs++;
   }
-
-  $('#images').append(elem);
+  // position: {before: file} or {after: file} to insert next to an existing item,
+  // as when a file appears in the folder, appended at the end by default
+  grid_add(entry, position);
 
   if (thumb) {
     update_progress();
@@ -281,8 +304,14 @@ function add_image_div(
 
   if (selected) {
     current = encode_path(file);
-    current_elem = elem[0];
-    setTimeout(_.bind(scroll_to_selected, undefined, elem), 200);
+    grid.selected = file;
+    var elem = grid_element(file);
+    current_elem = elem ? elem[0] : undefined;
+    setTimeout(function() {
+      if (current === file) {
+        scroll_to_selected(grid_element(file));
+      }
+    }, 200);
   }
 }
 
@@ -299,7 +328,7 @@ function set_image_count(count, folder_size, latest_date) {
 }
 
 function update_progress() {
-  var done = $('.item[with_thumb=true]').length;
+  var done = grid.thumbs;
   var progress =
     done >= image_count ? 0 : Math.min(100, (100 * done) / (image_count || 1));
   // (hide when done)
@@ -312,18 +341,7 @@ function add_image(file, thumb) {
   }
 
   clearTimeout(pending_add_timeouts[file]);
-  var item = $(".item[file='" + encode_path(file) + "']");
-  if (item.length) {
-    item.attr('with_thumb', true).css('width', 'initial');
-    item
-      .find('.holder')
-      .html(
-        "<img src='" +
-          encode_path(thumb) +
-          "' style='max-height: " +
-          thumb_height +
-          "px' />"
-      );
+  if (grid_set_thumb(file, thumb)) {
     update_progress();
   } else {
     pending_add_timeouts[file] = setTimeout(function() {
@@ -333,15 +351,15 @@ function add_image(file, thumb) {
 }
 
 function remove_image_div(file) {
-  var to_remove = $(".item[file='" + encode_path(file) + "']");
-  if (to_remove.hasClass('selected')) {
-    var next = $(to_remove).next('.selectable');
-    if (next.length === 0) {
-      next = $('.selectable');
+  if (grid.selected === file) {
+    var next = grid_next_item(file, 1) || grid_first_item();
+    if (next && next !== file) {
+      select(next);
+    } else {
+      select(decode_path($('.selectable.folder').attr('file')));
     }
-    select(decode_path(next.attr('file')));
   }
-  to_remove.remove();
+  grid_remove(file);
 
   image_count = Math.max(0, image_count - 1);
   update_progress();
@@ -364,20 +382,24 @@ function change_folder(new_folder) {
 
   $('#title').html('');
   $('#folders').html('');
-  $('#images').html('');
+  $('#images').html('<div id="grid"></div>');
+  if (grid.frame) {
+    cancelAnimationFrame(grid.frame);
+  }
+  grid_reset();
 
   toggle_exif(false);
 }
 
 function set_file_info(file, info, thumb_width) {
-  $(".item[file='" + encode_path(file) + "']")
-    .attr('dimensions', esc(info.dimensions))
-    .attr('filename', esc(info.filename))
-    .attr('data-file-date', esc(info.file_date))
-    .attr('data-file-size', esc(info.file_size))
-    .attr('data-exif-info', esc(info.exif_info));
-  if (thumb_width) {
-    $(".item[file='" + encode_path(file) + "']").css('width', thumb_width);
+  var entry = grid.index[file];
+  if (entry) {
+    entry.info = info;
+    entry.filename = info.filename;
+    if (thumb_width && thumb_width !== entry.width && !entry.thumb) {
+      grid_resize(entry, thumb_width);
+    }
+    grid_refresh(entry);
   }
   if (file === current) {
     $('#filename').html(esc(info.filename));
@@ -469,9 +491,20 @@ function show_spinner(msg) {
   $('#filename').html('<img src="images/spinner.svg" class="spinner"/>' + msg);
 }
 
+function find_selectable(file) {
+  return (
+    grid_element(file) ||
+    $(".match.selectable[file='" + encode_path(file) + "']").first()
+  );
+}
+
+function selected_elem() {
+  // the selected item may be scrolled out of the materialized rows
+  return (grid.selected && grid_element(grid.selected)) || $('.selected');
+}
+
 function select(file, dontScrollTo, elem) {
-  var el =
-    elem || $(".match.selectable[file='" + encode_path(file) + "']").first();
+  var el = elem || find_selectable(file);
 
   if (current === file && current_elem === el[0]) {
     return;
@@ -491,12 +524,14 @@ function select(file, dontScrollTo, elem) {
 
 function scroll_to_selected(el) {
   log('Scroll to selected');
-  el = el || $('.selected');
+  el = el || selected_elem();
   if (el.length) {
     var baseDelta = el.hasClass('item') ? thumb_height : 80;
     var container = el.closest('.scroll-container');
     var scrollTop = container.scrollTop();
-    var top = scrollTop + el.position().top;
+    var top = el.hasClass('item')
+      ? grid_item_top(decode_path(el.attr('file')))
+      : scrollTop + el.position().top;
     var containerHeight = container.height();
 
     var scrollTo;
@@ -528,6 +563,10 @@ function set_current_elem(new_current_elem) {
     hide_exif_info();
   }
   current_elem = new_current_elem;
+  grid.selected =
+    new_current_elem && $(new_current_elem).hasClass('item')
+      ? decode_path($(new_current_elem).attr('file'))
+      : null;
 
   $('.selectable').removeClass('selected');
   if (new_current_elem) {
@@ -551,6 +590,9 @@ function get_next_in_direction(elem, direction) {
   if (elem.length === 0) {
     return;
   }
+  if (elem.hasClass('item')) {
+    return grid_item_in_direction(decode_path(elem.attr('file')), direction);
+  }
   var current = elem.offset().top + (direction < 0 ? -10 : elem.height());
   var applicable = $('.selectable.match' + selection_class).filter(function() {
     var candidate = $(this).offset().top;
@@ -574,19 +616,20 @@ function goto_visible(first_or_last, onlyClass, immediate) {
 
   function _go() {
     for (var attempt = 0; attempt <= 1; attempt++) {
-      var visible = _.filter(
-        $(
-          '.selectable.match' +
-            (onlyClass ? onlyClass : attempt === 0 ? selection_class : '')
-        ),
-        function(x) {
-          var container = $(x).closest('.scroll-container');
-          return (
-            $(x).position().top >= -5 &&
-            $(x).position().top + $(x).height() < container.height() + 5
-          );
-        }
-      );
+      var cls = onlyClass ? onlyClass : attempt === 0 ? selection_class : '';
+      var visible =
+        cls === '.item'
+          ? []
+          : _.filter($('.selectable.match' + cls).not('.item'), function(x) {
+              var container = $(x).closest('.scroll-container');
+              return (
+                $(x).position().top >= -5 &&
+                $(x).position().top + $(x).height() < container.height() + 5
+              );
+            });
+      if (cls !== '.folder') {
+        visible = visible.concat(grid_visible_elements());
+      }
       if (visible.length) {
         break;
       }
@@ -603,13 +646,13 @@ function goto_visible(first_or_last, onlyClass, immediate) {
 
 function switch_pane(new_selection_class) {
   var new_file = selected_file_per_class[new_selection_class];
-  if (
-    new_file &&
-    $(".match.selectable[file='" + encode_path(new_file) + "']").length > 0
-  ) {
+  if (new_file && find_selectable(new_file).length > 0) {
     select(new_file);
   } else {
-    var elem = $('.selectable.match' + new_selection_class);
+    var elem =
+      new_selection_class === '.item'
+        ? grid_element(grid_first_item()) || $()
+        : $('.selectable.match' + new_selection_class);
     if (elem.length) {
       goto($(elem[0]));
       selection_class = new_selection_class;
@@ -629,7 +672,7 @@ function hide_exif_info() {
 }
 
 function on_key(key) {
-  var sel = $('.selected');
+  var sel = selected_elem();
   if (key === 'slash') {
     if (search && search !== '/' && sel.hasClass('folder')) {
       var new_search = sel.attr('file');
@@ -645,13 +688,11 @@ function on_key(key) {
     goto(get_next_in_direction(sel, key === 'Up' ? -1 : 1), false);
   } else if (key === 'Right') {
     if (selection_class === '.item') {
-      var next = sel.nextAll('.selectable.match' + selection_class);
-      goto(next.length ? $(next[0]) : null);
+      goto(grid_element(grid_next_item(current, 1)));
     }
   } else if (key === 'Left') {
     if (selection_class === '.item') {
-      var prev = sel.prevAll('.selectable.match' + selection_class);
-      goto(prev.length ? $(prev[0]) : null);
+      goto(grid_element(grid_next_item(current, -1)));
     }
   } else if (key === 'Page_Up' || key === 'Page_Down') {
     var direction = key === 'Page_Up' ? -1 : 1;
@@ -678,10 +719,12 @@ function on_key(key) {
         goto_visible(true, sel.hasClass('item') ? '.item' : '.folder', false);
       }
     }, 0);
-  } else if (key === 'Home') {
-    goto($(selection_class + '.selectable.match:first'));
-  } else if (key === 'End') {
-    goto($(selection_class + '.selectable.match:last'));
+  } else if (key === 'Home' || key === 'End') {
+    goto(
+      selection_class === '.item'
+        ? grid_element(grid_first_item(key === 'End'))
+        : $(selection_class + '.selectable.match:' + (key === 'End' ? 'last' : 'first'))
+    );
   } else if (key === 'BackSpace') {
     python('ojo-handle-key:' + key);
   } else if (key === 'Escape') {
@@ -694,10 +737,18 @@ function on_key(key) {
 }
 
 function matches_search(elem) {
+  return matches_search_fields(
+    elem.attr('filename'),
+    elem.attr('file'),
+    elem.attr('group')
+  );
+}
+
+function matches_search_fields(filename, file, group) {
   var nbsp = new RegExp(String.fromCharCode(160), 'g');
-  var filename = (elem.attr('filename') || '').replace(nbsp, ' ');
-  var file = (elem.attr('file') || '').replace(nbsp, ' ');
-  var group = (elem.attr('group') || '').replace(nbsp, ' ');
+  filename = (filename || '').replace(nbsp, ' ');
+  file = (file || '').replace(nbsp, ' ');
+  group = (group || '').replace(nbsp, ' ');
 
   var strippedFolders =
     search.charAt(0) === '/'
@@ -729,20 +780,24 @@ function on_search(bypass_python) {
 
   toggle_exif(false);
 
+  // the images are matched by the grid, the folders here
+  grid_search();
   $('.selectable')
+    .not('.item')
     .filter(function() {
       return !matches_search($(this));
     })
     .removeClass('match')
     .addClass('nonmatch');
-  var matches = $('.selectable').filter(function() {
-    return matches_search($(this));
-  });
+  var matches = $('.selectable')
+    .not('.item')
+    .filter(function() {
+      return matches_search($(this));
+    });
   matches.removeClass('nonmatch').addClass('match');
 
-  // hide/show groups
-  var firstGroup = true;
-  $('.group, .folder-category').map(function() {
+  // hide/show folder categories
+  $('.folder-category').map(function() {
     var g = $(this);
     var keep =
       search.trim() === '' ||
@@ -751,29 +806,21 @@ function on_search(bypass_python) {
         return m.attr('group') === g.attr('label');
       }).length > 0;
     g.toggleClass('match', keep).toggleClass('nonmatch', !keep);
-
-    if ($(this).hasClass('group')) {
-      if (keep) {
-        g.toggleClass('first', firstGroup);
-        firstGroup = false;
-      } else {
-        g.removeClass('first');
-      }
-    }
   });
 
-  var sel = $('.selected');
-  if (matches.length && (sel.length === 0 || !_.contains(matches, sel[0]))) {
-    var newSel = [];
-    if (selection_class) {
-      newSel = matches.filter(function() {
-        return $(this).hasClass(selection_class.substr(1));
-      });
-    }
-    if (newSel.length === 0) {
-      newSel = matches;
-    }
-    select(decode_path(newSel.attr('file')));
+  var first_item = grid_first_item();
+  var sel = selected_elem();
+  var sel_matches = grid.selected
+    ? grid.index[grid.selected].match
+    : sel.length > 0 && _.contains(matches, sel[0]);
+  if ((matches.length || first_item) && !sel_matches) {
+    // prefer the pane of the current selection
+    var first_folder = matches.length ? decode_path(matches.attr('file')) : null;
+    select(
+      selection_class === '.item'
+        ? first_item || first_folder
+        : first_folder || first_item
+    );
   } else {
     scroll_to_selected();
   }
@@ -811,11 +858,9 @@ function files_needing_thumb_in_view(applicable, container) {
 }
 
 function on_images_scroll() {
-  var container = $('#images');
-  var applicable = $('.item.match');
-  var files = files_needing_thumb_in_view(applicable, container);
+  var files = grid_files_needing_thumb_in_view();
   if (files.length > 0) {
-    python('ojo-priority:' + JSON.stringify(files));
+    send_message('ojo-priority', files);
   }
 }
 
@@ -824,7 +869,7 @@ function on_folders_scroll() {
   var applicable = $('.folder.match[group=Subfolders]');
   var folders = files_needing_thumb_in_view(applicable, container);
   if (folders.length > 0) {
-    python('ojo-priority-folders:' + JSON.stringify(folders));
+    send_message('ojo-priority-folders', folders);
   }
 }
 
@@ -863,6 +908,7 @@ function on_clickable(event) {
 }
 
 function toggle_captions(visible) {
+  grid.show_captions = visible;
   $('.caption').toggleClass('caption_above', visible);
   select('command:captions:' + (visible ? 'false' : 'true'));
 }
@@ -933,6 +979,7 @@ $(function() {
   });
 
   $('#images').scroll(function() {
+    grid_schedule();
     clearTimeout(scroll_timeout);
     scroll_timeout = setTimeout(on_images_scroll, 200);
   });
@@ -943,6 +990,8 @@ $(function() {
   });
 
   $(window).resize(function() {
+    // the grid lays out its rows anew when its width changes
+    grid_schedule();
     if (current) {
       select(current);
     }
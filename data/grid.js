@@ -0,0 +1,571 @@
+// Virtualized image grid.
+//
+// A folder can have tens of thousands of images, and a DOM node per image makes the web
+// process heavy and every relayout slow. Instead the grid keeps one entry per image and per
+// group header, lays out the rows itself from the known thumbnail widths, and materializes
+// only the rows in and near the viewport. Item nodes of the rows scrolled away are reused.
+//
+// Rendered items keep the markup, classes and attributes of the non-virtualized grid, so the
+// CSS and the selection code in browse.js work on them as before.
+
+var GRID_MARGIN = 8; // .item margin (the border of .item.selected)
+var GRID_POOL_SIZE = 500; // item nodes kept for reuse
+
+var grid;
+
+function grid_reset() {
+  grid = {
+    entries: [], // {type: 'item' | 'group', ...}, in display order
+    index: {}, // file -> item entry
+    rows: [], // {top, height, first (entry index), entries, group}
+    height: 0,
+    width: 0,
+    dirty_from: 0, // index of the first entry whose layout is stale, -1 if none
+    rendered: {}, // row index -> row element
+    pool: [],
+    group_heights: {},
+    selected: null, // file of the selected item
+    show_captions: false,
+    thumbs: 0, // items with a thumbnail
+    frame: null,
+  };
+}
+
+grid_reset();
+
+function grid_invalidate_from(index) {
+  grid.dirty_from =
+    grid.dirty_from < 0 ? index : Math.min(grid.dirty_from, index);
+  grid_schedule();
+}
+
+function grid_invalidate(entry) {
+  if (entry.row >= 0 && entry.row < grid.rows.length) {
+    grid_invalidate_from(grid.rows[entry.row].first);
+  } else {
+    grid_invalidate_from(Math.max(0, grid.entries.indexOf(entry)));
+  }
+}
+
+function grid_resize(entry, width) {
+  // a new width that still fits the row of the entry is patched in place, otherwise the rows
+  // from the entry's on are laid out again in the next frame
+  var row = entry.row >= 0 ? grid.rows[entry.row] : null;
+  var old_width = entry.width;
+  entry.width = width;
+  if (!row || row.group || row.entries.indexOf(entry) < 0) {
+    grid_invalidate(entry);
+    return;
+  }
+  var row_width = row.width + width - old_width;
+  if (row_width > grid.width && row.entries.length > 1) {
+    grid_invalidate(entry);
+    return;
+  }
+  // when it shrinks, the rows after keep their items until the next relayout
+  row.width = row_width;
+  var el = grid_item_element(entry);
+  if (el) {
+    el.style.width = width + 'px';
+  }
+}
+
+function grid_invalidate_all() {
+  grid.group_heights = {};
+  grid_invalidate_from(0);
+}
+
+function grid_schedule() {
+  if (!grid.frame) {
+    grid.frame = requestAnimationFrame(function() {
+      grid.frame = null;
+      grid_render();
+    });
+  }
+}
+
+function grid_add(entry, position) {
+  entry.row = -1;
+  if (entry.type === 'item') {
+    grid.index[entry.file] = entry;
+  }
+  var at = grid.entries.length;
+  var neighbor = position && grid.index[position.before || position.after];
+  if (neighbor) {
+    at = grid.entries.indexOf(neighbor) + (position.before ? 0 : 1);
+  }
+  grid.entries.splice(at, 0, entry);
+  grid_invalidate_from(at);
+}
+
+function grid_remove(file) {
+  var entry = grid.index[file];
+  if (!entry) {
+    return;
+  }
+  var at = grid.entries.indexOf(entry);
+  grid.entries.splice(at, 1);
+  delete grid.index[file];
+  if (entry.thumb) {
+    grid.thumbs--;
+  }
+  if (grid.selected === file) {
+    grid.selected = null;
+  }
+  grid_invalidate_from(at);
+}
+
+function grid_set_thumb(file, thumb) {
+  var entry = grid.index[file];
+  if (!entry) {
+    return false;
+  }
+  if (!entry.thumb) {
+    grid.thumbs++;
+  }
+  entry.thumb = thumb;
+  grid_refresh(entry);
+  return true;
+}
+
+function grid_search() {
+  var groups = {};
+  _.each(grid.entries, function(entry) {
+    if (entry.type === 'item') {
+      entry.match =
+        !search || matches_search_fields(entry.filename, entry.file, entry.group);
+      if (entry.match) {
+        groups[entry.group] = true;
+      }
+    }
+  });
+  _.each(grid.entries, function(entry) {
+    if (entry.type === 'group') {
+      entry.match = search.trim() === '' || !!groups[entry.label];
+    }
+  });
+  grid_invalidate_from(0);
+}
+
+// Layout
+
+function grid_row_index(key, value) {
+  // index of the last row whose key is <= value, 0 if none
+  var lo = 0;
+  var hi = grid.rows.length - 1;
+  var found = 0;
+  while (lo <= hi) {
+    var mid = (lo + hi) >> 1;
+    if (grid.rows[mid][key] <= value) {
+      found = mid;
+      lo = mid + 1;
+    } else {
+      hi = mid - 1;
+    }
+  }
+  return found;
+}
+
+function grid_layout() {
+  var canvas = document.getElementById('grid');
+  if (!canvas) {
+    return;
+  }
+  if (canvas.clientWidth !== grid.width) {
+    grid.width = canvas.clientWidth;
+    grid.dirty_from = 0;
+  }
+  if (grid.dirty_from < 0) {
+    return;
+  }
+
+  // rows before the one with the first stale entry stay, start one row earlier in case
+  // the stale entries now fit at its end
+  var r = Math.max(0, grid_row_index('first', grid.dirty_from) - 1);
+  var start = r < grid.rows.length ? grid.rows[r].first : 0;
+  if (r >= grid.rows.length) {
+    r = 0;
+  }
+  var old_rows = grid.rows.splice(r, grid.rows.length - r);
+
+  var prev = grid.rows[r - 1];
+  var top = prev ? prev.top + prev.height : 0;
+  var seen_group = prev ? prev.seen_group : false;
+  var item_height = thumb_height + 2 * GRID_MARGIN;
+  var row = null;
+  for (var i = start; i < grid.entries.length; i++) {
+    var entry = grid.entries[i];
+    if (!entry.match) {
+      entry.row = -1;
+      continue;
+    }
+    if (entry.type === 'group') {
+      entry.first = !seen_group;
+      seen_group = true;
+      row = {
+        top: top,
+        height: grid_group_height(entry.first),
+        first: i,
+        entries: [entry],
+        group: true,
+        seen_group: true,
+      };
+      grid.rows.push(row);
+      entry.row = grid.rows.length - 1;
+      top += row.height;
+      row = null;
+      continue;
+    }
+    var width = entry.width + 2 * GRID_MARGIN;
+    if (!row || row.width + width > grid.width) {
+      row = {
+        top: top,
+        height: item_height,
+        first: i,
+        entries: [],
+        width: 0,
+        seen_group: seen_group,
+      };
+      grid.rows.push(row);
+      top += item_height;
+    }
+    row.entries.push(entry);
+    row.width += width;
+    entry.row = grid.rows.length - 1;
+  }
+
+  // rendered rows that came out the same stay, the others are built again by grid_render
+  for (var rendered in grid.rendered) {
+    if (rendered < r) {
+      continue;
+    }
+    if (grid_same_row(old_rows[rendered - r], grid.rows[rendered])) {
+      grid_patch_widths(rendered);
+    } else {
+      grid_drop_row(rendered);
+    }
+  }
+
+  grid.height = top;
+  grid.dirty_from = -1;
+  canvas.style.height = top + 'px';
+}
+
+function grid_patch_widths(r) {
+  // a kept row has the same items, though their widths may have changed within it
+  var row = grid.rows[r];
+  if (row.group) {
+    return;
+  }
+  var items = grid.rendered[r].childNodes;
+  _.each(row.entries, function(entry, i) {
+    items[i].style.width = entry.width + 'px';
+  });
+}
+
+function grid_same_row(a, b) {
+  if (!a || !b || a.top !== b.top || a.height !== b.height) {
+    return false;
+  }
+  if (a.group) {
+    return b.group && a.entries[0] === b.entries[0] && a.entries[0].first === b.entries[0].first;
+  }
+  if (b.group || a.entries.length !== b.entries.length) {
+    return false;
+  }
+  for (var i = 0; i < a.entries.length; i++) {
+    if (a.entries[i] !== b.entries[i]) {
+      return false;
+    }
+  }
+  return true;
+}
+
+function grid_group_height(first) {
+  var key = first ? 'first' : 'other';
+  if (!grid.group_heights[key]) {
+    var probe = grid_group_row({ label: 'Group' }, first);
+    probe.style.visibility = 'hidden';
+    document.getElementById('grid').appendChild(probe);
+    grid.group_heights[key] = probe.offsetHeight;
+    $(probe).remove();
+  }
+  // before the page is displayed nothing has a height, render with a guess then
+  return grid.group_heights[key] || 80;
+}
+
+// Rendering
+
+function grid_render() {
+  grid_layout();
+  var container = document.getElementById('images');
+  var canvas = document.getElementById('grid');
+  if (!canvas || !grid.rows.length) {
+    return;
+  }
+  // one screen above and below the viewport
+  var view_top = container.scrollTop - canvas.offsetTop;
+  var view_height = container.clientHeight;
+  var first = grid_row_index('top', view_top - view_height);
+  var last = grid_row_index('top', view_top + 2 * view_height);
+
+  for (var r in grid.rendered) {
+    if (r < first || r > last) {
+      grid_drop_row(r);
+    }
+  }
+  // new rows go into the page at once
+  var fragment = document.createDocumentFragment();
+  for (r = first; r <= last; r++) {
+    if (!grid.rendered[r]) {
+      grid_build_row(r, fragment);
+    }
+  }
+  canvas.appendChild(fragment);
+}
+
+function grid_build_row(r, parent) {
+  var row = grid.rows[r];
+  var el;
+  if (row.group) {
+    el = grid_group_row(row.entries[0], row.entries[0].first);
+  } else {
+    el = document.createElement('div');
+    el.className = 'grid-row';
+    _.each(row.entries, function(entry) {
+      var item = grid.pool.pop() || grid_new_item();
+      grid_fill_item(item, entry);
+      el.appendChild(item);
+    });
+  }
+  el.style.top = row.top + 'px';
+  el.style.height = row.height + 'px';
+  (parent || document.getElementById('grid')).appendChild(el);
+  grid.rendered[r] = el;
+  return el;
+}
+
+function grid_drop_row(r) {
+  var el = grid.rendered[r];
+  delete grid.rendered[r];
+  $(el)
+    .children('.item')
+    .each(function() {
+      if (grid.pool.length < GRID_POOL_SIZE) {
+        grid.pool.push(this);
+      }
+    });
+  el.parentNode && el.parentNode.removeChild(el);
+}
+
+function grid_group_row(entry, first) {
+  var el = document.createElement('div');
+  el.className = 'grid-row';
+  $('<h2/>')
+    .addClass('group match ' + (first ? 'first' : 'non-first'))
+    .attr('label', entry.label)
+    .text(entry.label)
+    .appendTo(el);
+  return el;
+}
+
+var grid_item_template = $(
+  "<div class='item selectable match'>" +
+    "<div class='holder'></div>" +
+    "<div class='caption'></div>" +
+    '</div>'
+)[0];
+
+function grid_new_item() {
+  return grid_item_template.cloneNode(true);
+}
+
+function grid_fill_item(el, entry) {
+  el.className =
+    'item selectable match' + (entry.file === grid.selected ? ' selected' : '');
+  var $el = $(el).attr({
+    file: encode_path(entry.file),
+    filename: entry.filename,
+    group: entry.group,
+  });
+  if (entry.thumb) {
+    $el.attr('with_thumb', true);
+  } else {
+    $el.removeAttr('with_thumb');
+  }
+  if (entry.info) {
+    $el.attr({
+      dimensions: esc(entry.info.dimensions),
+      'data-file-date': esc(entry.info.file_date),
+      'data-file-size': esc(entry.info.file_size),
+      'data-exif-info': esc(entry.info.exif_info),
+    });
+  } else {
+    $el.removeAttr('dimensions data-file-date data-file-size data-exif-info');
+  }
+  el.style.width = entry.width + 'px';
+  el.style.height = thumb_height + 'px';
+
+  var holder = el.firstChild;
+  holder.style.height = thumb_height + 'px';
+  var img = holder.firstChild;
+  if (!entry.thumb) {
+    $(holder).empty();
+  } else if (!img || img.getAttribute('src') !== encode_path(entry.thumb)) {
+    $(holder)
+      .empty()
+      .append(
+        $('<img/>')
+          .on('load', grid_on_thumb_load)
+          .css('max-height', thumb_height + 'px')
+          .attr('src', encode_path(entry.thumb))
+      );
+  }
+  $(el.lastChild)
+    .text(entry.name)
+    .toggleClass('caption_above', grid.show_captions);
+}
+
+function grid_on_thumb_load() {
+  // the width of the item was a guess from the metadata, the thumbnail knows better
+  var item = $(this).closest('.item');
+  var entry = grid.index[decode_path(item.attr('file'))];
+  if (!entry || !this.naturalHeight) {
+    return;
+  }
+  var width =
+    (this.naturalWidth * Math.min(this.naturalHeight, thumb_height)) /
+    this.naturalHeight;
+  if (Math.abs(width - entry.width) > 1) {
+    grid_resize(entry, width);
+  }
+}
+
+function grid_refresh(entry) {
+  // patches the rendered element, a pending relayout is left to the next frame
+  var el = grid_item_element(entry);
+  if (el) {
+    grid_fill_item(el, entry);
+  }
+}
+
+function grid_item_element(entry) {
+  var row = grid.rendered[entry.row];
+  return row ? row.childNodes[grid.rows[entry.row].entries.indexOf(entry)] : null;
+}
+
+// Queries for selection and navigation
+
+function grid_element(file) {
+  // the element of a matching item, its row is materialized if it is out of view
+  var entry = grid.index[file];
+  if (!entry || !entry.match) {
+    return null;
+  }
+  grid_layout();
+  if (!grid.rendered[entry.row]) {
+    grid_build_row(entry.row);
+  }
+  return $(grid_item_element(entry));
+}
+
+function grid_item_top(file) {
+  // top of the item, in the scroll coordinates of #images
+  grid_layout();
+  var entry = grid.index[file];
+  return document.getElementById('grid').offsetTop + grid.rows[entry.row].top;
+}
+
+function grid_item_center(entry) {
+  var x = 0;
+  var row = grid.rows[entry.row];
+  for (var i = 0; row.entries[i] !== entry; i++) {
+    x += row.entries[i].width + 2 * GRID_MARGIN;
+  }
+  return x + entry.width / 2;
+}
+
+function grid_first_item(last) {
+  var entries = grid.entries;
+  for (var i = 0; i < entries.length; i++) {
+    var entry = entries[last ? entries.length - 1 - i : i];
+    if (entry.type === 'item' && entry.match) {
+      return entry.file;
+    }
+  }
+  return null;
+}
+
+function grid_next_item(file, direction) {
+  var entries = grid.entries;
+  var i = entries.indexOf(grid.index[file]);
+  if (i < 0) {
+    return null;
+  }
+  for (i += direction; i >= 0 && i < entries.length; i += direction) {
+    if (entries[i].type === 'item' && entries[i].match) {
+      return entries[i].file;
+    }
+  }
+  return null;
+}
+
+function grid_item_in_direction(file, direction) {
+  // the item in the next row up or down closest to the column of the given one
+  grid_layout();
+  var entry = grid.index[file];
+  if (!entry || entry.row < 0) {
+    return null;
+  }
+  var x = grid_item_center(entry);
+  for (var r = entry.row + direction; r >= 0 && r < grid.rows.length; r += direction) {
+    if (!grid.rows[r].group) {
+      var closest = _.min(grid.rows[r].entries, function(candidate) {
+        return Math.abs(grid_item_center(candidate) - x);
+      });
+      return grid_element(closest.file);
+    }
+  }
+  return null;
+}
+
+function grid_items_in_view(margin, partial) {
+  // the item entries of the rows within the viewport extended by margin px,
+  // or of the rows at least partially within it
+  grid_render();
+  var container = document.getElementById('images');
+  var canvas = document.getElementById('grid');
+  if (!canvas || !grid.rows.length) {
+    return [];
+  }
+  var view_top = container.scrollTop - canvas.offsetTop - margin;
+  var view_bottom = view_top + container.clientHeight + 2 * margin;
+  var entries = [];
+  for (
+    var r = grid_row_index('top', view_top);
+    r < grid.rows.length && grid.rows[r].top < view_bottom;
+    r++
+  ) {
+    var row = grid.rows[r];
+    var inside = partial
+      ? row.top + row.height >= view_top
+      : row.top >= view_top && row.top + row.height <= view_bottom;
+    if (!row.group && inside) {
+      entries.push.apply(entries, row.entries);
+    }
+  }
+  return entries;
+}
+
+function grid_visible_elements() {
+  return _.map(grid_items_in_view(5, false), grid_item_element);
+}
+
+function grid_files_needing_thumb_in_view() {
+  return _.pluck(
+    _.filter(grid_items_in_view(200, true), function(entry) {
+      return !entry.thumb;
+    }),
+    'file'
+  );
+}
@@ -0,0 +1,212 @@
+"""
+Asyncio client for a stay_open exiftool process.
+
+AsyncExifTool speaks the same numbered -executeNUM protocol as exiftool.ExifTool, but all of
+its requests are coroutines, so any number of them can be outstanding without tying up threads.
+Cancelling a request (e.g. because the user moved on to another image) just drops its response
+when it arrives.
+
+GTK code runs in the GLib main loop, not in an asyncio one. AsyncLoop runs an asyncio loop in a
+background thread, and call_in_glib() runs a coroutine there and hands its result back to the
+GLib main loop, so the UI can request metadata without blocking redraws:
+
+    call_in_glib(exiftool.get_metadata(filename), on_metadata)
+"""
+
+import asyncio
+import json
+import logging
+import threading
+
+from ojo.exiftool import ExifToolError, ExifToolTimeout, ResponseBuffer, block_size, fsencode, sentinel
+
+# embedded previews, as in imaging.EMBEDDED_IMAGE_TAGS
+PREVIEW_TAGS = ("ThumbnailImage", "PreviewImage", "JpgFromRaw", "OtherImage")
+
+
+class AsyncExifTool:
+    def __init__(self, executable=None, timeout=None):
+        self.executable = executable or "exiftool"
+        self.timeout = timeout
+        self.running = False
+        self.process = None
+        self.pending = {}  # number -> Future, in the order sent
+        self.number = 0
+        self.reader = None
+
+    async def start(self):
+        if self.running:
+            logging.warning("AsyncExifTool already running, starting again is a noop.")
+            return self
+        self.process = await asyncio.create_subprocess_exec(
+            self.executable,
+            "-stay_open",
+            "True",
+            "-@",
+            "-",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        self.running = True
+        self.pending = {}
+        self.reader = asyncio.ensure_future(self._read_responses(self.process, self.pending))
+        return self
+
+    async def terminate(self):
+        """Completes outstanding requests, then stops the process"""
+        process = self.process
+        if process is None:
+            return
+        if self.running:
+            self.running = False
+            if self.pending:
+                await asyncio.wait(list(self.pending.values()))
+            try:
+                process.stdin.write(b"-stay_open\nFalse\n")
+                await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        self.process = None
+        await process.wait()
+        await self.reader
+
+    def _kill(self):
+        if not self.running:
+            return
+        self.running = False
+        self.process.kill()
+
+    async def _read_responses(self, process, pending):
+        buf = ResponseBuffer()
+        while True:
+            chunk = await process.stdout.read(block_size)
+            if not chunk:
+                break
+            buf.feed(chunk)
+            while pending:
+                number, future = next(iter(pending.items()))
+                result = buf.pop(sentinel % number)
+                if result is None:
+                    break
+                del pending[number]
+                if not future.done():  # not cancelled
+                    future.set_result(result)
+
+        self.running = False
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ExifToolError("exiftool exited unexpectedly"))
+        pending.clear()
+
+    async def execute_raw(self, *params):
+        """Execute the given batch of parameters and return the raw output (bytes)"""
+        if not self.running:
+            raise ValueError("AsyncExifTool instance not running.")
+        params = [(p.encode("utf-8") if isinstance(p, str) else p) for p in params]
+        self.number += 1
+        number = self.number
+        future = asyncio.get_event_loop().create_future()
+        self.pending[number] = future
+        try:
+            self.process.stdin.write(b"\n".join(params + [b"-execute%d\n" % number]))
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            self._kill()
+        try:
+            # shield, so that a timeout or cancellation doesn't cancel the Future the reader
+            # is going to complete
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self._kill()
+            raise ExifToolTimeout("exiftool did not respond in %ss" % self.timeout)
+        except asyncio.CancelledError:
+            future.cancel()  # the reader will drop the response
+            raise
+
+    async def execute(self, *params):
+        return (await self.execute_raw(*params)).strip().decode("utf-8")
+
+    async def execute_json(self, *params):
+        params = map(fsencode, params)
+        return json.loads(await self.execute(b"-j", b"-l", *params))
+
+    async def get_metadata_batch(self, filenames):
+        return await self.execute_json(*filenames)
+
+    async def get_metadata(self, filename):
+        return (await self.execute_json(filename))[0]
+
+    async def get_tags_batch(self, tags, filenames):
+        if isinstance(tags, (str, bytes)) or isinstance(filenames, (str, bytes)):
+            raise TypeError("The arguments 'tags' and 'filenames' must be iterables of strings")
+        return await self.execute_json(*(["-" + t for t in tags] + list(filenames)))
+
+    async def get_tags(self, tags, filename):
+        return (await self.get_tags_batch(tags, [filename]))[0]
+
+    async def get_binary_tag(self, tag, filename):
+        return await self.execute_raw(b"-b", fsencode("-" + tag), fsencode(filename))
+
+    async def extract_previews(self, filename, tags=PREVIEW_TAGS):
+        """
+        Reads the embedded previews of the file into memory, all requests in flight at once.
+        :return: dict tag -> image data, for the tags present in the file
+        """
+        data = await asyncio.gather(*[self.get_binary_tag(tag, filename) for tag in tags])
+        return {tag: d for tag, d in zip(tags, data) if d}
+
+
+class AsyncLoop:
+    """An asyncio event loop running in a daemon thread"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="ojo-asyncio", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, coro):
+        """Runs the coroutine in the loop, returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = AsyncLoop()
+        return _loop
+
+
+def call_in_glib(coro, callback, error_callback=None):
+    """
+    Runs the coroutine in the background asyncio loop and calls callback(result), or
+    error_callback(exception), in the GLib main loop.
+    :return: concurrent.futures.Future of the coroutine, cancel() it to drop the request
+    """
+    from gi.repository import GLib
+
+    def _done(future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            GLib.idle_add(lambda: callback(future.result()) and False)
+        elif error_callback:
+            GLib.idle_add(lambda: error_callback(error) and False)
+        else:
+            logging.error("Async request failed", exc_info=error)
+
+    future = get_loop().submit(coro)
+    future.add_done_callback(_done)
+    return future
@@ -23,12 +23,18 @@ def load_options():
     defaults = {
         "folder": util.get_xdg_pictures_folder(),
         "exiftool_path": "~bundled~",
+        "exiftool_processes": 3,
+        "exiftool_timeout": 30,
         "decorated": True,
         "maximized": False,
         "fullscreen": False,
         "enlarge_smaller": False,
         "font_size": "12pt",
         "thumb_height": 180,
+        "thumb_store": "pack",
+        "thumbs_backend": "threads",
+        "thumb_cache_max_mb": 2048,
+        "full_exif_cache_mb": 32,
         "sort_by": "name",
         "sort_order": "asc",
         "show_hidden": False,
@@ -64,6 +70,10 @@ def get_config_dir():
     return util.makedirs(os.path.expanduser("~/.config/ojo/config/"))
 
 
+def get_cache_dir():
+    return os.path.expanduser("~/.config/ojo/cache")
+
+
 def get_config_file(filename):
     return os.path.join(get_config_dir(), filename)
 
@@ -56,12 +56,17 @@ Example usage::
 from __future__ import unicode_literals
 
 import codecs
+import collections
+import itertools
 import json
 import logging
 import os
+import queue
+import re
 import subprocess
 import sys
 import threading
+import time
 
 try:  # Py3k compatibility
     basestring
@@ -70,13 +75,13 @@ except NameError:
 
 
 # Sentinel indicating the end of the output of a sequence of commands.
-# The standard value should be fine.
-sentinel = b"{ready}"
+# Requests are sent with numbered -executeNUM, so their output ends with
+# {readyNUM} and several requests can be in flight at once.
+sentinel = b"{ready%d}"
 
-# The block size when reading from exiftool.  The standard value
-# should be fine, though other values might give better performance in
-# some cases.
-block_size = 4096
+# The block size when reading from exiftool.  Batch JSON responses can
+# be several megabytes, so read in big blocks.
+block_size = 65536
 
 # This code has been adapted from Lib/os.py in the Python source tree
 # (sha1 265e36e277f3)
@@ -109,6 +114,132 @@ fsencode = _fscodec()
 del _fscodec
 
 
+class ExifToolError(Exception):
+    """The ``exiftool`` process died or stopped responding."""
+
+
+class ExifToolTimeout(ExifToolError):
+    """A request did not complete within the timeout."""
+
+
+class ResponseBuffer(object):
+    """Collects the output of an ``exiftool`` process and splits it
+    into responses, each ending with its {readyNUM} sentinel.
+
+    Every byte is searched for a sentinel at most once (plus the few
+    bytes of a sentinel split between reads), so splitting takes
+    linear time even for responses of many megabytes.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.scan_from = 0
+        self.skip_newline = False
+
+    def feed(self, data):
+        self.buf += data
+        if self.skip_newline and self.buf[:1] == b"\n":
+            del self.buf[:1]
+        self.skip_newline = False
+
+    def pop(self, token):
+        """Return the response ending with ``token`` and remove it from
+        the buffer, or ``None`` if it's not complete yet."""
+        buf = self.buf
+        end = buf.find(token, self.scan_from)
+        if end < 0:
+            self.scan_from = max(0, len(buf) - len(token) + 1)
+            return None
+        result = bytes(buf[:end])
+        del buf[: end + len(token)]
+        self.scan_from = 0
+        # the token is followed by a newline, which is not part of the next response
+        if buf[:1] == b"\n":
+            del buf[:1]
+        elif not buf:
+            self.skip_newline = True
+        return result
+
+    def pop_partial(self, token):
+        """Return and remove the start of the response ending with
+        ``token`` that is already in the buffer, keeping back the few
+        bytes that may be the start of the token.  For streaming a
+        response, :py:meth:`pop()` then returns the rest of it."""
+        buf = self.buf
+        if buf.find(token, self.scan_from) >= 0:
+            return b""
+        keep = len(token) - 1
+        if len(buf) <= keep:
+            return b""
+        result = bytes(buf[: len(buf) - keep])
+        del buf[: len(buf) - keep]
+        self.scan_from = 0
+        return result
+
+
+class JsonArrayDecoder(object):
+    """Incrementally decodes a JSON array of objects, as printed by
+    ``exiftool -j``, returning each object as soon as its closing
+    brace has been fed."""
+
+    # characters that matter outside and inside of strings
+    _structure = re.compile(rb'["{}\[\]]')
+    _string = re.compile(rb'["\\]')
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0
+        self.depth = 0
+        self.start = None  # start of the current object
+        self.in_string = False
+
+    def feed(self, data):
+        """Return the list of the objects completed by ``data``."""
+        buf = self.buf
+        buf += data
+        objects = []
+        pos = self.pos
+        while True:
+            if self.in_string:
+                match = self._string.search(buf, pos)
+                if not match:
+                    pos = len(buf)
+                    break
+                pos = match.end()
+                if buf[match.start()] == 0x5C:  # backslash
+                    if pos >= len(buf):
+                        pos -= 1  # the escaped character is yet to come
+                        break
+                    pos += 1
+                else:
+                    self.in_string = False
+                continue
+            match = self._structure.search(buf, pos)
+            if not match:
+                pos = len(buf)
+                break
+            pos = match.end()
+            c = buf[match.start()]
+            if c == 0x22:  # quote
+                self.in_string = True
+            elif c in (0x7B, 0x5B):  # { or [
+                self.depth += 1
+                if self.depth == 2 and c == 0x7B:
+                    self.start = match.start()
+            else:
+                self.depth -= 1
+                if self.depth == 1 and c == 0x7D and self.start is not None:
+                    objects.append(json.loads(bytes(buf[self.start : pos])))
+                    self.start = None
+        # drop what has been decoded
+        consumed = self.start if self.start is not None else pos
+        del buf[:consumed]
+        self.pos = pos - consumed
+        if self.start is not None:
+            self.start = 0
+        return objects
+
+
 class ExifTool(object):
     """Run the `exiftool` command-line tool and communicate to it.
 
@@ -145,11 +276,17 @@ class ExifTool(object):
        associated with a running subprocess.
     """
 
-    def __init__(self, executable=None):
+    def __init__(self, executable=None, timeout=None):
         self.executable = executable or "exiftool"
         logging.info("ExifTool: Using exiftool executable path: %s", self.executable)
         self.running = False
+        self.timeout = timeout
         self.lock = threading.RLock()
+        self.idle = threading.Condition(self.lock)
+        self.numbers = itertools.count(1)
+        self.pending = collections.OrderedDict()  # number -> _Request, in the order sent
+        self.last_done = 0
+        self.stats = _new_stats()
 
     def start(self, show_version=False):
         """Start an ``exiftool`` process in batch mode for this instance.
@@ -169,26 +306,117 @@ class ExifTool(object):
                     stderr=devnull,
                 )
             self.running = True
-            if show_version and logging.getLogger().isEnabledFor(logging.INFO):
-                logging.info("ExifTool Version: %s", self.execute("-ver"))
-            return self
+            # requests of a previous process are failed by that process' reader
+            self.pending = collections.OrderedDict()
+            threading.Thread(
+                target=self._read_responses,
+                args=(self._process, self.pending),
+                name="ojo-exiftool-reader",
+                daemon=True,
+            ).start()
+        if show_version and logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("ExifTool Version: %s", self.execute("-ver"))
+        return self
 
     def terminate(self):
         """Terminate the ``exiftool`` process of this instance.
 
-        If the subprocess isn't running, this method will do nothing.
+        Requests in progress are completed first.  If the subprocess
+        isn't running, this method will do nothing.
         """
         with self.lock:
+            while self.running and self.pending:
+                self.idle.wait()
             if not self.running:
                 return
-            self._process.stdin.write(b"-stay_open\nFalse\n")
+            self.running = False
+            process = self._process
+            del self._process
             try:
-                self._process.stdin.flush()
+                process.stdin.write(b"-stay_open\nFalse\n")
+                process.stdin.flush()
             except BrokenPipeError:
                 pass
-            self._process.communicate()
-            del self._process
+        process.wait()
+        process.stdin.close()
+
+    def _kill(self):
+        """Kill the process after a failed request, its state is unknown.
+        The reader then fails all requests still in flight."""
+        with self.lock:
+            if not self.running:
+                return
             self.running = False
+            process = self._process
+            del self._process
+        process.kill()
+        process.wait()
+        process.stdin.close()
+
+    def _read_responses(self, process, pending):
+        """Reader thread: split the output of the process into the
+        responses of the pending requests, which come in the order sent."""
+        fd = process.stdout.fileno()
+        buf = ResponseBuffer()
+        while True:
+            chunk = os.read(fd, block_size)
+            if not chunk:
+                break
+            buf.feed(chunk)
+            while True:
+                with self.lock:
+                    if not pending:
+                        break
+                    request = next(iter(pending.values()))
+                result = buf.pop(request.token)
+                if result is None:
+                    if request.stream:
+                        self._stream(request, buf.pop_partial(request.token))
+                    break
+                if request.stream:
+                    self._stream(request, result)
+                    result = b""
+                self._finish(pending, request, result=result)
+
+        process.stdout.close()
+        with self.lock:
+            if getattr(self, "_process", None) is process:
+                # exited by itself
+                self.running = False
+                del self._process
+            failed = list(pending.values())
+        for request in failed:
+            self._finish(pending, request, error=ExifToolError("exiftool exited unexpectedly"))
+
+    def _stream(self, request, data):
+        if data and request.error is None:
+            try:
+                request.stream(data)
+            except Exception as e:
+                # fail the request when it's done, the response still has to be read
+                request.error = e
+
+    def _finish(self, pending, request, result=None, error=None):
+        now = time.time()
+        with self.lock:
+            pending.pop(request.number, None)
+            # exiftool serves requests one by one, so a request starts when the previous finishes
+            started = max(request.submitted, self.last_done)
+            self.last_done = now
+            stats = self.stats
+            stats["requests"] += 1
+            stats["wait_time"] += started - request.submitted
+            stats["max_wait_time"] = max(stats["max_wait_time"], started - request.submitted)
+            stats["service_time"] += now - started
+            stats["max_service_time"] = max(stats["max_service_time"], now - started)
+            if error:
+                stats["errors"] += 1
+            self.idle.notify_all()
+        request.result = result
+        request.error = request.error or error
+        request.event.set()
+        if request.stream:
+            request.stream(None)
 
     def __enter__(self):
         return self.start()
@@ -215,17 +443,46 @@ class ExifTool(object):
         .. note:: This is considered a low-level method, and should
            rarely be needed by application developers.
         """
+        return self.execute_raw(*params).strip().decode("utf-8")
+
+    def execute_raw(self, *params):
+        """Execute the given batch of parameters and return the raw output.
+
+        Unlike :py:meth:`execute()`, the output is returned as an
+        unmodified ``bytes`` object (only the sentinel is removed), so
+        this is suitable for extracting binary data with ``-b``.
+
+        This method can be called from several threads at once, their
+        requests are pipelined into the process.
+        """
+        request = self._submit(params)
+        if not request.event.wait(self.timeout):
+            self._timed_out()
+        if request.error:
+            raise request.error
+        return request.result
+
+    def _submit(self, params, stream=None):
+        params = [(p.encode("utf-8") if isinstance(p, str) else p) for p in params]
         with self.lock:
             if not self.running:
                 raise ValueError("ExifTool instance not running.")
-            params = [(p.encode("utf-8") if isinstance(p, str) else p) for p in params]
-            self._process.stdin.write(b"\n".join(params + [b"-execute\n"]))
-            self._process.stdin.flush()
-            output = b""
-            fd = self._process.stdout.fileno()
-            while not output[-32:].strip().endswith(sentinel):
-                output += os.read(fd, block_size)
-            return output.strip()[: -len(sentinel)].decode('utf-8')
+            request = _Request(next(self.numbers), stream)
+            self.pending[request.number] = request
+            try:
+                self._process.stdin.write(
+                    b"\n".join(params + [b"-execute%d\n" % request.number])
+                )
+                self._process.stdin.flush()
+            except BrokenPipeError:
+                self._kill()
+        return request
+
+    def _timed_out(self):
+        with self.lock:
+            self.stats["timeouts"] += 1
+        self._kill()
+        raise ExifToolTimeout("exiftool did not respond in %ss" % self.timeout)
 
     def execute_json(self, *params):
         """Execute the given batch of parameters and parse the JSON output.
@@ -252,6 +509,43 @@ class ExifTool(object):
         params = map(fsencode, params)
         return json.loads(self.execute(b"-j", b"-l", *params))
 
+    def iter_json(self, *params):
+        """Like :py:meth:`execute_json()`, but yield the dictionary of
+        each file as soon as exiftool has printed it, instead of
+        returning the list of all of them at the end.
+
+        ``timeout`` applies to the wait for each file.  Stopping the
+        iteration early is fine, the rest of the response is read and
+        dropped by the reader thread.
+        """
+        items = queue.Queue()
+        decoder = JsonArrayDecoder()
+
+        def _stream(data):
+            if data is None:
+                items.put(_END)
+            else:
+                for item in decoder.feed(data):
+                    items.put(item)
+
+        request = self._submit([b"-j", b"-l"] + [fsencode(p) for p in params], stream=_stream)
+        while True:
+            try:
+                item = items.get(timeout=self.timeout)
+            except queue.Empty:
+                self._timed_out()
+            if item is _END:
+                break
+            yield item
+        if request.error:
+            raise request.error
+
+    def execute_json_stream(self, callback, *params):
+        """Like :py:meth:`execute_json()`, but call ``callback`` with
+        the dictionary of each file as soon as it's available."""
+        for item in self.iter_json(*params):
+            callback(item)
+
     def get_metadata_batch(self, filenames):
         """Return all meta-data for the given files.
 
@@ -289,6 +583,14 @@ class ExifTool(object):
         params.extend(filenames)
         return self.execute_json(*params)
 
+    def iter_tags_batch(self, tags, filenames):
+        """Like :py:meth:`get_tags_batch()`, but yield the dictionary
+        of each file as soon as it's available, see
+        :py:meth:`iter_json()`."""
+        if isinstance(tags, basestring) or isinstance(filenames, basestring):
+            raise TypeError("The arguments 'tags' and 'filenames' must be " "iterables of strings")
+        return self.iter_json(*(["-" + t for t in tags] + list(filenames)))
+
     def get_tags(self, tags, filename):
         """Return only specified tags for a single file.
 
@@ -323,13 +625,180 @@ class ExifTool(object):
         """
         return self.get_tag_batch(tag, [filename])[0]
 
-    def extract_previews(self, filename, to_folder):
-        params = [
-            "-a",
-            "-b",
-            "-W",
-            "{}/%f_%t%-c.%s".format(to_folder),
-            "-preview:all",
-            filename,
-        ]
-        self.execute(*params)
+    def get_binary_tag(self, tag, filename):
+        """Extract the binary data of a tag (e.g. an embedded preview image) from a single file.
+
+        The return value is a ``bytes`` object, empty if the tag was
+        not found in the file.
+        """
+        return self.execute_raw(b"-b", fsencode("-" + tag), fsencode(filename))
+
+
+class ExifToolPool(ExifTool):
+    """Several ``exiftool`` processes behind the :py:class:`ExifTool` interface.
+
+    Every request goes to the process with the fewest requests in
+    flight (an idle one if there is any), so that callers in different
+    threads don't queue behind a single process.  A process that
+    crashes or doesn't answer a request within ``timeout`` seconds is
+    killed (its requests fail with :py:class:`ExifToolError`) and
+    replaced by a new one.
+
+    :py:meth:`get_stats()` reports how long requests waited behind
+    other requests and how long the processes took to serve them,
+    which helps choosing the pool size.
+    """
+
+    def __init__(self, executable=None, size=2, timeout=None):
+        super(ExifToolPool, self).__init__(executable, timeout)
+        self.size = max(1, size)
+        self.instances = []
+        self.restarts = 0
+
+    def start(self, show_version=False):
+        with self.lock:
+            if self.running:
+                logging.warning("ExifToolPool already running, starting again is a noop.")
+                return self
+            self.instances = [
+                ExifTool(self.executable, self.timeout).start() for _ in range(self.size)
+            ]
+            self.running = True
+        if show_version and logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("ExifTool Version: %s, %d processes", self.execute("-ver"), self.size)
+        return self
+
+    def terminate(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            instances = list(self.instances)
+        for instance in instances:
+            # waits for requests in progress
+            instance.terminate()
+        logging.info("ExifToolPool stats: %s", self.get_stats())
+
+    def _choose(self):
+        with self.lock:
+            dead = [instance for instance in self.instances if not instance.running]
+        for instance in dead:
+            self._replace(instance)
+        with self.lock:
+            if not self.running:
+                raise ValueError("ExifTool instance not running.")
+            if not self.instances:
+                raise ExifToolError("no exiftool processes could be started")
+            return min(self.instances, key=lambda instance: len(instance.pending))
+
+    def _replace(self, instance):
+        with self.lock:
+            if not self.running or instance not in self.instances:
+                return  # already replaced
+            self.instances.remove(instance)
+            self._add_stats(instance.stats)
+            self.restarts += 1
+        try:
+            instance = ExifTool(self.executable, self.timeout).start()
+        except Exception:
+            logging.exception("Could not restart exiftool")
+            return
+        with self.lock:
+            if self.running:
+                self.instances.append(instance)
+                return
+        instance.terminate()
+
+    def _add_stats(self, stats):
+        for key, value in stats.items():
+            if key.startswith("max_"):
+                self.stats[key] = max(self.stats[key], value)
+            else:
+                self.stats[key] += value
+
+    def execute_raw(self, *params):
+        instance = self._choose()
+        try:
+            return instance.execute_raw(*params)
+        except ValueError:
+            if not self.running:
+                raise
+            # the process died since we chose it, try another one
+            self._replace(instance)
+            return self._choose().execute_raw(*params)
+        except ExifToolError as e:
+            logging.warning("ExifToolPool: %s, restarting the process", e)
+            self._replace(instance)
+            raise
+
+    def iter_json(self, *params):
+        instance = self._choose()
+        try:
+            try:
+                items = instance.iter_json(*params)
+                first = next(items, _END)
+            except ValueError:
+                if not self.running:
+                    raise
+                # the process died since we chose it, try another one
+                self._replace(instance)
+                instance = self._choose()
+                items = instance.iter_json(*params)
+                first = next(items, _END)
+            if first is _END:
+                return
+            yield first
+            for item in items:
+                yield item
+        except ExifToolError as e:
+            logging.warning("ExifToolPool: %s, restarting the process", e)
+            self._replace(instance)
+            raise
+
+    def get_stats(self):
+        """Return request, error, timeout and restart counts, and the
+        average and maximum wait and service times in seconds."""
+        with self.lock:
+            totals = dict(self.stats)
+            instances = list(self.instances)
+            restarts = self.restarts
+        stats = _new_stats()
+        for s in [totals] + [instance.stats for instance in instances]:
+            for key, value in s.items():
+                stats[key] = max(stats[key], value) if key.startswith("max_") else stats[key] + value
+        requests = stats["requests"] or 1
+        stats["avg_wait_time"] = stats["wait_time"] / requests
+        stats["avg_service_time"] = stats["service_time"] / requests
+        stats["size"] = self.size
+        stats["in_flight"] = sum(len(instance.pending) for instance in instances)
+        stats["restarts"] = restarts
+        return stats
+
+
+def _new_stats():
+    return {
+        "requests": 0,
+        "wait_time": 0.0,
+        "max_wait_time": 0.0,
+        "service_time": 0.0,
+        "max_service_time": 0.0,
+        "errors": 0,
+        "timeouts": 0,
+    }
+
+
+# marks the end of a streamed response
+_END = object()
+
+
+class _Request(object):
+    __slots__ = ("number", "token", "event", "submitted", "result", "error", "stream")
+
+    def __init__(self, number, stream=None):
+        self.number = number
+        self.stream = stream  # called with each part of the response, then with None
+        self.token = sentinel % number
+        self.event = threading.Event()
+        self.submitted = time.time()
+        self.result = None
+        self.error = None
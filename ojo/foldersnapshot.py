@@ -0,0 +1,79 @@
+"""
+What is in a folder, read with a single os.scandir.
+
+Listing, sorting, grouping, the folder stats and the thumbnail manifest all need the images of the
+folder and their sizes and dates, the folders pane needs the subfolders. A FolderSnapshot reads
+the folder once and keeps the DirEntry objects, which tell files from folders without a syscall
+and stat an entry at most once, when first asked.
+"""
+
+import os
+
+
+class FolderSnapshot:
+    def __init__(self, folder, image_extensions):
+        """
+        :param image_extensions: lowercase extensions (with the dot) of the files listed as images
+        """
+        self.folder = os.path.normpath(folder)
+        self.images = {}  # path -> DirEntry, in directory order
+        self.folders = {}  # path -> DirEntry
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        self.folders[entry.path] = entry
+                    elif (
+                        os.path.splitext(entry.name)[1].lower() in image_extensions
+                        and entry.is_file()
+                    ):
+                        self.images[entry.path] = entry
+                except OSError:
+                    continue
+
+    def add_image(self, path):
+        """Adds (or refreshes) an image that appeared in the folder after the snapshot was taken"""
+        self.images[path] = _Stat(os.stat(path))
+
+    def remove_image(self, path):
+        self.images.pop(path, None)
+
+    def list_images(self):
+        return list(self.images)
+
+    def list_folders(self):
+        return list(self.folders)
+
+    def stat(self, path):
+        """:return: the stat result of a file or folder in the snapshot, os.stat for any other"""
+        entry = self.images.get(path) or self.folders.get(path)
+        if entry is None:
+            return os.stat(path)
+        return entry.stat()
+
+    def get_mtime(self, path):
+        return self.stat(path).st_mtime
+
+    def get_size(self, path):
+        return self.stat(path).st_size
+
+    def total_size(self, images=None):
+        """:return: total size of the images (all images of the folder by default)"""
+        return sum(self.get_size(img) for img in (self.images if images is None else images))
+
+    def latest_mtime(self, images=None):
+        """:return: latest modification time of the images, None if there are none"""
+        images = self.images if images is None else images
+        return max((self.get_mtime(img) for img in images), default=None)
+
+
+class _Stat:
+    """Stands for the DirEntry of a file added later"""
+
+    __slots__ = ("st",)
+
+    def __init__(self, st):
+        self.st = st
+
+    def stat(self):
+        return self.st
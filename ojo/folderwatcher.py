@@ -0,0 +1,125 @@
+import logging
+import os
+
+# how long (ms) changes are collected before they are reported together
+DELAY = 300
+
+# GFileMonitorEvent nicks, see FolderWatcher.on_changed
+CREATED = "created"
+CHANGES_DONE_HINT = "changes-done-hint"
+DELETED = "deleted"
+MOVED_IN = "moved-in"
+MOVED_OUT = "moved-out"
+RENAMED = "renamed"
+
+
+class FolderWatcher:
+    """
+    Watches one folder with a Gio.FileMonitor (inotify on Linux) and reports what changed in it
+    as deltas: on_delta(folder, added, removed, changed) with sets of paths, called on the
+    GTK thread. Events are collected for DELAY ms first, so that e.g. a batch of files copied in
+    is reported at once. A new file is reported when it's completely written, and a rename is
+    reported as the removal of the old name and the addition of the new one.
+
+    GLib and Gio are imported where used: how events are coalesced doesn't depend on them.
+    """
+
+    def __init__(self, on_delta):
+        self.on_delta = on_delta
+        self.folder = None
+        self.monitor = None
+        self.timeout_id = None
+        self._reset()
+
+    def _reset(self):
+        self.writing = set()  # created, not yet completely written
+        self.added = set()
+        self.removed = set()
+        self.changed = set()
+
+    def watch(self, folder):
+        from gi.repository import GObject
+
+        # the monitor delivers its signals in the main context of the thread that created it
+        GObject.idle_add(self._watch, os.path.normpath(folder))
+
+    def _watch(self, folder):
+        from gi.repository import Gio, GLib
+
+        if folder == self.folder and self.monitor:
+            return
+        self.stop()
+        self.folder = folder
+        try:
+            self.monitor = Gio.File.new_for_path(folder).monitor_directory(
+                Gio.FileMonitorFlags.WATCH_MOVES, None
+            )
+            self.monitor.connect("changed", self.on_changed)
+        except GLib.Error:
+            logging.exception("Could not watch %s", folder)
+            self.monitor = None
+
+    def stop(self):
+        if self.monitor:
+            self.monitor.cancel()
+            self.monitor = None
+        if self.timeout_id:
+            from gi.repository import GLib
+
+            GLib.source_remove(self.timeout_id)
+            self.timeout_id = None
+        self.folder = None
+        self._reset()
+
+    def on_changed(self, monitor, file, other_file, event_type):
+        if monitor is not self.monitor:
+            return
+        path = file.get_path()
+        event = event_type.value_nick
+        if event == CREATED:
+            self.writing.add(path)
+            return
+        elif event == MOVED_IN:
+            self._add(path)
+        elif event in (DELETED, MOVED_OUT):
+            self._remove(path)
+        elif event == RENAMED:
+            self._remove(path)
+            if other_file and os.path.dirname(other_file.get_path()) == self.folder:
+                self._add(other_file.get_path())
+        elif event == CHANGES_DONE_HINT:
+            if path in self.writing:
+                self.writing.discard(path)
+                self._add(path)
+            elif path not in self.added:
+                self.changed.add(path)
+        else:
+            return
+        if not self.timeout_id:
+            from gi.repository import GLib
+
+            self.timeout_id = GLib.timeout_add(DELAY, self._flush)
+
+    def _add(self, path):
+        self.removed.discard(path)
+        self.changed.discard(path)
+        self.added.add(path)
+
+    def _remove(self, path):
+        self.changed.discard(path)
+        if path in self.writing:
+            self.writing.discard(path)  # deleted before it was completely written
+        elif path in self.added:
+            self.added.discard(path)  # came and went
+        else:
+            self.removed.add(path)
+
+    def _flush(self):
+        self.timeout_id = None
+        added, removed, changed = self.added, self.removed, self.changed
+        self.added, self.removed, self.changed = set(), set(), set()
+        try:
+            self.on_delta(self.folder, added, removed, changed)
+        except Exception:
+            logging.exception("Could not apply the changes in %s", self.folder)
+        return False
@@ -0,0 +1,243 @@
+"""
+Reads the dimensions, orientation and capture date of an image from its header, in-process.
+
+For JPEG, PNG, WebP, TIFF and the TIFF-based RAW formats these are in the first few KB of the
+file (or in a few small IFDs for TIFFs), so reading them here is much cheaper than a round trip
+to ExifTool. Only what the thumbnailer, the viewer and sorting need is read, ExifTool remains
+the source of everything else.
+
+read_header() returns None for other formats and for files it can't make sense of, callers
+fall back to ExifTool then.
+"""
+
+import io
+import os
+import struct
+from collections import namedtuple
+
+# formats with a TIFF structure whose IFDs carry the image size
+TIFF_EXTENSIONS = {".tif", ".tiff", ".dng", ".nef", ".cr2", ".arw"}
+EXTENSIONS = {".jpg", ".jpe", ".jpeg", ".png", ".webp"}.union(TIFF_EXTENSIONS)
+
+# limits against malformed files
+MAX_IFDS = 16
+MAX_IFD_ENTRIES = 1000
+MAX_JPEG_SEGMENTS = 64
+
+# width and height as stored, orientation 1-8 or None, date as "YYYY:MM:DD HH:MM:SS" or None
+ImageHeader = namedtuple("ImageHeader", ["format", "width", "height", "orientation", "date"])
+
+TAG_WIDTH = 0x0100
+TAG_HEIGHT = 0x0101
+TAG_ORIENTATION = 0x0112
+TAG_SUB_IFDS = 0x014A
+TAG_EXIF_IFD = 0x8769
+TAG_DATE_TIME_ORIGINAL = 0x9003
+
+# TIFF field type -> size of one value in bytes
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 6: 1, 7: 1, 8: 2, 9: 4, 13: 4}
+_TYPE_FORMATS = {1: "B", 3: "H", 4: "L", 6: "b", 8: "h", 9: "l", 13: "L"}
+
+# start-of-frame markers, all but DHT (C4), JPG (C8) and DAC (CC)
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _extension(filename):
+    return os.path.splitext(filename)[1].lower()
+
+
+def is_supported(filename):
+    return _extension(filename) in EXTENSIONS
+
+
+def read_header(filename):
+    """:return: ImageHeader, or None if the format is not supported or the header is malformed"""
+    extension = _extension(filename)
+    if extension not in EXTENSIONS:
+        return None
+    try:
+        with open(filename, "rb") as f:
+            start = f.read(12)
+            f.seek(0)
+            if start.startswith(b"\xff\xd8"):
+                return _read_jpeg(f)
+            if start.startswith(b"\x89PNG\r\n\x1a\n"):
+                return _read_png(f)
+            if start.startswith(b"RIFF") and start[8:12] == b"WEBP":
+                return _read_webp(f)
+            if start[:4] in (b"II*\x00", b"MM\x00*") and extension in TIFF_EXTENSIONS:
+                return _read_tiff_image(f)
+    except (OSError, ValueError, struct.error):
+        pass
+    return None
+
+
+def _read_jpeg(f):
+    f.seek(2)
+    orientation = date = None
+    for _ in range(MAX_JPEG_SEGMENTS):
+        b = f.read(1)
+        while b == b"\xff":
+            b = f.read(1)  # fill bytes
+        if not b:
+            return None
+        marker = b[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue  # no payload
+        if marker in (0xD9, 0xDA):
+            return None  # end of image or start of scan before any frame header
+        length = struct.unpack(">H", f.read(2))[0]
+        if length < 2:
+            return None
+        if marker in _SOF_MARKERS:
+            height, width = struct.unpack(">xHH", f.read(5))
+            return ImageHeader("jpeg", width, height, orientation, date)
+        if marker == 0xE1 and orientation is None and date is None:
+            data = f.read(length - 2)
+            if data.startswith(b"Exif\x00\x00"):
+                tiff = _read_tiff(io.BytesIO(data[6:]))
+                if tiff:
+                    orientation, date = tiff["orientation"], tiff["date"]
+        else:
+            f.seek(length - 2, io.SEEK_CUR)
+    return None
+
+
+def _read_png(f):
+    f.seek(8)
+    length, chunk_type, width, height = struct.unpack(">L4sLL", f.read(16))
+    if chunk_type != b"IHDR":
+        return None
+    return ImageHeader("png", width, height, None, None)
+
+
+def _read_webp(f):
+    f.seek(12)
+    width = height = orientation = date = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        chunk_type, size = struct.unpack("<4sL", header)
+        next_chunk = f.tell() + size + (size & 1)
+        if chunk_type == b"VP8X":
+            data = f.read(10)
+            has_exif = data[0] & 0x08
+            width = 1 + int.from_bytes(data[4:7], "little")
+            height = 1 + int.from_bytes(data[7:10], "little")
+            if not has_exif:
+                break
+        elif chunk_type == b"VP8 " and width is None:
+            data = f.read(10)
+            if data[3:6] != b"\x9d\x01\x2a":
+                return None
+            w, h = struct.unpack("<HH", data[6:10])
+            width, height = w & 0x3FFF, h & 0x3FFF
+            break
+        elif chunk_type == b"VP8L" and width is None:
+            data = f.read(5)
+            if data[0] != 0x2F:
+                return None
+            bits = int.from_bytes(data[1:5], "little")
+            width, height = 1 + (bits & 0x3FFF), 1 + ((bits >> 14) & 0x3FFF)
+            break
+        elif chunk_type == b"EXIF":
+            data = f.read(size)
+            if data.startswith(b"Exif\x00\x00"):
+                data = data[6:]
+            tiff = _read_tiff(io.BytesIO(data))
+            if tiff:
+                orientation, date = tiff["orientation"], tiff["date"]
+            break
+        f.seek(next_chunk)
+    if not width or not height:
+        return None
+    return ImageHeader("webp", width, height, orientation, date)
+
+
+def _read_tiff_image(f):
+    tiff = _read_tiff(f, with_sizes=True)
+    if not tiff or not tiff["sizes"]:
+        return None
+    # RAWs keep small previews in some IFDs, the biggest one is the image itself
+    width, height = max(tiff["sizes"], key=lambda size: size[0] * size[1])
+    return ImageHeader("tiff", width, height, tiff["orientation"], tiff["date"])
+
+
+def _read_tiff(f, with_sizes=False):
+    """
+    Reads the IFDs of a TIFF structure starting at the current position of f.
+    :return: dict with the orientation and date, and the (width, height) of all IFDs with_sizes,
+    None if f doesn't start with a TIFF header
+    """
+    base = f.tell()
+    byte_order = f.read(2)
+    if byte_order == b"II":
+        endian = "<"
+    elif byte_order == b"MM":
+        endian = ">"
+    else:
+        return None
+    magic, ifd_offset = struct.unpack(endian + "HL", f.read(6))
+    if magic != 42:
+        return None
+
+    result = {"orientation": None, "date": None, "sizes": []}
+    todo = [(ifd_offset, True)]  # (offset, is in the main IFD chain)
+    seen = set()
+    while todo and len(seen) < MAX_IFDS:
+        offset, in_chain = todo.pop(0)
+        if not offset or offset in seen:
+            continue
+        seen.add(offset)
+        entries, next_offset = _read_ifd(f, base, offset, endian)
+        if len(seen) == 1:
+            orientation = entries.get(TAG_ORIENTATION)
+            result["orientation"] = orientation[0] if orientation else None
+        if TAG_DATE_TIME_ORIGINAL in entries:
+            result["date"] = entries[TAG_DATE_TIME_ORIGINAL]
+        if TAG_EXIF_IFD in entries:
+            todo.append((entries[TAG_EXIF_IFD][0], False))
+        if with_sizes:
+            width, height = entries.get(TAG_WIDTH), entries.get(TAG_HEIGHT)
+            if width and height:
+                result["sizes"].append((width[0], height[0]))
+            todo.extend((sub_ifd, False) for sub_ifd in entries.get(TAG_SUB_IFDS, ()))
+            if in_chain:
+                todo.append((next_offset, True))
+    return result
+
+
+def _read_ifd(f, base, offset, endian):
+    """:return: (dict tag -> tuple of values or string, offset of the next IFD)"""
+    f.seek(base + offset)
+    count = struct.unpack(endian + "H", f.read(2))[0]
+    if count > MAX_IFD_ENTRIES:
+        raise ValueError("Too many IFD entries")
+    raw = f.read(12 * count)
+    next_offset = struct.unpack(endian + "L", f.read(4))[0]
+
+    wanted = {
+        TAG_WIDTH,
+        TAG_HEIGHT,
+        TAG_ORIENTATION,
+        TAG_SUB_IFDS,
+        TAG_EXIF_IFD,
+        TAG_DATE_TIME_ORIGINAL,
+    }
+    entries = {}
+    for i in range(count):
+        tag, field_type, n, value = struct.unpack(endian + "HHL4s", raw[12 * i : 12 * i + 12])
+        if tag not in wanted or field_type not in _TYPE_SIZES or n > MAX_IFD_ENTRIES:
+            continue
+        size = _TYPE_SIZES[field_type] * n
+        if size > 4:
+            position = f.tell()
+            f.seek(base + struct.unpack(endian + "L", value)[0])
+            value = f.read(size)
+            f.seek(position)
+        if field_type == 2:
+            entries[tag] = value[:size].split(b"\x00")[0].decode("ascii", "replace").strip()
+        elif field_type in _TYPE_FORMATS:
+            entries[tag] = struct.unpack(endian + _TYPE_FORMATS[field_type] * n, value[:size])
+    return entries, next_offset
@@ -1,17 +1,21 @@
 # coding=utf-8
+import asyncio
 import io
 import logging
+import math
 import os
 import random
-import tempfile
+import re
 import threading
+from concurrent.futures import Future
 
 import gi
 from gi.repository import GdkPixbuf, Gio, GObject
 from PIL import Image
 
-from ojo import config
-from ojo.exiftool import ExifTool
+from ojo import asyncexiftool, config
+from ojo.exiftool import ExifToolError, ExifToolPool
+from ojo.foldersnapshot import FolderSnapshot
 from ojo.metadata import metadata
 from ojo.util import ext
 
@@ -90,61 +94,159 @@ RAW_FORMATS = {
     ".x3f",
 }
 
+# embedded thumbnails and previews, see get_embedded_pil
+EMBEDDED_IMAGE_TAGS = ("ThumbnailImage", "PreviewImage", "JpgFromRaw", "OtherImage")
+EMBEDDED_IMAGE_FORMATS = {".jpg", ".jpe", ".jpeg", ".tif", ".tiff"}.union(RAW_FORMATS)
+# even heavily compressed JPEG previews take more than this, so a smaller preview
+# can't be big enough for the requested size
+MIN_PREVIEW_BYTES_PER_PIXEL = 0.1
 
 exiftool = None
+async_exiftool = None
+# resolved with the ExifToolPool once it's running
+exiftool_ready = Future()
+_stopped = False
 _lock = threading.Lock()
+# guards starting async_exiftool, created in (and only used from) the asyncexiftool loop
+_async_lock = None
 
 
 # ExifTool is not Thread-safe, so we start one for every subprocess that requires it
-def start_exiftool_process(show_version=False):
+def start_exiftool_process(show_version=False, processes=None):
+    """
+    :param processes: how many exiftool processes serve requests in parallel,
+    the exiftool_processes option by default
+    """
+    with _lock:
+        pool = _start_pool(show_version, processes)
+    _set_ready(pool)
+
+
+def _start_pool(show_version, processes=None):
     logging.debug('Starting exiftool in process %d', os.getpid())
     global exiftool
-    global _lock
-    with _lock:
-        exiftool = ExifTool(executable=config.get_exiftool_path())
-        exiftool.start(show_version)
+    pool = ExifToolPool(
+        executable=config.get_exiftool_path(),
+        size=processes or config.options.get("exiftool_processes", 1),
+        timeout=config.options.get("exiftool_timeout"),
+    )
+    pool.start(show_version)
+    exiftool = pool
+    return pool
+
+
+def _set_ready(pool):
+    # outside of _lock, the Future runs its callbacks right here
+    if not exiftool_ready.done():
+        exiftool_ready.set_result(pool)
+
+
+def start_exiftool_process_in_background(show_version=False):
+    """
+    Starts ExifTool in a background thread, so that startup doesn't wait for Perl.
+    Until it's ready, is_exiftool_ready() is False and metadata makes do without it.
+    :return: the exiftool_ready Future
+    """
+
+    def _start():
+        try:
+            with _lock:
+                if _stopped:  # already quitting
+                    return
+                pool = _start_pool(show_version)
+            _set_ready(pool)
+        except Exception as e:
+            logging.exception("Could not start exiftool")
+            if not exiftool_ready.done():
+                exiftool_ready.set_exception(e)
+
+    threading.Thread(target=_start, name="ojo-exiftool-start", daemon=True).start()
+    return exiftool_ready
+
+
+def is_exiftool_ready():
+    return exiftool is not None and exiftool.running
 
 
 def stop_exiftool_process():
     global exiftool
     global _lock
+    global _stopped
     with _lock:
+        _stopped = True
         if exiftool:
             exiftool.terminate()
             exiftool = None
+        _stop_async_exiftool()
+
 
+async def ensure_async_exiftool():
+    """
+    The AsyncExifTool of this process, started (or restarted, if it died) on first use.
+    To be awaited in the asyncexiftool background loop, which also runs its coroutines,
+    see asyncexiftool.call_in_glib.
+    """
+    global async_exiftool
+    global _async_lock
+    if _async_lock is None:
+        _async_lock = asyncio.Lock()
+    async with _async_lock:
+        if _stopped:
+            raise ExifToolError("exiftool was stopped")
+        if async_exiftool is None or not async_exiftool.running:
+            client = asyncexiftool.AsyncExifTool(
+                executable=config.get_exiftool_path(),
+                timeout=config.options.get("exiftool_timeout"),
+            )
+            await client.start()
+            async_exiftool = client
+        return async_exiftool
 
-def get_optimal_preview(filename, to_folder, width=None, height=None):
-    exiftool.extract_previews(filename, to_folder)
 
-    # filter to just jpeg and png previews (tiffs are sometimes present too)
-    previews = [
-        {"path": os.path.join(to_folder, name)}
-        for name in os.listdir(to_folder)
-        if name.endswith((".jpg", ".jpeg", ".png"))
-    ]
+def _stop_async_exiftool():
+    global async_exiftool
+    if async_exiftool:
+        try:
+            asyncexiftool.get_loop().submit(async_exiftool.terminate()).result(timeout=10)
+        except Exception:
+            logging.exception("Could not stop async exiftool")
+        async_exiftool = None
+
 
-    for p in previews:
-        w, h = get_size_via_pixbuf(p["path"])
-        p["width"] = w
-        p["height"] = h
+def get_optimal_preview(filename, width=None, height=None):
+    """
+    Picks the best embedded preview using the preview sizes already known from the metadata,
+    and reads just that one into memory.
+    :return: the preview image data (jpeg or png)
+    """
+    meta = metadata.get(filename)
+    candidates = get_embedded_image_sizes(meta)
+    if not candidates:
+        raise Exception("No embedded previews in %s" % filename)
 
-    if width is None or height is None:
+    if width is None or height is None or not meta["width"] or not meta["height"]:
         # if no resizing required - use the biggest image
-        preview = max(previews, key=lambda p: p["width"])
+        ordered = list(reversed(candidates))
     else:
-        # else use the smallest image that is bigger than the desired size
-        bigger = [p for p in previews if p["width"] >= width and p["height"] >= height]
-        if bigger:
-            preview = min(bigger, key=lambda p: p["width"])
-        else:
-            preview = max(previews, key=lambda p: p["width"])
+        # else use the smallest image that is likely bigger than the desired size,
+        # judging by its size in bytes
+        scale = min(1.0, float(width) / meta["width"], float(height) / meta["height"])
+        needed_bytes = meta["width"] * meta["height"] * scale * scale * MIN_PREVIEW_BYTES_PER_PIXEL
+        bigger = [c for c in candidates if c[1] >= needed_bytes]
+        smaller = [c for c in candidates if c[1] < needed_bytes]
+        ordered = bigger + list(reversed(smaller))
 
-    return preview["path"]
+    for tag, _ in ordered:
+        data = exiftool.get_binary_tag(tag, filename)
+        # filter to just jpeg and png previews (tiffs are sometimes present too)
+        if data.startswith((b"\xff\xd8", b"\x89PNG")):
+            return data
+
+    raise Exception("No usable embedded previews in %s" % filename)
 
 
 def get_pil(filename, width=None, height=None, fallback_to_preview=False):
-    meta = metadata.get(filename)
+    meta = metadata.get_basic(filename)
     orientation = meta["orientation"]
 
     try:
@@ -152,33 +254,90 @@ def get_pil(filename, width=None, height=None, fallback_to_preview=False):
     except IOError:
         if not fallback_to_preview:
             raise
-        with tempfile.TemporaryDirectory(prefix="ojo") as to_folder:
-            optimal_preview = get_optimal_preview(filename, to_folder, width, height)
-            pil_image = Image.open(optimal_preview)
+        pil_image = Image.open(io.BytesIO(get_optimal_preview(filename, width, height)))
 
     if width is not None:
-        # thumbnail, than auto-rotate (so we work rotate a smaller image), than re-thumbnail
-        # because the rotation might chnage width/height
-        pil_image.thumbnail((max(width, height), max(width, height)), Image.ANTIALIAS)
-        pil_image = auto_rotate_pil(orientation, pil_image)
-        if pil_image.size[0] > width or pil_image.size[1] > height:
-            pil_image.thumbnail((width, height), Image.ANTIALIAS)
+        draft_pil(pil_image, orientation, width, height)
+        return fit_pil(pil_image, orientation, width, height)
     else:
-        pil_image = auto_rotate_pil(orientation, pil_image)
+        return auto_rotate_pil(orientation, pil_image)
+
 
+def fit_pil(pil_image, orientation, width, height):
+    # thumbnail, than auto-rotate (so we work rotate a smaller image), than re-thumbnail
+    # because the rotation might chnage width/height
+    pil_image.thumbnail((max(width, height), max(width, height)), Image.ANTIALIAS)
+    pil_image = auto_rotate_pil(orientation, pil_image)
+    if pil_image.size[0] > width or pil_image.size[1] > height:
+        pil_image.thumbnail((width, height), Image.ANTIALIAS)
     return pil_image
 
 
+def get_embedded_image_sizes(meta):
+    """
+    :return: list of (tag, size in bytes) of the embedded thumbnails and previews listed in the
+    metadata, smallest first
+    """
+    sizes = []
+    for tag in EMBEDDED_IMAGE_TAGS:
+        match = re.match(r"\(Binary data (\d+) bytes", str(meta.get_tag(tag) or ""))
+        if match:
+            sizes.append((tag, int(match.group(1))))
+    return sorted(sizes, key=lambda tag_size: tag_size[1])
+
+
+def get_embedded_pil(filename, width, height):
+    """
+    Looks for an embedded thumbnail or preview that can be used instead of decoding the image.
+    :return: PIL image of the smallest embedded image that is big enough for a width x height
+    thumbnail and has the aspect ratio of the main image (not yet auto-rotated), or None
+    """
+    if ext(filename) in RAW_FORMATS:
+        # RAW previews are only found by ExifTool
+        meta = metadata.get(filename)
+    else:
+        meta = metadata.get_basic(filename)
+        if metadata.is_provisional(filename) and not get_embedded_image_sizes(meta):
+            # a header record doesn't list the embedded images, get() reads them if ExifTool is
+            # ready; if not, it's the image itself that gets decoded
+            meta = metadata.get(filename)
+    orientation = meta["orientation"]
+    image_width, image_height = meta["width"], meta["height"]
+    if not image_width or not image_height:
+        return None
+
+    scale = min(1.0, float(width) / image_width, float(height) / image_height)
+    needed_width, needed_height = int(image_width * scale), int(image_height * scale)
+
+    for tag, _ in get_embedded_image_sizes(meta):
+        data = exiftool.get_binary_tag(tag, filename)
+        if not data:
+            continue
+        try:
+            pil_image = Image.open(io.BytesIO(data))
+        except IOError:
+            continue
+        w, h = pil_image.size
+        if swaps_dimensions(orientation):
+            w, h = h, w
+        if abs(w * image_height - h * image_width) > 0.02 * w * image_height:
+            # e.g. 4:3 thumbnails with black bars for 3:2 images
+            logging.debug("%s of %s has a different aspect ratio, skipping", tag, filename)
+            continue
+        if w >= needed_width and h >= needed_height:
+            return pil_image
+
+    return None
+
+
 def get_pixbuf(filename, width=None, height=None):
-    meta = metadata.get(filename)
+    meta = metadata.get_basic(filename)
     orientation = meta["orientation"]
     image_width, image_height = meta["width"], meta["height"]
 
     def _from_preview():
         try:
-            with tempfile.TemporaryDirectory(prefix="ojo") as to_folder:
-                optimal_preview = get_optimal_preview(filename, to_folder, width, height)
-                pixbuf = pixbuf_from_file(optimal_preview)
+            pixbuf = pixbuf_from_data(get_optimal_preview(filename, width, height))
             pixbuf = auto_rotate_pixbuf(orientation, pixbuf)
             logging.debug("Loaded from preview")
             return pixbuf
@@ -187,7 +346,12 @@ def get_pixbuf(filename, width=None, height=None):
 
     def _from_gdk_pixbuf():
         try:
-            pixbuf = pixbuf_from_file(filename)
+            if width is not None and (width < image_width or height < image_height):
+                # let the loader decode at reduced size (e.g. libjpeg's scaled IDCT for JPEGs)
+                box = (height, width) if swaps_dimensions(orientation) else (width, height)
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(filename, *box)
+            else:
+                pixbuf = pixbuf_from_file(filename)
             pixbuf = auto_rotate_pixbuf(orientation, pixbuf)
             logging.debug("Loaded directly")
             return pixbuf
@@ -238,69 +402,108 @@ def get_pixbuf(filename, width=None, height=None):
     return pixbuf
 
 
-def thumbnail(filename, thumb_path, width, height):
-    temp_fd, tmp_thumb_path = tempfile.mkstemp(prefix="ojo_thumbnail_")
+def thumbnail(filename, store, width, height):
+    """
+    Creates a thumbnail for the image and saves it to the thumbnail store
+    :return: (filename, thumbnail URL, source), where source is "embedded" when an embedded
+    thumbnail or preview was used, and "decoded" when the image itself was decoded
+    """
+    mtime = os.path.getmtime(filename)
+    source = "decoded"
 
-    def use_pil():
-        pil = get_pil(filename, width, height)
+    def save_jpeg(pil):
         try:
-            pil.save(tmp_thumb_path, "JPEG")
+            output = io.BytesIO()
+            pil.save(output, "JPEG")
+            return output.getvalue()
         except Exception:
             logging.exception("Could not save thumbnail in format %s:" % format)
             raise
         finally:
             pil.close()
 
+    def use_pil():
+        return save_jpeg(get_pil(filename, width, height))
+
+    def use_embedded():
+        try:
+            pil = get_embedded_pil(filename, width, height)
+        except Exception:
+            logging.exception("Could not read embedded thumbnails of %s", filename)
+            return None
+        if not pil:
+            return None
+        if pil.mode not in ("RGB", "L"):
+            pil = pil.convert("RGB")
+        return save_jpeg(fit_pil(pil, metadata.get_basic(filename)["orientation"], width, height))
+
     def use_pixbuf():
         pixbuf = get_pixbuf(filename, width, height)
-        pixbuf.savev(tmp_thumb_path, "png", [], [])
-
-    cache_dir = os.path.dirname(thumb_path)
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
+        return pixbuf.save_to_bufferv("png", [], [])[1]
 
-    if ext(filename) in {".gif", ".png", ".svg", ".xpm"}.union(RAW_FORMATS):
+    data = use_embedded() if ext(filename) in EMBEDDED_IMAGE_FORMATS else None
+    if data:
+        source = "embedded"
+    elif ext(filename) in {".gif", ".png", ".svg", ".xpm"}.union(RAW_FORMATS):
         try:
-            use_pixbuf()
+            data = use_pixbuf()
         except Exception:
-            use_pil()
+            data = use_pil()
     else:
         try:
-            use_pil()
+            data = use_pil()
         except Exception:
-            use_pixbuf()
+            data = use_pixbuf()
+
+    store.write(filename, data, mtime)
+
+    return filename, store.url(filename, mtime), source
+
 
-    os.rename(tmp_thumb_path, thumb_path)
-    os.close(temp_fd)
+def derive_thumbnail(filename, store, source_store, width, height):
+    """
+    Creates a thumbnail by downscaling an already cached bigger thumbnail of the same image,
+    without touching the original
+    :return: (filename, thumbnail URL, "derived"), or None if source_store has no thumbnail for
+    the image
+    """
+    mtime = os.path.getmtime(filename)
+    data = source_store.read(filename, mtime)
+    if data is None:
+        return None
+
+    with Image.open(io.BytesIO(data)) as pil:
+        thumb_format = "PNG" if pil.format == "PNG" else "JPEG"
+        pil.thumbnail((width, height), Image.ANTIALIAS)
+        output = io.BytesIO()
+        pil.save(output, thumb_format)
 
-    return filename, thumb_path
+    store.write(filename, output.getvalue(), mtime)
+    logging.debug("Derived thumbnail for %s from %s", filename, source_store.name)
+
+    return filename, store.url(filename, mtime), "derived"
 
 
 def folder_thumb_height(thumb_height):
     return int(thumb_height / 4)
 
 
-def folder_thumbnail(folder, thumb_path, width, height, kill_event):
+def folder_thumbnail(folder, store, image_store, width, height, kill_event):
     """
-    Create the cache folder for the thumb
+    Create the thumb for a folder, composed of thumbs of some of the images in it
     :param folder: folder path
-    :param thumb_path: thumb path to save thumb to
+    :param store: thumbnail store to save the folder thumb to
+    :param image_store: thumbnail store for the thumbs of single images
     :param width: max width of a single image thumbnail (standard non-folder one)
     :param height: height of a single image thumbnail (standard non-folder one, as set in options)
     :param kill_event: multiprocessing.Event that will be set when app is exiting
-    :return: (folder, thumb path), or (folder, None) if folder contains no images
+    :return: (folder, thumb URL), or (folder, None) if folder contains no images
     """
-    cache_dir = os.path.dirname(thumb_path)
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
-
     images = list_images(folder)
 
     if not images:
         return folder, None
 
-    from ojo.thumbs import Thumbs
-
     random.seed(1234)
     random.shuffle(images)
 
@@ -317,10 +520,10 @@ def folder_thumbnail(folder, thumb_path, width, height, kill_event):
             return folder, None
 
         try:
-            fthumb = Thumbs.get_cached_thumbnail_path(f, height)
-            if not os.path.exists(fthumb):
-                _, fthumb = thumbnail(f, fthumb, 3 * height, height)
-            fthumb_image = get_pil(fthumb, MAX_WIDTH, THUMB_HEIGHT)
+            if not image_store.exists(f):
+                thumbnail(f, image_store, 3 * height, height)
+            fthumb_image = Image.open(io.BytesIO(image_store.read(f)))
+            fthumb_image.thumbnail((MAX_WIDTH, THUMB_HEIGHT), Image.ANTIALIAS)
             w, h = fthumb_image.size
             if total_width + MARGIN + w > MAX_WIDTH + 100:
                 break
@@ -330,14 +533,40 @@ def folder_thumbnail(folder, thumb_path, width, height, kill_event):
         except Exception:
             logging.exception("folder_thumbnail: Failed thumbing %s" % f)
 
-    if total_width > 0:
-        image = image.crop((0, 0, min(MAX_WIDTH, total_width), THUMB_HEIGHT))
-        fd, tmp_thumb_path = tempfile.mkstemp(prefix="ojo_folder_thumbnail_")
-        image.save(tmp_thumb_path, "PNG")
-        os.rename(tmp_thumb_path, thumb_path)
-        os.close(fd)
+    if total_width == 0:
+        return folder, None
+
+    image = image.crop((0, 0, min(MAX_WIDTH, total_width), THUMB_HEIGHT))
+    output = io.BytesIO()
+    image.save(output, "PNG")
+    store.write(folder, output.getvalue())
+
+    return folder, store.url(folder)
+
 
-    return folder, thumb_path
+def swaps_dimensions(orientation):
+    """Whether the EXIF orientation rotates the image by 90 or 270 degrees"""
+    if isinstance(orientation, int):
+        return orientation in (5, 6, 7, 8)
+    return bool(orientation) and ("otate 90" in orientation or "otate 270" in orientation)
+
+
+def draft_pil(pil_image, orientation, width, height):
+    """
+    For JPEGs, ask the decoder for 1/2, 1/4 or 1/8 scale output (libjpeg's scaled IDCT) instead of
+    decoding all pixels, as long as the result is still big enough to fill a width x height box
+    after auto-rotation. Must be called before the image data is loaded.
+    """
+    if pil_image.format != "JPEG":
+        return
+    image_width, image_height = pil_image.size
+    box_width, box_height = (height, width) if swaps_dimensions(orientation) else (width, height)
+    scale = min(float(box_width) / image_width, float(box_height) / image_height)
+    if scale < 0.5:
+        pil_image.draft(
+            pil_image.mode,
+            (int(math.ceil(image_width * scale)), int(math.ceil(image_height * scale))),
+        )
 
 
 def auto_rotate_pil(orientation, im):
@@ -490,4 +719,4 @@ def is_image(filename):
 
 
 def list_images(folder):
-    return list(filter(is_image, [os.path.join(folder, f) for f in os.listdir(folder)]))
+    return FolderSnapshot(folder, get_supported_image_extensions()).list_images()
@@ -1,89 +1,490 @@
+import asyncio
+import itertools
 import logging
 import os
+import threading
+from collections import Counter, OrderedDict
 from datetime import datetime
 
 from ojo.util import ext
 
-from ojo import imaging
+from ojo import config, imageheader, imaging
+from ojo.metadatastore import MetadataStore
+from ojo.metarecord import FAST_TAGS, MetaRecord, pack_tags
+
+
+# number of files per ExifTool request when prefetching
+PREFETCH_CHUNK_SIZE = 200
+
+# how long (seconds) get() waits for a prefetch that is about to deliver the file's metadata
+PREFETCH_WAIT_TIMEOUT = 10
+
+# how long (seconds) a prefetch waits for ExifTool to start
+EXIFTOOL_START_TIMEOUT = 30
+
+# how many MetaRecords are kept in memory, the oldest are dropped first
+# (and are loaded again from the persistent cache when needed)
+MAX_CACHED_RECORDS = 200000
+
+# estimated memory of a tag in a full EXIF dump, besides its strings
+EXIF_TAG_OVERHEAD = 400
+
+
+def estimate_exif_size(exif):
+    """:return: rough in-memory size in bytes of an ExifTool -l JSON dict"""
+    size = 0
+    for name, tag in exif.items():
+        size += EXIF_TAG_OVERHEAD + len(name)
+        if isinstance(tag, dict):
+            size += len(str(tag.get("desc", ""))) + len(str(tag.get("val", "")))
+    return size
 
 
 def needs_rotation(meta):
-    orientation = meta.get("Orientation", {"val": ""})["val"]
-    return "otate 90" in orientation or "otate 270" in orientation
+    return imaging.swaps_dimensions(meta.get("Orientation", {"val": None})["val"])
 
 
 class Metadata:
     def __init__(self):
         self.cache = {}
+        self.lock = threading.Lock()
+        self.pending = {}  # filename -> Event set when the prefetch of its chunk is done
+        # notified whenever a prefetch delivers a file, the chunks arrive file by file
+        self.arrived = threading.Condition()
+        self.prefetch_generation = 0
+        self.store = None
+        self.store_failed = False
+        # files cached with what could be read without ExifTool while it was starting
+        self.provisional = set()
+        self.full_exif_cache = OrderedDict()  # filename -> (exif, estimated size)
+        self.full_exif_bytes = 0
+        self.stats = Counter()
 
     def clear_cache(self):
-        self.cache.clear()
+        with self.lock:
+            self.cache.clear()
+            self.provisional.clear()
+            self.full_exif_cache.clear()
+            self.full_exif_bytes = 0
+
+    def _cache_record(self, filename, meta, replace=True, provisional=False):
+        with self.lock:
+            if not replace and filename in self.cache and filename not in self.provisional:
+                return
+            self.cache[filename] = meta
+            if provisional:
+                self.provisional.add(filename)
+            else:
+                self.provisional.discard(filename)
+            if len(self.cache) > MAX_CACHED_RECORDS:
+                # dicts keep insertion order, drop the oldest tenth
+                for key in list(itertools.islice(self.cache, MAX_CACHED_RECORDS // 10)):
+                    del self.cache[key]
+                    self.provisional.discard(key)
+                self.stats["record_evictions"] += MAX_CACHED_RECORDS // 10
+
+    def forget(self, filenames):
+        """Drops what is cached in memory for the files, e.g. because they were changed or removed"""
+        with self.lock:
+            for filename in filenames:
+                self.cache.pop(filename, None)
+                self.provisional.discard(filename)
+                entry = self.full_exif_cache.pop(filename, None)
+                if entry:
+                    self.full_exif_bytes -= entry[1]
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["records"] = len(self.cache)
+            stats["provisional"] = len(self.provisional)
+            stats["full_exif_entries"] = len(self.full_exif_cache)
+            stats["full_exif_bytes"] = self.full_exif_bytes
+        return stats
 
     def get(self, filename):
-        # check cache
+        ready = imaging.is_exiftool_ready()
+
+        # check cache, a provisional entry is only good until ExifTool can read the file
         meta = self.cache.get(filename)
+        if meta and not (ready and filename in self.provisional):
+            return meta
+
+        # a prefetch is about to read it anyway
+        event = self.pending.get(filename)
+        if event and ready:
+            with self.arrived:
+                self.arrived.wait_for(
+                    lambda: filename in self.cache or event.is_set(), PREFETCH_WAIT_TIMEOUT
+                )
+            meta = self.cache.get(filename)
+            if meta:
+                return meta
+
+        # read by us before, in this or an earlier session
+        meta = self.load_persisted(filename)
         if meta:
+            self._cache_record(filename, meta)
             return meta
 
+        if not ready:
+            # ExifTool is still starting, make do with the header, or the pixbuf size for formats
+            # the header reader doesn't know; the entry is upgraded when ExifTool is ready.
+            # RAW previews are only found by ExifTool, so wait for it then: a RAW thumbnail made
+            # from a provisional record would fail for good.
+            if ext(filename) not in imaging.RAW_FORMATS:
+                meta = self.read_header(filename) or self.read_via_pixbuf(filename)
+                self._cache_record(filename, meta, provisional=True)
+                return meta
+            try:
+                imaging.exiftool_ready.result(EXIFTOOL_START_TIMEOUT)
+            except Exception:
+                pass
+            ready = imaging.is_exiftool_ready()
+            if not ready:
+                meta = self.read_via_pixbuf(filename)
+                self._cache_record(filename, meta, provisional=True)
+                return meta
+
         # try to read actual metadata
         meta = self.read(filename)
         if meta:
-            self.cache[filename] = meta
+            self._cache_record(filename, meta)
             return meta
 
         # no metadata, fallback to pixbuf method
         meta = self.read_via_pixbuf(filename)
-        self.cache[filename] = meta
+        self._cache_record(filename, meta)
+        return meta
+
+    def get_basic(self, filename):
+        """
+        Metadata with at least the size, orientation and capture date of the image, for the
+        thumbnailer, viewer and sorting. When nothing is cached or stored yet, these are read from
+        the file header in-process if imageheader knows the format, instead of waiting for ExifTool.
+        The result of a header read is cached as a provisional entry, which get() upgrades later.
+        """
+        meta = self.cache.get(filename)
+        if meta:
+            return meta
+        meta = self.load_persisted(filename)
+        if meta:
+            self._cache_record(filename, meta, replace=False)
+            return meta
+        meta = self.read_header(filename)
+        if not meta:
+            return self.get(filename)
+        if ext(filename) not in imaging.RAW_FORMATS:
+            # RAW previews are only found by ExifTool, keep get() from settling for the header
+            self._cache_record(filename, meta, replace=False, provisional=True)
         return meta
 
+    def read_header(self, filename):
+        header = imageheader.read_header(filename)
+        if not header:
+            return None
+        exif = {
+            "ImageWidth": {"val": header.width},
+            "ImageHeight": {"val": header.height},
+            "Orientation": {"val": header.orientation},
+            "DateTimeOriginal": {"val": header.date},
+        }
+        return self.parse(filename, exif)
+
+    def is_provisional(self, filename):
+        """Whether the cached entry of the file is a stand-in until ExifTool reads the file"""
+        return filename in self.provisional
+
     def get_cached(self, filename):
         return self.cache.get(filename, None)
 
+    def get_full_exif(self, filename):
+        """
+        Returns all the tags ExifTool knows for the file, as shown in the EXIF panel.
+        Falls back to the tags of get() if they can't be read.
+        """
+        exif = self._get_cached_full_exif(filename)
+        if exif is not None:
+            return exif
+
+        try:
+            if not imaging.is_exiftool_ready():
+                return self.get(filename)["exif"]
+            exif = imaging.exiftool.get_metadata(filename)
+        except Exception:
+            logging.exception("Could not read EXIF of %s" % filename)
+            return self.get(filename)["exif"]
+        return self._cache_full_exif(filename, exif)
+
+    async def get_full_exif_async(self, filename):
+        """
+        Coroutine version of get_full_exif, to be run in the asyncexiftool loop
+        (e.g. with asyncexiftool.call_in_glib), so that the UI is not blocked while reading
+        """
+        exif = self._get_cached_full_exif(filename)
+        if exif is not None:
+            return exif
+
+        try:
+            async_exiftool = await imaging.ensure_async_exiftool()
+            exif = await async_exiftool.get_metadata(filename)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Could not read EXIF of %s" % filename)
+            # get() may wait for ExifTool, keep the loop free meanwhile
+            meta = await asyncio.get_event_loop().run_in_executor(None, self.get, filename)
+            return meta["exif"]
+        return self._cache_full_exif(filename, exif)
+
+    def _get_cached_full_exif(self, filename):
+        with self.lock:
+            entry = self.full_exif_cache.get(filename)
+            if entry is None:
+                self.stats["full_exif_misses"] += 1
+                return None
+            self.stats["full_exif_hits"] += 1
+            self.full_exif_cache.move_to_end(filename)
+            return entry[0]
+
+    def _cache_full_exif(self, filename, exif):
+        exif["SourceFile"] = {"desc": "Source File", "val": exif["SourceFile"]}
+        size = estimate_exif_size(exif)
+        budget = config.options.get("full_exif_cache_mb", 32) * 1024 * 1024
+        with self.lock:
+            old = self.full_exif_cache.pop(filename, None)
+            if old:
+                self.full_exif_bytes -= old[1]
+            self.full_exif_cache[filename] = (exif, size)
+            self.full_exif_bytes += size
+            # always keep the newest one, it's the one on screen
+            while self.full_exif_bytes > budget and len(self.full_exif_cache) > 1:
+                _, (_, evicted_size) = self.full_exif_cache.popitem(last=False)
+                self.full_exif_bytes -= evicted_size
+                self.stats["full_exif_evictions"] += 1
+        return exif
+
+    def get_store(self):
+        if self.store is None and not self.store_failed:
+            with self.lock:
+                if self.store is None and not self.store_failed:
+                    try:
+                        self.store = MetadataStore(
+                            os.path.join(config.get_cache_dir(), "metadata.sqlite")
+                        )
+                    except Exception:
+                        logging.exception("Could not open the metadata cache, not using it")
+                        self.store_failed = True
+        return self.store
+
+    def load_persisted(self, filename):
+        """Returns the stored metadata of the file if it is still valid, otherwise None"""
+        store = self.get_store()
+        if not store:
+            return None
+        try:
+            stored = store.get(filename)
+            if stored:
+                stat = os.stat(filename)
+                if stored[:2] == (stat.st_size, stat.st_mtime_ns):
+                    return MetaRecord.from_dict(stored[2])
+        except Exception:
+            logging.exception("Could not load cached metadata for %s", filename)
+        return None
+
+    def load_persisted_folders(self, filenames, snapshot=None):
+        """
+        Fills the cache with the still valid stored metadata of the files, one query per folder
+        :param snapshot: FolderSnapshot of one of the folders, its stats are used to validate the
+        stored entries of that folder instead of a stat call per file
+        """
+        store = self.get_store()
+        if not store:
+            return
+        by_folder = {}
+        for f in filenames:
+            by_folder.setdefault(os.path.dirname(f), set()).add(f)
+        for folder, files in by_folder.items():
+            stored = store.load_folder(folder)
+            listed = snapshot.images if snapshot and snapshot.folder == folder else None
+            gone = []
+            for path, (size, mtime_ns, meta) in stored.items():
+                try:
+                    if listed is None:
+                        stat = os.stat(path)
+                    elif path in listed:
+                        stat = listed[path].stat()
+                    else:
+                        gone.append(path)
+                        continue
+                except FileNotFoundError:
+                    gone.append(path)
+                    continue
+                if path in files and (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                    self._cache_record(path, MetaRecord.from_dict(meta), replace=False)
+            if gone:
+                store.remove_many(gone)
+
+    def persist(self, entries):
+        """Stores a list of (filename, os.stat result taken before reading, metadata)"""
+        store = self.get_store()
+        if not store or not entries:
+            return
+        try:
+            store.put_many(
+                [(f, st.st_size, st.st_mtime_ns, meta.to_dict()) for f, st, meta in entries]
+            )
+        except Exception:
+            logging.exception("Could not save metadata to the cache")
+
+    def prefetch(self, filenames, wait=False, cancel_previous=True, snapshot=None):
+        """
+        Loads the metadata of all the files not yet cached, first from the persistent cache (one
+        query per folder), the rest with ExifTool in chunks of PREFETCH_CHUNK_SIZE files per call.
+        ExifTool's output is parsed file by file as it arrives, get() calls for files in a chunk
+        being read wait just for their file.
+        A new prefetch cancels the chunks of the previous one that haven't been read yet,
+        unless cancel_previous is False.
+        :param wait: read in the calling thread and return when done,
+        otherwise read in a background thread
+        :param snapshot: FolderSnapshot of the files' folder, see load_persisted_folders
+        """
+        with self.lock:
+            if cancel_previous:
+                self.prefetch_generation += 1
+            generation = self.prefetch_generation
+            chunks = []
+            todo = [
+                f
+                for f in filenames
+                if (f not in self.cache or f in self.provisional) and f not in self.pending
+            ]
+            for i in range(0, len(todo), PREFETCH_CHUNK_SIZE):
+                chunk = todo[i : i + PREFETCH_CHUNK_SIZE]
+                event = threading.Event()
+                for f in chunk:
+                    self.pending[f] = event
+                chunks.append((chunk, event))
+
+        def _prefetch():
+            try:
+                self.load_persisted_folders(todo, snapshot)
+            except Exception:
+                logging.exception("Could not load cached metadata")
+
+            if chunks:
+                try:
+                    imaging.exiftool_ready.result(EXIFTOOL_START_TIMEOUT)
+                except Exception:
+                    pass  # the chunks are skipped below
+
+            for chunk, event in chunks:
+                try:
+                    chunk = [f for f in chunk if f not in self.cache or f in self.provisional]
+                    if (
+                        chunk
+                        and generation == self.prefetch_generation
+                        and imaging.is_exiftool_ready()
+                    ):
+                        self._read_batch(chunk)
+                except Exception:
+                    logging.exception("Could not prefetch metadata")
+                finally:
+                    with self.lock:
+                        for f in chunk:
+                            if self.pending.get(f) is event:
+                                del self.pending[f]
+                    event.set()
+                    with self.arrived:
+                        self.arrived.notify_all()
+
+        if wait:
+            _prefetch()
+        elif chunks:
+            threading.Thread(target=_prefetch, name="ojo-metadata-prefetch", daemon=True).start()
+
+    def upgrade_provisional(self):
+        """Reads the files cached without ExifTool again, now that it's ready"""
+        with self.lock:
+            files = list(self.provisional)
+        if files:
+            logging.info("Reading metadata of %d files cached while ExifTool was starting", len(files))
+            # not to cancel the prefetch of the folder being shown
+            self.prefetch(files, cancel_previous=False)
+
+    def _read_batch(self, filenames):
+        stats = {}
+        for filename in filenames:
+            try:
+                stats[filename] = os.stat(filename)
+            except OSError:
+                pass
+        read = []
+        # files not in the response are read individually by get()
+        for meta in imaging.exiftool.iter_tags_batch(FAST_TAGS, list(stats)):
+            filename = meta["SourceFile"]
+            stat = stats.get(filename)
+            if stat is None:
+                continue
+            result = self.parse(filename, meta)
+            if result:
+                self._cache_record(filename, result)
+                read.append((filename, stat, result))
+                with self.arrived:
+                    self.arrived.notify_all()
+        self.persist(read)
+
     def read_via_pixbuf(self, filename):
         w, h = imaging.get_size_via_pixbuf(filename)
         stat = os.stat(filename)
-        return {
-            "filename": os.path.basename(filename),
-            "needs_rotation": False,
-            "width": w,
-            "height": h,
-            "orientation": None,
-            "file_date": stat.st_mtime,
-            "file_size": stat.st_size,
-            "exif": {},
-        }
+        return MetaRecord(
+            filename=os.path.basename(filename),
+            needs_rotation=False,
+            width=w,
+            height=h,
+            orientation=None,
+            file_date=stat.st_mtime,
+            file_size=stat.st_size,
+        )
 
     def read(self, filename):
         try:
-            if imaging.exiftool is None or not imaging.exiftool.running:
+            if not imaging.is_exiftool_ready():
                 return None
 
-            meta = imaging.exiftool.get_metadata(filename)
-
-            meta["SourceFile"] = {"desc": "Source File", "val": meta["SourceFile"]}
+            stat = os.stat(filename)
+            result = self.parse(filename, imaging.exiftool.get_tags(FAST_TAGS, filename))
+            if result:
+                self.persist([(filename, stat, result)])
+            return result
+        except Exception:
+            logging.exception("Could not read meta-info for %s" % filename)
+            return None
 
-            # also cache the most important part
+    def parse(self, filename, meta):
+        """Builds our MetaRecord from ExifTool's JSON output of FAST_TAGS for the file"""
+        try:
             needs_rot = needs_rotation(meta)
             stat = os.stat(filename)
 
-            result = {
-                "filename": os.path.basename(filename),
-                "needs_rotation": needs_rot,
-                "width": meta["ImageWidth" if not needs_rot else "ImageHeight"]["val"],
-                "height": meta["ImageHeight" if not needs_rot else "ImageWidth"]["val"],
-                "orientation": meta.get("Orientation", {"val": None})["val"],
-                "file_date": stat.st_mtime,
-                "file_size": stat.st_size,
-                "exif": meta,
-            }
+            result = MetaRecord(
+                filename=os.path.basename(filename),
+                needs_rotation=needs_rot,
+                width=meta["ImageWidth" if not needs_rot else "ImageHeight"]["val"],
+                height=meta["ImageHeight" if not needs_rot else "ImageWidth"]["val"],
+                orientation=meta.get("Orientation", {"val": None})["val"],
+                file_date=stat.st_mtime,
+                file_size=stat.st_size,
+                tags=pack_tags(meta),
+            )
 
             if ext(filename) == ".svg":
                 # svg sizing is special, exiftool could return things like "270mm" which causes
                 # exceptions downstream, as width and height are expected to be numbers.
                 # So use size from pixbuf, it works OK for svgs.
                 meta_svg = self.read_via_pixbuf(filename)
-                result["width"] = meta_svg["width"]
-                result["height"] = meta_svg["height"]
+                result.width = meta_svg.width
+                result.height = meta_svg.height
 
             return result
 
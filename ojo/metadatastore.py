@@ -0,0 +1,81 @@
+"""
+Persistent metadata cache, an SQLite database in the cache folder.
+
+Rows hold the metadata of a file in the dict form of MetaRecord.to_dict() as JSON,
+keyed by file path. Each row remembers the size and mtime (in ns) of the file it was read from,
+callers compare these to the file's current stat to tell whether the row is still valid.
+Rows are looked up per folder, so a folder is loaded with a single query.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+SCHEMA_VERSION = 2
+
+
+class MetadataStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self.lock, self.db:
+            # WAL lets several ojo instances read while one writes
+            self.db.execute("PRAGMA journal_mode=WAL")
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self.db.execute("DROP TABLE IF EXISTS metadata")
+                self.db.execute("PRAGMA user_version=%d" % SCHEMA_VERSION)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS metadata ("
+                "path TEXT PRIMARY KEY, folder TEXT NOT NULL, "
+                "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, data TEXT NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS metadata_folder ON metadata (folder)")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, path):
+        """:return: (size, mtime_ns, metadata) stored for the file, or None"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, data FROM metadata WHERE path = ?", (path,)
+            ).fetchone()
+        return (row[0], row[1], json.loads(row[2])) if row else None
+
+    def load_folder(self, folder):
+        """:return: dict path -> (size, mtime_ns, metadata) for all files stored for the folder"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT path, size, mtime_ns, data FROM metadata WHERE folder = ?",
+                (os.path.normpath(folder),),
+            ).fetchall()
+        result = {}
+        for path, size, mtime_ns, data in rows:
+            try:
+                result[path] = (size, mtime_ns, json.loads(data))
+            except ValueError:
+                logging.warning("Corrupt metadata cache entry for %s, ignoring", path)
+        return result
+
+    def put_many(self, entries):
+        """Stores a list of (path, size, mtime_ns, metadata), replacing what was stored before"""
+        rows = [
+            (path, os.path.dirname(path), size, mtime_ns, json.dumps(meta))
+            for path, size, mtime_ns, meta in entries
+        ]
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO metadata (path, folder, size, mtime_ns, data) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def remove_many(self, paths):
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM metadata WHERE path = ?", [(p,) for p in paths])
@@ -0,0 +1,120 @@
+"""
+Compact in-memory form of an image's metadata.
+
+A folder of RAW files means tens of thousands of metadata entries kept in memory. Instead of
+ExifTool's JSON ({"Tag": {"desc": ..., "val": ...}} per tag), a MetaRecord keeps the fields ojo
+needs for every image in slots, and the values of the FAST_TAGS as a tuple in FAST_TAGS order.
+The tag descriptions are the same for every image and are kept once per tag.
+
+Records support the meta["width"] / meta["exif"] access of the dicts they replace, and
+to_dict() / from_dict() convert to and from the JSON form stored in the MetadataStore.
+"""
+
+# The tags read for every image: what sizing, rotation, sorting, the file info line and
+# embedded thumbnails need. Orientation is read as a number (1-8).
+# The full EXIF dump, often 50-200KB of JSON for RAW files, is only read for the EXIF panel.
+FAST_TAGS = [
+    "ImageWidth",
+    "ImageHeight",
+    "Orientation#",
+    "DateTimeOriginal",
+    "ExposureTime",
+    "FNumber",
+    "ISO",
+    "FocalLength",
+    "Model",
+    "LensType",
+    # embedded thumbnails and previews, as in imaging.EMBEDDED_IMAGE_TAGS
+    "ThumbnailImage",
+    "PreviewImage",
+    "JpgFromRaw",
+    "OtherImage",
+]
+
+# the keys of the tags in ExifTool's output
+TAG_NAMES = tuple(tag.rstrip("#") for tag in FAST_TAGS)
+_tag_index = {name: i for i, name in enumerate(TAG_NAMES)}
+
+# tag name -> description, as ExifTool reported it
+_tag_descs = {}
+
+
+def pack_tags(exif):
+    """:return: the values of the TAG_NAMES in the ExifTool JSON dict as a tuple, None if none"""
+    values = []
+    found = False
+    for name in TAG_NAMES:
+        tag = exif.get(name)
+        if tag is None:
+            values.append(None)
+            continue
+        found = True
+        values.append(tag.get("val"))
+        if name not in _tag_descs and "desc" in tag:
+            _tag_descs[name] = tag["desc"]
+    return tuple(values) if found else None
+
+
+class MetaRecord(object):
+    __slots__ = (
+        "filename",
+        "needs_rotation",
+        "width",
+        "height",
+        "orientation",
+        "file_date",
+        "file_size",
+        "tags",
+    )
+
+    FIELDS = __slots__[:-1]
+
+    def __init__(
+        self, filename, needs_rotation, width, height, orientation, file_date, file_size, tags=None
+    ):
+        self.filename = filename
+        self.needs_rotation = needs_rotation
+        self.width = width
+        self.height = height
+        self.orientation = orientation
+        self.file_date = file_date
+        self.file_size = file_size
+        self.tags = tags
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def get_tag(self, name):
+        """:return: the value of one of the TAG_NAMES, None if the image doesn't have it"""
+        if self.tags is None:
+            return None
+        i = _tag_index.get(name)
+        return None if i is None else self.tags[i]
+
+    @property
+    def exif(self):
+        """The tags in ExifTool's JSON form, {"Tag": {"desc": ..., "val": ...}}"""
+        if self.tags is None:
+            return {}
+        return {
+            name: {"desc": _tag_descs.get(name, name), "val": val}
+            for name, val in zip(TAG_NAMES, self.tags)
+            if val is not None
+        }
+
+    def to_dict(self):
+        d = {field: getattr(self, field) for field in self.FIELDS}
+        d["exif"] = self.exif
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(
+            *[d.get(field) for field in cls.FIELDS], tags=pack_tags(d.get("exif") or {})
+        )
@@ -39,16 +39,27 @@ import threading
 import time
 from collections import OrderedDict
 
-from ojo import config, imaging, ojoconfig, thumbs, util, webview
+from ojo import (
+    asyncexiftool,
+    config,
+    foldersnapshot,
+    folderwatcher,
+    imageheader,
+    imaging,
+    ojoconfig,
+    thumbqueue,
+    thumbs,
+    util,
+    webview,
+)
 from ojo.config import options
-from ojo.imaging import folder_thumb_height, get_pixbuf, is_image, list_images
+from ojo.imaging import folder_thumb_height, get_pixbuf, is_image
 from ojo.metadata import metadata
 from ojo.places import Places
-from ojo.thumbs import Thumbs
+from ojo.thumbs import THUMBHEIGHTS
 from ojo.util import _u, get_failed_image, ext
 
 LEVELS = (logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG)
-THUMBHEIGHTS = [80, 120, 180, 240, 320, 480]
 CACHE_SIZE = 50
 EXIF_DATE_FORMAT = "%Y:%m:%d %H:%M:%S"
 
@@ -116,6 +127,19 @@ class Ojo:
             action="count",
             help="set error_level output to warning, info, and then debug",
         )
+        parser.add_option(
+            "--cache-stats",
+            dest="cache_stats",
+            action="store_true",
+            help="Print the size of the thumbnail cache and exit",
+        )
+        parser.add_option(
+            "--cache-gc",
+            dest="cache_gc",
+            action="store_true",
+            help="Remove stale thumbnails and shrink the thumbnail cache to the "
+            "thumb_cache_max_mb option, then exit",
+        )
         parser.set_defaults(logging_level=0)
         (self.command_options, self.command_args) = parser.parse_args()
         self.command_args = [os.path.expanduser(p) for p in self.command_args]
@@ -143,7 +167,13 @@ class Ojo:
         self.parse_command_line()
         self.setup_logging()
         config.load_options()
-        imaging.start_exiftool_process(show_version=True)
+        if self.command_options.cache_stats or self.command_options.cache_gc:
+            self.manage_cache()
+            sys.exit(0)
+        # Perl takes a while to start, metadata makes do without ExifTool meanwhile
+        imaging.start_exiftool_process_in_background(show_version=True).add_done_callback(
+            lambda future: future.exception() or metadata.upgrade_provisional()
+        )
 
         if len(self.command_args) >= 1 and os.path.exists(self.command_args[0]):
             path = os.path.realpath(self.command_args[0])
@@ -205,6 +235,8 @@ class Ojo:
         self.mode = "image" if os.path.isfile(path) else "folder"
         self.is_in_search = False
         self.is_in_exif = False
+        self.exif_request = None
+        self.folder_watcher = folderwatcher.FolderWatcher(self.on_folder_delta)
         self.last_action_time = 0
         self.last_folder_change_time = time.time()
         self.last_key_event_time = None
@@ -273,6 +305,9 @@ class Ojo:
     def js(self, command=None, commands=None):
         self.browser.js(command, commands)
 
+    def js_call(self, function, *args):
+        self.browser.call(function, *args)
+
     def select_in_browser(self, path):
         if path:
             self.js(
@@ -348,32 +383,45 @@ class Ojo:
                 self.image.set_from_pixbuf(self.pixbuf)
 
     def get_image_list(self):
-        images = list_images(self.folder)
-        dates = {}
+        images = self.snapshot.list_images()
         if not options["show_hidden"]:
             images = [f for f in images if not os.path.basename(f).startswith(".")]
 
+        images = sorted(images, key=self.get_sort_key(images))
+        if options["sort_order"] == "desc":
+            images = list(reversed(images))
+
+        return images
+
+    def get_sort_key(self, images, snapshot=None):
+        """
+        :return: the sort key for the current sort option, images are those to be sorted
+        :param snapshot: FolderSnapshot of the images' folder, the current one by default
+        """
+        snapshot = snapshot or self.snapshot
         if options["sort_by"] == "extension":
-            key = lambda f: (ext(f) + "_" + os.path.basename(f)).lower()
+            return lambda f: (ext(f) + "_" + os.path.basename(f)).lower()
         elif options["sort_by"] == "name":
-            key = lambda f: os.path.basename(f).lower()
+            return lambda f: os.path.basename(f).lower()
         elif options["sort_by"] == "date":
-            key = lambda f: os.stat(f).st_mtime
+            return snapshot.get_mtime
         elif options["sort_by"] == "exif_date":
-            dates = {
-                image: self._exif_timestamp_fallback_mtime(image) for image in images
-            }
-            key = lambda f: dates[f]
-        elif options["sort_by"] == "size":
-            key = lambda f: os.stat(f).st_size
-        else:
-            key = lambda f: f
+            # the header reader knows the capture date of most images, ExifTool the rest
+            metadata.prefetch(
+                [i for i in images if not imageheader.is_supported(i)], wait=True, snapshot=snapshot
+            )
+            dates = {}
 
-        images = sorted(images, key=key)
-        if options["sort_order"] == "desc":
-            images = list(reversed(images))
+            def key(f):
+                if f not in dates:
+                    dates[f] = self._exif_timestamp_fallback_mtime(f)
+                return dates[f]
 
-        return images
+            return key
+        elif options["sort_by"] == "size":
+            return snapshot.get_size
+        else:
+            return lambda f: f
 
     def get_group_key(self, image, sort_by=None):
         if not sort_by:
@@ -383,7 +431,7 @@ class Ojo:
             ext = os.path.splitext(image)[1][1:].upper()
             return ext if ext else "No extension"
         elif sort_by == "date":
-            ts = os.stat(image).st_mtime
+            ts = self.snapshot.get_mtime(image)
             return self._format_date(ts)
         elif sort_by == "exif_date":
             exif_timestamp = self._exif_timestamp_fallback_mtime(image)
@@ -391,7 +439,7 @@ class Ojo:
         elif sort_by == "name":
             return os.path.basename(image)[0].upper()
         elif sort_by == "size":
-            size = os.stat(image).st_size
+            size = self.snapshot.get_size(image)
             buckets = options["group_by_size_buckets"]
             return next(b[1] for b in buckets if b[0] > size)
         else:
@@ -400,8 +448,8 @@ class Ojo:
     def _exif_timestamp_fallback_mtime(self, filename):
         exif_date = None
         try:
-            m = metadata.get(filename)
-            exif_date = m["exif"].get("DateTimeOriginal", {"val": None})["val"]
+            m = metadata.get_basic(filename)
+            exif_date = m.get_tag("DateTimeOriginal")
         except:
             pass
         if exif_date:
@@ -409,7 +457,7 @@ class Ojo:
                 return datetime.strptime(exif_date, EXIF_DATE_FORMAT).timestamp()
             except:
                 logging.exception("Could not parse EXIF date")
-        return os.stat(filename).st_mtime
+        return self.snapshot.get_mtime(filename)
 
     def _format_date(self, ts):
         return datetime.fromtimestamp(ts).strftime(options["date_format"])
@@ -475,7 +523,15 @@ class Ojo:
         else:
             self.folder_history_position = modify_history_position
         self.recent = ([path] + [r for r in self.recent if r != path])[:50]
+        # one directory read for listing, sorting, grouping, stats and the thumbnail manifest
+        self.snapshot = foldersnapshot.FolderSnapshot(
+            path, imaging.get_supported_image_extensions()
+        )
         self.images = self.get_image_list()
+        # from here on, files added, removed or changed in the folder are applied in place
+        self.folder_watcher.watch(path)
+        # read the metadata of the whole folder in a few batches, ahead of rendering it
+        metadata.prefetch(self.images, snapshot=self.snapshot)
         self.search_text = ""
         self.toggle_search(False, bypass_search)
         self.js('show_error("")')
@@ -528,7 +584,8 @@ class Ojo:
             self.pix_cache[False].clear()
             self.pix_cache[True].clear()
 
-            # TODO: we may want to call metadata.clear_cache() here, or use a LRU policy for it
+            logging.debug("Metadata cache: %s" % metadata.get_stats())
+            logging.debug("Browser messages: %s" % self.browser.get_message_stats())
 
             collected = gc.collect()
             logging.debug("GC collected: %d" % collected)
@@ -637,6 +694,22 @@ class Ojo:
         self.render_browser()
         self.start_background_processes()
 
+    def manage_cache(self):
+        def _print_stats():
+            total = 0
+            for backend, name, count, size in thumbs.Thumbs.get_cache_stats():
+                print(
+                    "%-20s %-6s %8d thumbnails %10.1f MB"
+                    % (name, backend, count, size / 1024 / 1024)
+                )
+                total += size
+            print("Total %.1f MB, budget %d MB" % (total / 1024 / 1024, options["thumb_cache_max_mb"]))
+
+        if self.command_options.cache_gc:
+            removed, freed = thumbs.Thumbs.collect_garbage()
+            print("Removed %d thumbnails, freed %.1f MB" % (removed, freed / 1024 / 1024))
+        _print_stats()
+
     def start_background_processes(self):
         with self.lock:
             global killed
@@ -646,6 +719,7 @@ class Ojo:
             self.thumbs.start(self)
             self.folder_thumbs = thumbs.Thumbs(ojo=self)
             self.folder_thumbs.start(self)
+            self.thumbs.start_cache_sweeper(self)
             self.start_cache_thread()
             if self.mode == "image":
                 self.cache_around()
@@ -695,18 +769,34 @@ class Ojo:
         meta = metadata.get(filename)
         info = self.get_file_info(meta)
         self.js("set_file_info('%s', %s)" % (util.path2url(filename), json.dumps(info)))
+        if self.is_in_exif:
+            self.update_exif_content()
+
+    def update_exif_content(self):
+        filename = self.selected
+        if not self.is_in_exif or not os.path.isfile(filename):
+            return
+
+        def _on_exif(exif):
+            if self.selected == filename and self.is_in_exif:
+                self.js("update_exif_content(%s)" % json.dumps(exif))
+
+        # only the EXIF of the current image matters, drop the request for the previous one
+        if self.exif_request:
+            self.exif_request.cancel()
+        self.exif_request = asyncexiftool.call_in_glib(
+            metadata.get_full_exif_async(filename), _on_exif
+        )
 
     def is_command(self, s):
         return s.startswith("command:")
 
     @util.debounce(0.05)
-    def on_priority(self, argument):
-        files = json.loads(argument)
+    def on_priority(self, files):
         self.thumbs.priority_thumbs([util.url2path(f) for f in files])
 
     @util.debounce(0.05)
-    def on_priority_folders(self, argument):
-        files = json.loads(argument)
+    def on_priority_folders(self, files):
         self.folder_thumbs.priority_thumbs([util.url2path(f) for f in files])
 
     def on_browser_action(self, action, argument):
@@ -815,9 +905,9 @@ class Ojo:
         thumb = None
         show_thumb = group == "Subfolders" and options.show_folder_thumbs
         if show_thumb:
-            thumb = self.folder_thumbs.get_folder_thumbnail_path(path)
-            if not os.path.exists(thumb):
-                self.folder_thumbs.enqueue([path])
+            thumb = self.folder_thumbs.get_folder_thumbnail_url(path)
+            if not thumb:
+                self.folder_thumbs.enqueue([path], thumbqueue.FOLDER)
 
         return {
             "type": "folder",
@@ -829,11 +919,7 @@ class Ojo:
             "note": note,
             "thumb": None
             if not show_thumb
-            else (
-                thumb
-                if os.path.exists(thumb)
-                else "~~pending~~:%d" % folder_thumb_height(options.thumb_height)
-            ),
+            else (thumb or "~~pending~~:%d" % folder_thumb_height(options.thumb_height)),
         }
 
     def get_command_item(self, command, path, icon, group="", label="", nofocus=False):
@@ -856,6 +942,9 @@ class Ojo:
 
     def on_toggle_exif(self, arg):
         self.is_in_exif = arg == "true"
+        if self.is_in_exif:
+            # the grid only has the few tags read for every image, fetch the rest
+            GObject.idle_add(self.update_exif_content)
 
     def on_command(self, command):
         parts = command.split(":")
@@ -988,18 +1077,13 @@ class Ojo:
             return None
 
     def list_subfolders(self):
-        folders = self.filter_hidden(
-            [
-                os.path.join(self.folder, f)
-                for f in os.listdir(self.folder)
-                if os.path.isdir(os.path.join(self.folder, f))
-            ]
-        )
+        snapshot = self.snapshot
+        folders = self.filter_hidden(snapshot.list_folders())
 
         if options["sort_by"] in ("extension", "name", "size"):
             key = lambda f: os.path.basename(f).lower()
         elif options["sort_by"] in ("date", "exif_date"):
-            key = lambda f: os.stat(f).st_mtime
+            key = snapshot.get_mtime
         else:
             key = lambda f: f
 
@@ -1281,13 +1365,11 @@ class Ojo:
     def refresh_category(self, category):
         self.js("refresh_category(%s)" % json.dumps(category))
 
-    def safe_basename(self, img):
-        return os.path.basename(img).replace("'", "\\'")
-
     def render_folder_view(self):
         self.loading_folder = True
         thread_change_time = self.last_folder_change_time
         thread_folder = self.folder
+        snapshot = self.snapshot
         self.js("set_font_size('%s')" % options["font_size"])
         thumbh = options["thumb_height"]
         self.js("set_thumb_height(%d)" % thumbh)
@@ -1308,6 +1390,8 @@ class Ojo:
 
             GObject.idle_add(_render_folders)
 
+            self.thumbs.load_manifest(thread_folder, snapshot)
+
             pos = (
                 self.images.index(self.selected) if self.selected in self.images else 0
             )
@@ -1317,19 +1401,16 @@ class Ojo:
                     for x in sorted(
                         enumerate(self.images), key=lambda i_f: abs(i_f[0] - pos)
                     )
-                    if not os.path.exists(self.thumbs.get_cached_thumbnail_path(x[1]))
-                ]
+                    if not self.thumbs.has_thumbnail(x[1])
+                ],
+                thumbqueue.NEAR,
             )
 
             folder_size = (
-                util.human_size(sum(os.stat(img).st_size for img in self.images))
-                if self.images
-                else ""
+                util.human_size(snapshot.total_size(self.images)) if self.images else ""
             )
             latest_date = (
-                self._format_date(max(os.stat(img).st_mtime for img in self.images))
-                if self.images
-                else ""
+                self._format_date(snapshot.latest_mtime(self.images)) if self.images else ""
             )
             self.js(
                 "set_image_count(%d, '%s', '%s')"
@@ -1349,10 +1430,7 @@ class Ojo:
                     if groups_enabled:
                         group = self.get_group_key(img, options["sort_by"])
                         if group != last_group:
-                            self.js(
-                                "add_group('%s', %s)"
-                                % (group, "true" if last_group is None else "false")
-                            )
+                            self.js_call("add_group", group, last_group is None)
                             last_group = group
 
                     if (
@@ -1361,56 +1439,7 @@ class Ojo:
                     ):
                         return
 
-                    time.sleep(0.001)
-
-                    cached = Thumbs.get_cached_thumbnail_path(img)
-                    if os.path.exists(cached):
-                        self.js(
-                            "add_image_div('%s', '%s', '%s', %s, %s, '%s', '%s')"
-                            % (
-                                util.path2url(thread_folder),
-                                util.path2url(img),
-                                self.safe_basename(img),
-                                "true" if img == self.selected else "false",
-                                "true" if options["show_captions"] else "false",
-                                group if group else "",
-                                util.path2url(cached),
-                            )
-                        )
-
-                        if img == self.selected:
-                            self.update_selected_info(img)
-                    else:
-                        info = None
-                        try:
-                            meta = metadata.get(img)
-                            info = self.get_file_info(meta)
-
-                            w, h = meta["width"], meta["height"]
-                            thumb_width = float(w) * min(h, thumbh) / h
-                        except:
-                            thumb_width = (
-                                190  # best to match the width of the failed image
-                            )
-
-                        self.js(
-                            "add_image_div('%s', '%s', '%s', %s, %s, '%s', undefined, %f)"
-                            % (
-                                util.path2url(thread_folder),
-                                util.path2url(img),
-                                self.safe_basename(img),
-                                "true" if img == self.selected else "false",
-                                "true" if options["show_captions"] else "false",
-                                group if group else "",
-                                thumb_width,
-                            )
-                        )
-
-                        if info:
-                            self.js(
-                                "set_file_info('%s', %s, %d)"
-                                % (util.path2url(img), json.dumps(info), thumb_width)
-                            )
+                    self.add_image_div(thread_folder, img, group)
                 except Exception:
                     logging.exception(
                         "Error in render_folder_view._prepare_thread for %s", img
@@ -1422,6 +1451,158 @@ class Ojo:
 
         OjoThread(ojo=self, target=_prepare_thread).start()
 
+    def add_image_div(self, folder, img, group, position=None):
+        """
+        Adds the grid item of the image, with its thumbnail if cached.
+        :param position: None to append, {"before": file} or {"after": file} to insert
+        """
+        position = (
+            {k: util.path2url(v) for k, v in position.items()} if position else None
+        )
+        cached = self.thumbs.get_thumbnail_url(img)
+        info = None
+        if cached:
+            # the grid lays out its rows from the widths of the items, up front
+            try:
+                thumb_width = self.get_thumb_width(metadata.get_basic(img))
+            except Exception:
+                thumb_width = None  # the grid corrects it when the thumbnail loads
+        else:
+            try:
+                meta = metadata.get(img)
+                info = self.get_file_info(meta)
+                thumb_width = self.get_thumb_width(meta)
+            except:
+                thumb_width = 190  # best to match the width of the failed image
+
+        self.js_call(
+            "add_image_div",
+            util.path2url(folder),
+            util.path2url(img),
+            os.path.basename(img),
+            img == self.selected,
+            bool(options["show_captions"]),
+            group or "",
+            cached,
+            thumb_width,
+            position,
+        )
+        if cached and img == self.selected:
+            self.update_selected_info(img)
+        if info:
+            self.js_call("set_file_info", util.path2url(img), info, int(thumb_width))
+
+    @staticmethod
+    def get_thumb_width(meta):
+        thumbh = options["thumb_height"]
+        w, h = meta["width"], meta["height"]
+        return float(w) * min(h, thumbh) / h
+
+    def on_folder_delta(self, folder, added, removed, changed):
+        """
+        Applies the changes reported by the folder watcher to the image list, the grid,
+        the thumbnail queue and the metadata cache, without reloading the folder
+        """
+        if folder != self.folder:
+            return
+        if self.loading_folder:
+            # the folder is being rendered from the image list, try again when done
+            GObject.timeout_add(
+                folderwatcher.DELAY, self.on_folder_delta, folder, added, removed, changed
+            )
+            return
+
+        extensions = imaging.get_supported_image_extensions()
+        current = set(self.images)
+        # changed files and files replaced by a rename are removed and added back
+        changed = {f for f in changed | added if f in current}
+        gone = {f for f in removed | changed if f in current}
+        new = [
+            f
+            for f in added | changed
+            if ext(f) in extensions
+            and (options["show_hidden"] or not os.path.basename(f).startswith("."))
+            and os.path.isfile(f)
+        ]
+        if not gone and not new:
+            return
+        logging.info("%s: %d images added, %d removed", folder, len(new), len(gone))
+        # sorting and sizing the new images may need their metadata, don't wait for it here
+        OjoThread(
+            ojo=self, target=self._apply_folder_delta, args=(folder, gone, new)
+        ).start()
+
+    def _apply_folder_delta(self, folder, gone, new):
+        # the user may change folder meanwhile, work on this folder's state only
+        snapshot = self.snapshot
+        images = self.images
+        if snapshot.folder != folder:
+            return
+        manifest = self.thumbs.manifest
+
+        metadata.forget(gone | set(new))
+        for f in gone:
+            snapshot.remove_image(f)
+            self.thumbs.queue.remove(f)
+            if manifest:
+                manifest.remove(f)
+        for f in list(new):
+            try:
+                snapshot.add_image(f)
+                if manifest:
+                    # a changed file has a new mtime and so a new thumbnail key
+                    manifest.add(f, snapshot.stat(f))
+            except OSError:
+                new.remove(f)
+
+        # sort the new images in, as get_image_list would
+        images = [f for f in images if f not in gone]
+        descending = options["sort_order"] == "desc"
+        if descending:
+            images.reverse()
+        images = sorted(images + new, key=self.get_sort_key(new, snapshot))
+        if descending:
+            images.reverse()
+        if self.folder != folder or self.snapshot is not snapshot:
+            return
+        self.images = images
+        metadata.prefetch(new, cancel_previous=False, snapshot=snapshot)
+        self.thumbs.priority_thumbs(new, thumbqueue.NEAR)
+
+        if self.mode != "folder" or self.folder != folder:
+            return
+        for f in gone:
+            self.js_call("remove_image_div", util.path2url(f))
+
+        groups_enabled = options.get("show_groups_for", {}).get(options["sort_by"], False)
+        new = set(new)
+        for i, img in enumerate(images):
+            if img not in new:
+                continue
+            group = self.get_group_key(img) if groups_enabled else None
+            before = images[i + 1] if i + 1 < len(images) else None
+            after = images[i - 1] if i > 0 else None
+            if after and (not groups_enabled or self.get_group_key(after) == group):
+                position = {"after": after}
+            elif before and (not groups_enabled or self.get_group_key(before) == group):
+                position = {"before": before}
+            elif not after and not before and not groups_enabled:
+                position = None
+            else:
+                # the image starts a new group, render the folder anew
+                GObject.idle_add(self.render_folder_view)
+                return
+            self.add_image_div(folder, img, group, position)
+
+        self.js(
+            "set_image_count(%d, '%s', '%s')"
+            % (
+                len(images),
+                util.human_size(snapshot.total_size(images)) if images else "",
+                self._format_date(snapshot.latest_mtime(images)) if images else "",
+            )
+        )
+
     def build_folder_info(self):
         categories = []
 
@@ -1508,28 +1689,24 @@ class Ojo:
 
         OjoThread(ojo=self, target=_queue_thread).start()
 
-    def on_thumb_ready(self, img, thumb_path):
+    def on_thumb_ready(self, img, thumb_url):
         if os.path.isfile(img):
             if not self.folder or os.path.normpath(
                 os.path.dirname(img)
             ) != os.path.normpath(self.folder):
                 # ignore thumbs that were returned after the folder was changed
                 return
-            self.js(
-                "add_image('%s', '%s')"
-                % (util.path2url(img), util.path2url(thumb_path))
-            )
+            self.js_call("add_image", util.path2url(img), thumb_url)
             if img == self.selected:
                 self.select_in_browser(img)
         else:
             if options.show_folder_thumbs:
                 self.js(
-                    "add_folderthumb('%s', '%s')"
-                    % (util.path2url(img), util.path2url(thumb_path))
+                    "add_folderthumb('%s', '%s')" % (util.path2url(img), thumb_url)
                 )
 
     def on_thumb_failed(self, img, error_msg):
-        self.js("remove_image_div('%s')" % util.path2url(img))
+        self.js_call("remove_image_div", util.path2url(img))
         logging.warning("Could not add thumb for " + img)
 
     def set_margins(self, margin):
@@ -1741,6 +1918,7 @@ class Ojo:
         """
         logging.info("Exiting, closing window...")
         self.window.hide()
+        self.folder_watcher.stop()
         logging.info("Window closed")
 
         def _exit(*args):
@@ -1822,14 +2000,7 @@ class Ojo:
         elif key == "F5":
             if self.ctrl_key(event) and self.mode == "folder":
                 self.thumbs.clear_thumbnails(self.folder)
-                folder_thumb_path = self.folder_thumbs.get_folder_thumbnail_path(
-                    self.folder
-                )
-                try:
-                    os.unlink(folder_thumb_path)
-                except:
-                    pass
-                self.folder_thumbs.priority_thumbs([folder_thumb_path])
+                self.folder_thumbs.clear_folder_thumbnail(self.folder)
             self.show(self.selected if self.mode == "image" else self.folder)
         elif key == "Return":
             if self.mode == "image":
@@ -2054,7 +2225,7 @@ class Ojo:
                 logging.info("Cache hit: " + filename)
                 return cached[0]
 
-        meta = metadata.get(filename)
+        meta = metadata.get_basic(filename)
         image_width, image_height = meta["width"], meta["height"]
 
         if not zoom:
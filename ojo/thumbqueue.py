@@ -0,0 +1,85 @@
+"""
+Priority queue of files waiting for a thumbnail.
+
+Files are ordered by priority class first (what is visible comes before what is near the
+viewport, before the rest of the folder, before folder thumbnails), then by the order in which
+they were queued. Files moved to the front of their class with prioritize() come before
+everything queued earlier, as when scrolling the most recently requested files matter most.
+
+A file is in the queue at most once. Adding, reprioritizing and removing a file are O(log n),
+entries of reprioritized and removed files are only marked as such and skipped when popped.
+"""
+
+import heapq
+import itertools
+import threading
+
+VISIBLE = 0
+NEAR = 1
+OFFSCREEN = 2
+FOLDER = 3
+
+
+class ThumbQueue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []  # [priority class, sequence, filename or None when cancelled]
+        self.entries = {}  # filename -> its live heap entry
+        self.back = itertools.count()  # sequence numbers for appending
+        self.front = itertools.count(-1, -1)  # sequence numbers for prepending
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def __contains__(self, filename):
+        with self.lock:
+            return filename in self.entries
+
+    def _push(self, filename, priority, sequence):
+        entry = [priority, sequence, filename]
+        self.entries[filename] = entry
+        heapq.heappush(self.heap, entry)
+
+    def _cancel(self, filename):
+        entry = self.entries.pop(filename, None)
+        if entry:
+            entry[2] = None
+
+    def enqueue(self, files, priority=OFFSCREEN):
+        """Appends the files to their class, files already queued keep their place"""
+        with self.lock:
+            for filename in files:
+                if filename not in self.entries:
+                    self._push(filename, priority, next(self.back))
+
+    def prioritize(self, files, priority=VISIBLE):
+        """
+        Moves the files to the front of the given class, keeping their order,
+        and ahead of files prioritized earlier
+        """
+        with self.lock:
+            files = list(dict.fromkeys(files))
+            # sequence numbers decrease, so take them in reverse to keep the files' order
+            for filename, sequence in zip(reversed(files), self.front):
+                self._cancel(filename)
+                self._push(filename, priority, sequence)
+
+    def remove(self, filename):
+        with self.lock:
+            self._cancel(filename)
+
+    def pop(self):
+        """Removes and returns the first file, None if the queue is empty"""
+        with self.lock:
+            while self.heap:
+                _, _, filename = heapq.heappop(self.heap)
+                if filename is not None:
+                    del self.entries[filename]
+                    return filename
+            return None
+
+    def clear(self):
+        with self.lock:
+            self.heap = []
+            self.entries = {}
@@ -1,37 +1,163 @@
-import hashlib
+import atexit
+import collections
+import contextlib
 import logging
 import multiprocessing
 import os
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from ojo import imaging
+from ojo import config, imaging, thumbqueue, thumbstore
 from ojo.config import options
-from ojo.util import _bytes, ext, get_failed_image
+from ojo.foldersnapshot import FolderSnapshot
+from ojo.util import ext, get_failed_image, path2url
 
 POOL_SIZE = max(1, multiprocessing.cpu_count() - 1)
+THUMBHEIGHTS = [80, 120, 180, 240, 320, 480]
+BACKENDS = ("threads", "processes")
 
+# thumbnail workers run at this niceness, so that the decoding of the image being viewed wins
+WORKER_NICENESS = 10
 
-def _safe_thumbnail(filename, cached, width, height, kill_event):
+# while the user is cycling through images (last action less than FOREGROUND_TIME seconds ago)
+# or an image is being decoded for viewing, at most FOREGROUND_SLOTS thumbnails are in progress
+FOREGROUND_TIME = 1
+FOREGROUND_SLOTS = 1
+
+# the background cache sweeper first runs this many seconds after start, then periodically
+SWEEP_DELAY = 60
+SWEEP_INTERVAL = 3600
+
+
+def _lower_worker_priority():
+    try:
+        # Linux applies the niceness to the calling thread only
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), WORKER_NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+
+def _init_process_worker(worker_options):
+    # every worker process gets its own ExifTool and decoder state
+    options.update(worker_options)
+    _lower_worker_priority()
+    # requests within a worker are sequential, one exiftool is enough
+    imaging.start_exiftool_process(processes=1)
+    atexit.register(imaging.stop_exiftool_process)
+    atexit.register(thumbstore.save_all_access_times)
+
+
+def _safe_thumbnail(filename, store, image_store, larger_stores, width, height, kill_event):
+    """
+    :return: (filename, thumbnail URL or None, source), source tells how the thumbnail was made
+    """
     try:
         if kill_event.is_set():
-            return filename, cached
+            return filename, None, "killed"
+
+        if ext(filename) == ".gif" and os.path.isfile(filename):
+            # Use gifs directly - webkit will handle transparency, animation, etc.
+            return filename, path2url(filename), "gif"
 
-        if os.path.exists(cached):
-            return filename, cached
+        if store.exists(filename):
+            return filename, store.url(filename), "cached"
 
         if os.path.isfile(filename) and not imaging.is_image(filename):
-            return filename, cached
+            return filename, None, "not_image"
 
         if os.path.isdir(filename):
-            return imaging.folder_thumbnail(filename, cached, width, height, kill_event)
-        else:
-            return imaging.thumbnail(filename, cached, width, height)
+            folder, thumb_url = imaging.folder_thumbnail(
+                filename, store, image_store, width, height, kill_event
+            )
+            return folder, thumb_url, "folder"
+
+        # a bigger thumbnail of the same image is much cheaper to downscale than the original
+        for larger_store in larger_stores:
+            derived = imaging.derive_thumbnail(filename, store, larger_store, width, height)
+            if derived:
+                return derived
+
+        return imaging.thumbnail(filename, store, width, height)
     except:
         logging.exception("Error creating thumb for %s, using error image", filename)
-        # caller will check whether the file was actually created
-        return filename, get_failed_image() if os.path.isfile(filename) else None
+        if os.path.isfile(filename):
+            return filename, path2url(get_failed_image()), "failed"
+        else:
+            return filename, None, "failed"
+
+
+class ManifestEntry:
+    __slots__ = ("inode", "size", "mtime_ns", "mtime", "cached")
+
+    def __init__(self, inode, size, mtime_ns, mtime, cached):
+        self.inode = inode
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.mtime = mtime
+        self.cached = cached
+
+
+class FolderManifest:
+    """
+    Thumbnail status of all images in a folder, built from a FolderSnapshot of the folder and a
+    single listing of the matching thumbnail cache folder. Afterwards checking whether an image
+    has a thumbnail needs no syscalls. Entries are keyed by image name.
+    """
+
+    def __init__(self, folder, store, snapshot=None):
+        """:param snapshot: FolderSnapshot of the folder, taken anew if not given"""
+        self.folder = os.path.normpath(folder)
+        self.store = store
+        self.entries = {}
+        self.scan(snapshot)
+
+    def scan(self, snapshot=None):
+        if snapshot is None or snapshot.folder != self.folder:
+            snapshot = FolderSnapshot(self.folder, imaging.get_supported_image_extensions())
+        cached = self.store.cached_keys(self.folder)
+        entries = {}
+        for path in snapshot.list_images():
+            try:
+                st = snapshot.stat(path)
+            except OSError:
+                continue
+            key = thumbstore.get_thumb_key(path, st.st_mtime)
+            entries[os.path.basename(path)] = ManifestEntry(
+                st.st_ino, st.st_size, st.st_mtime_ns, st.st_mtime, key in cached
+            )
+        self.entries = entries
+
+    def get(self, filename):
+        if os.path.dirname(filename) != self.folder:
+            return None
+        return self.entries.get(os.path.basename(filename))
+
+    def update(self, filename):
+        entry = self.get(filename)
+        if entry:
+            entry.cached = self.store.exists(filename, entry.mtime)
+
+    def set_cached(self, filename, cached):
+        entry = self.get(filename)
+        if entry:
+            entry.cached = cached
+
+    def add(self, filename, st):
+        """Adds (or refreshes) the entry of an image added or changed after the scan"""
+        if os.path.dirname(filename) != self.folder:
+            return
+        self.entries[os.path.basename(filename)] = ManifestEntry(
+            st.st_ino,
+            st.st_size,
+            st.st_mtime_ns,
+            st.st_mtime,
+            self.store.exists(filename, st.st_mtime),
+        )
+
+    def remove(self, filename):
+        if os.path.dirname(filename) == self.folder:
+            self.entries.pop(os.path.basename(filename), None)
 
 
 class Thumbs:
@@ -39,42 +165,196 @@ class Thumbs:
         self.ojo = ojo
         self.pool = None
         self.killed = False
+        self.queue = thumbqueue.ThumbQueue()
+        self.processing = set()
+        self.dispatch_lock = threading.RLock()
+        self.dispatching = False
         self.lock = threading.Lock()
+        self.manifest = None
+        self.stats = collections.Counter()  # how thumbnails were made, see _safe_thumbnail
+
+    @staticmethod
+    def get_cache_dir():
+        return config.get_cache_dir()
 
     @staticmethod
     def get_thumbs_cache_dir(height):
-        return os.path.expanduser("~/.config/ojo/cache/%d" % height)
+        return os.path.join(Thumbs.get_cache_dir(), "%d" % height)
 
     @staticmethod
     def get_folderthumbs_cache_dir(height):
-        return os.path.expanduser("~/.config/ojo/cache/folderthumbs_%d" % height)
+        return os.path.join(Thumbs.get_cache_dir(), "folderthumbs_%d" % height)
+
+    @staticmethod
+    def get_store(thumb_height=None):
+        if thumb_height is None:
+            thumb_height = options["thumb_height"]
+        return thumbstore.open_store(
+            options["thumb_store"], Thumbs.get_cache_dir(), "%d" % thumb_height
+        )
+
+    @staticmethod
+    def get_larger_stores(thumb_height=None):
+        """Existing stores with thumbnails bigger than thumb_height, nearest size first"""
+        if thumb_height is None:
+            thumb_height = options["thumb_height"]
+        return [
+            Thumbs.get_store(h)
+            for h in THUMBHEIGHTS
+            if h > thumb_height
+            and thumbstore.store_exists(options["thumb_store"], Thumbs.get_cache_dir(), "%d" % h)
+        ]
+
+    @staticmethod
+    def get_folder_store():
+        return thumbstore.open_store(
+            options["thumb_store"],
+            Thumbs.get_cache_dir(),
+            "folderthumbs_%d" % options["thumb_height"],
+            suffix=".png",
+        )
+
+    @staticmethod
+    @contextlib.contextmanager
+    def open_all_stores():
+        """
+        All stores found in the cache folder, including ones of the backend not in use.
+        Those are opened just for the with block and closed after it.
+        """
+        stores = []
+        unshared = []
+        for backend, name in thumbstore.list_stores(Thumbs.get_cache_dir()):
+            suffix = ".png" if name.startswith("folderthumbs_") else ".jpg"
+            if backend == options["thumb_store"]:
+                stores.append(thumbstore.open_store(backend, Thumbs.get_cache_dir(), name, suffix))
+                continue
+            if backend == "files":
+                store = thumbstore.FileThumbStore(Thumbs.get_cache_dir(), name, suffix)
+            else:
+                store = thumbstore.PackThumbStore(Thumbs.get_cache_dir(), name)
+            stores.append(store)
+            unshared.append(store)
+        try:
+            yield stores
+        finally:
+            for store in unshared:
+                store.close()
+
+    @staticmethod
+    def get_cache_stats():
+        """:return: list of (store backend, store name, thumbnail count, bytes)"""
+        with Thumbs.open_all_stores() as stores:
+            return [(s.backend, s.name) + s.size() for s in stores]
+
+    @staticmethod
+    def collect_garbage(kill_event=None, pause=0):
+        """Enforces the thumb_cache_max_mb budget, see thumbstore.collect_garbage"""
+        with Thumbs.open_all_stores() as stores:
+            return thumbstore.collect_garbage(
+                stores,
+                options["thumb_cache_max_mb"] * 1024 * 1024,
+                kill_event=kill_event,
+                pause=pause,
+            )
+
+    def start_cache_sweeper(self, ojo):
+        def _sweeper_thread():
+            try:
+                # run at the lowest CPU priority (Linux sets niceness per thread)
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+            except (AttributeError, OSError):
+                pass
+
+            delay = SWEEP_DELAY
+            while not self.kill_event.wait(delay):
+                delay = SWEEP_INTERVAL
+                try:
+                    start = time.time()
+                    removed, freed = self.collect_garbage(kill_event=self.kill_event, pause=0.01)
+                    logging.info(
+                        "Cache sweeper: removed %d thumbnails, freed %d bytes in %.1fs",
+                        removed,
+                        freed,
+                        time.time() - start,
+                    )
+                except Exception:
+                    logging.exception("Cache sweeper failed")
+
+        from ojo.ojo import OjoThread
+
+        self.sweeper = OjoThread(ojo=ojo, target=_sweeper_thread, name="ojo-cache-sweeper")
+        if not self.killed:
+            self.sweeper.start()
 
     def reset_queues(self):
-        self.queue = []
+        self.queue.clear()
 
     def stop(self):
         self.killed = True
         with self.lock:
-            self.queue = []
+            self.queue.clear()
             self.kill_event.set()
-            self.thumbs_event.set()
             if self.pool:
-                logging.info("%s: Shutting down ThreaPoolExecutor...", self)
+                logging.info("%s: Shutting down %s...", self, type(self.pool).__name__)
                 self.pool.shutdown(wait=True)
                 self.pool = None
                 self.thread.join()
-                logging.info("%s: Stopped", self)
+                logging.info("%s: Stopped, thumbnails by source: %s", self, dict(self.stats))
+        thumbstore.save_all_access_times()
 
     def init_pool(self):
         with self.lock:
-            self.pool = ThreadPoolExecutor(max_workers=POOL_SIZE)
+            if options["thumbs_backend"] == "processes":
+                # spawn, as forking a process running GTK and several threads is not safe
+                self.pool = ProcessPoolExecutor(
+                    max_workers=POOL_SIZE,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_process_worker,
+                    initargs=(dict(options),),
+                )
+            else:
+                self.pool = ThreadPoolExecutor(
+                    max_workers=POOL_SIZE, initializer=_lower_worker_priority
+                )
+
+    def get_free_slots(self):
+        ojo = self.ojo
+        if ojo.mode == "image" and (
+            ojo.current_preparing or time.time() - ojo.last_action_time < FOREGROUND_TIME
+        ):
+            # the user is viewing images, keep most cores free for decoding them
+            slots = FOREGROUND_SLOTS
+        else:
+            slots = POOL_SIZE
+        return slots - len(self.processing)
+
+    def dispatch(self):
+        """
+        Submits queued files until all worker slots are taken. Called whenever files are queued
+        and whenever a thumbnail completes, so a slot never stays idle while there is work.
+        """
+        with self.dispatch_lock:
+            if self.dispatching:
+                # called back from a thumbnail that completed immediately, the loop below goes on
+                return
+            self.dispatching = True
+            try:
+                while self.pool and not self.killed and self.get_free_slots() > 0:
+                    img = self.queue.pop()
+                    if img is None:
+                        return
+                    try:
+                        self.add_thumbnail(img)
+                    except Exception:
+                        logging.exception("Could not submit thumbnail for %s", img)
+            finally:
+                self.dispatching = False
 
     def start(self, ojo):
-        self.queue = []
+        self.queue.clear()
         self.processing = set()
         self.pool = None
         self.kill_event = multiprocessing.Manager().Event()
-        self.thumbs_event = threading.Event()
 
         def _thumbs_thread():
             # delay the start to give the caching thread some time to prepare next images
@@ -86,47 +366,15 @@ class Thumbs:
 
             self.init_pool()
 
-            cache_dir = self.get_thumbs_cache_dir(options["thumb_height"])
             try:
-                if not os.path.exists(cache_dir):
-                    os.makedirs(cache_dir)
+                self.get_store()
             except Exception:
-                logging.exception("Could not create cache dir %s" % cache_dir)
+                logging.exception("Could not open thumbnail store")
 
-            logging.info("Starting thumbs thread")
+            logging.info("%s: Thumbnail pool ready", self)
 
-            while True:
-                if self.killed:
-                    return
-                self.thumbs_event.wait(timeout=0.5)
-                self.thumbs_event.clear()
-                if self.killed:
-                    return
-
-                while self.queue:
-                    if self.killed:
-                        return
-
-                    if len(self.processing) >= POOL_SIZE:
-                        break
-
-                    # pause thumbnailing while the user is actively cycling images:
-                    while time.time() - self.ojo.last_action_time < 1 and self.ojo.mode == "image":
-                        if self.killed:
-                            return
-                        time.sleep(0.2)
-
-                    # make the cycle less tight
-                    time.sleep(0.05)
-
-                    try:
-                        img = self.queue.pop(0)
-                        self.add_thumbnail(img)
-                    except IndexError:
-                        # caused by queue being modified, ignore
-                        pass
-                    except Exception:
-                        logging.exception("Exception in thumbs thread:")
+            # from now on dispatching is driven by queueing and by completed thumbnails
+            self.dispatch()
 
         from ojo.ojo import OjoThread
 
@@ -134,117 +382,137 @@ class Thumbs:
         if not self.killed:
             self.thread.start()
 
-    def priority_thumbs(self, files):
+    def priority_thumbs(self, files, priority=thumbqueue.VISIBLE):
+        """Queues the files ahead of everything queued before, in the given order"""
         if self.killed:
             return
-        pq = set(files)
-        self.queue = files + [f for f in self.queue if f not in pq]
-        self.thumbs_event.set()
+        self.queue.prioritize(files, priority)
+        self.dispatch()
 
-    def enqueue(self, files):
+    def enqueue(self, files, priority=thumbqueue.OFFSCREEN):
         if self.killed:
             return
-        self.queue = self.queue + [f for f in files if f not in self.queue]
-        self.thumbs_event.set()
+        self.queue.enqueue(files, priority)
+        self.dispatch()
 
-    @staticmethod
-    def get_cached_thumbnail_path(filename, force_cache=False, thumb_height=None):
-        # Use gifs directly - webkit will handle transparency, animation, etc.
-        if not force_cache and ext(filename) == ".gif":
-            return filename
+    def load_manifest(self, folder, snapshot=None):
+        self.manifest = FolderManifest(folder, self.get_store(), snapshot)
+        return self.manifest
 
-        if thumb_height is None:
-            thumb_height = options["thumb_height"]
+    def get_manifest_entry(self, filename):
+        manifest = self.manifest
+        if manifest and manifest.store is self.get_store():
+            return manifest.get(filename)
+        return None
 
-        # we append modification time to ensure we're not using outdated cached images
-        mtime = os.path.getmtime(filename)
-        hash = hashlib.md5(_bytes(filename + "{0:.2f}".format(mtime))).hexdigest()
-        # we use .2 precision to keep the same behavior of getmtime as under Python 2
-        folder = os.path.dirname(filename)
-        if folder.startswith(os.sep):
-            folder = folder[1:]
-        return os.path.join(
-            Thumbs.get_thumbs_cache_dir(thumb_height),  # cache folder root
-            folder,  # mirror the original directory structure
-            os.path.basename(filename) + "_" + hash + ".jpg",
-        )  # filename + hash of the name & time
+    def has_thumbnail(self, filename):
+        # Use gifs directly - webkit will handle transparency, animation, etc.
+        if ext(filename) == ".gif":
+            return True
+        entry = self.get_manifest_entry(filename)
+        return entry.cached if entry else self.get_store().exists(filename)
+
+    def get_thumbnail_url(self, filename):
+        """Returns the URL of the cached thumbnail, or None if not yet cached"""
+        if ext(filename) == ".gif":
+            return path2url(filename)
+        store = self.get_store()
+        entry = self.get_manifest_entry(filename)
+        if entry:
+            return store.url(filename, entry.mtime) if entry.cached else None
+        return store.url(filename) if store.exists(filename) else None
 
     @staticmethod
-    def get_folder_thumbnail_path(folder):
+    def get_folder_thumbnail_url(folder):
+        """Returns the URL of the cached folder thumbnail, or None if not yet cached"""
         if not os.path.isdir(folder):
             raise Exception("Requested folder thumb for non-folder: " + folder)
 
         folder = os.path.abspath(folder)
-        mtime = os.path.getmtime(folder)
-        hash = hashlib.md5(_bytes(folder + "{0:.2f}".format(mtime))).hexdigest()
-
-        parent = os.path.dirname(folder)
-        if parent.startswith(os.sep):
-            parent = parent[1:]
-
-        return os.path.join(
-            Thumbs.get_folderthumbs_cache_dir(
-                options["thumb_height"]
-            ),  # folderthumbs cache folder root
-            parent,  # mirror the original directory structure
-            os.path.basename(folder) + "_" + hash + ".png",
-        )  # filename + hash of the name
-
-    def on_thumb_ready(self, img, thumb_path):
-        try:
-            self.processing.remove(img)
-        except:
-            logging.warning(f"on_thumb_ready: {img} was not present in the 'processing' set")
-        self.thumbs_event.set()
-        if thumb_path:
-            self.ojo.on_thumb_ready(img, thumb_path)
-
-    def on_thumb_failed(self, img, thumb_path):
-        self.processing.remove(img)
-        self.thumbs_event.set()
-        self.ojo.on_thumb_failed(img, thumb_path)
+        store = Thumbs.get_folder_store()
+        return store.url(folder) if store.exists(folder) else None
+
+    def on_thumb_ready(self, img, thumb_url):
+        with self.dispatch_lock:
+            try:
+                self.processing.remove(img)
+            except:
+                logging.warning(f"on_thumb_ready: {img} was not present in the 'processing' set")
+        self.dispatch()
+        if thumb_url:
+            if self.manifest:
+                self.manifest.update(img)
+            self.ojo.on_thumb_ready(img, thumb_url)
+
+    def on_thumb_failed(self, img, error_msg):
+        with self.dispatch_lock:
+            self.processing.discard(img)
+        self.dispatch()
+        self.ojo.on_thumb_failed(img, error_msg)
 
     def add_thumbnail(self, img):
         th = options["thumb_height"]
         self.prepare_thumbnail(img, 3 * th, th)
 
     def prepare_thumbnail(self, filename, width, height):
-        self.processing.add(filename)
-
         is_folder = os.path.isdir(filename)
-        cached = (
-            self.get_folder_thumbnail_path(filename)
-            if is_folder
-            else self.get_cached_thumbnail_path(filename)
-        )
+        if is_folder:
+            filename = os.path.abspath(filename)
+        self.processing.add(filename)
+        store = self.get_folder_store() if is_folder else self.get_store()
 
         def _thumbnail_ready(future):
-            filename, thumb_path = future.result()
+            try:
+                _, thumb_url, source = future.result()
+            except Exception:
+                # e.g. a crashed worker process
+                logging.exception("Thumbnail worker failed for %s", filename)
+                self.stats["failed"] += 1
+                self.on_thumb_failed(filename, "Could not create thumbnail")
+                return
+
+            self.stats[source] += 1
+            logging.debug("Thumbnail for %s: %s", filename, source)
 
-            if thumb_path is None:
+            if thumb_url is None and is_folder:
                 # valid situation for folder thumbs
                 self.on_thumb_ready(filename, None)
-            elif not os.path.isfile(thumb_path) or not os.path.getsize(thumb_path):
+            elif not thumb_url:
                 self.on_thumb_failed(filename, "Could not create thumbnail")
             else:
-                self.on_thumb_ready(filename, thumb_path)
+                self.on_thumb_ready(filename, thumb_url)
 
         if self.killed:
             return
 
-        future = self.pool.submit(_safe_thumbnail, filename, cached, width, height, self.kill_event)
+        future = self.pool.submit(
+            _safe_thumbnail,
+            filename,
+            store,
+            self.get_store(),
+            [] if is_folder else self.get_larger_stores(),
+            width,
+            height,
+            self.kill_event,
+        )
         future.add_done_callback(_thumbnail_ready)
 
     def clear_thumbnails(self, folder):
+        store = self.get_store()
         for img in imaging.list_images(folder):
             if self.killed:
                 return
 
-            cached = self.get_cached_thumbnail_path(img, True)
-            if os.path.isfile(cached) and cached.startswith(
-                self.get_thumbs_cache_dir(options["thumb_height"]) + os.sep
-            ):
-                try:
-                    os.unlink(cached)
-                except IOError:
-                    logging.exception("Could not delete %s" % cached)
+            entry = self.get_manifest_entry(img)
+            try:
+                store.remove(img, entry.mtime if entry else None)
+            except IOError:
+                logging.exception("Could not delete thumbnail for %s" % img)
+            if entry:
+                entry.cached = False
+
+    def clear_folder_thumbnail(self, folder):
+        try:
+            self.get_folder_store().remove(os.path.abspath(folder))
+        except IOError:
+            logging.exception("Could not delete folder thumbnail for %s" % folder)
@@ -0,0 +1,820 @@
+"""
+Storage backends for cached thumbnails.
+
+A thumbnail is identified by the path of its source and the source's modification time, exactly
+as in the original per-image JPEG cache, so a changed source never reuses a stale thumbnail.
+
+Two backends are available:
+
+* FileThumbStore - one file per thumbnail, mirroring the source directory structure
+  (the historical layout under ~/.config/ojo/cache/<height>/)
+* PackThumbStore - all thumbnails of a store appended to a single pack file, with a small
+  append-only index next to it. Reads go through mmap, removals append tombstones to the index
+  and the dead space is reclaimed by a compaction running in the background.
+
+Both backends expose the same interface and can be used from several threads and processes.
+
+Stores remember when each thumbnail was last used (in <cache_dir>/<name>.access), so
+collect_garbage can keep the cache under a size budget by evicting the least recently used
+thumbnails, after removing orphans whose source image is gone or has changed.
+"""
+
+import collections
+import contextlib
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+# URL scheme used for thumbnails that do not live in separate files (see webview.py)
+URL_SCHEME = "ojothumb"
+
+BACKENDS = ("pack", "files")
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_thumb_key(filename, mtime):
+    # we use .2 precision to keep the same behavior of getmtime as under Python 2
+    return hashlib.md5((filename + "{0:.2f}".format(mtime)).encode("utf8")).hexdigest()
+
+
+def open_store(backend, cache_dir, name, suffix=".jpg"):
+    """
+    Returns the (shared) store with the given name, opening it if needed
+    :param backend: "pack" or "files"
+    :param cache_dir: root folder of the thumbnail cache
+    :param name: name of the store, e.g. the thumbnail height
+    :param suffix: file extension used by the "files" backend
+    """
+    with _stores_lock:
+        store = _stores.get(name)
+        if store is None or store.backend != backend or store.cache_dir != cache_dir:
+            replaced = store
+            if backend == "files":
+                store = FileThumbStore(cache_dir, name, suffix)
+            elif backend == "pack":
+                store = PackThumbStore(cache_dir, name)
+            else:
+                raise ValueError("Unknown thumbnail store backend %s" % backend)
+            if replaced:
+                replaced.close()
+            _stores[name] = store
+        return store
+
+
+def store_exists(backend, cache_dir, name):
+    """Whether a store was ever created, without creating it"""
+    if backend == "pack":
+        return os.path.exists(os.path.join(cache_dir, name + ".pack"))
+    else:
+        return os.path.isdir(os.path.join(cache_dir, name))
+
+
+def find_store(name):
+    with _stores_lock:
+        return _stores.get(name)
+
+
+def list_stores(cache_dir):
+    """Returns (backend, name) of all stores found in the cache folder"""
+    try:
+        entries = list(os.scandir(cache_dir))
+    except FileNotFoundError:
+        return []
+    found = []
+    for entry in entries:
+        if entry.name.endswith(".pack") and entry.is_file():
+            found.append(("pack", entry.name[: -len(".pack")]))
+        elif entry.is_dir():
+            found.append(("files", entry.name))
+    return sorted(found)
+
+
+def save_all_access_times():
+    with _stores_lock:
+        stores = list(_stores.values())
+    for store in stores:
+        try:
+            store.save_access_times()
+        except Exception:
+            logging.exception("Could not save access times of thumbnail store %s", store.name)
+
+
+def is_orphan(key, source):
+    """Whether a thumbnail's source image is gone, or was modified after the thumbnail was made"""
+    try:
+        return get_thumb_key(source, os.path.getmtime(source)) != key
+    except OSError:
+        return True
+
+
+def collect_garbage(stores, max_bytes, kill_event=None, pause=0):
+    """
+    Removes orphaned thumbnails, then the least recently used ones until all stores together
+    take at most max_bytes.
+    :param kill_event: optional event, stops collecting when set
+    :param pause: seconds to sleep after every 100 checked thumbnails, to stay in the background
+    :return: (number of removed thumbnails, number of freed bytes)
+    """
+    removed_count = 0
+    freed_bytes = 0
+    candidates = []  # (last access, store, key, source, length) of live thumbnails
+    total_bytes = 0
+
+    for store in stores:
+        store.save_access_times()  # also picks up access times saved by other processes
+        orphans = []
+        for i, (key, source, _, length) in enumerate(store.entries()):
+            if i % 100 == 99:
+                if kill_event is not None and kill_event.is_set():
+                    return removed_count, freed_bytes
+                if pause:
+                    time.sleep(pause)
+            if is_orphan(key, source):
+                orphans.append((key, source))
+                freed_bytes += length
+            else:
+                candidates.append((store.get_access_time(key), store, key, source, length))
+                total_bytes += length
+        if orphans:
+            store.remove_keys(orphans)
+            removed_count += len(orphans)
+            logging.info("Thumbnail store %s: removed %d orphans", store.name, len(orphans))
+
+    candidates.sort(key=lambda c: c[0])
+    evicted = collections.defaultdict(list)
+    for _, store, key, source, length in candidates:
+        if total_bytes <= max_bytes:
+            break
+        evicted[store].append((key, source))
+        total_bytes -= length
+        freed_bytes += length
+    for store, keys in evicted.items():
+        if kill_event is not None and kill_event.is_set():
+            break
+        store.remove_keys(keys)
+        removed_count += len(keys)
+        logging.info("Thumbnail store %s: evicted %d least recently used", store.name, len(keys))
+
+    for store in stores:
+        if kill_event is not None and kill_event.is_set():
+            break
+        store.reclaim_space()
+        store.save_access_times(live_keys={entry[0] for entry in store.entries()})
+
+    return removed_count, freed_bytes
+
+
+def read_url(url):
+    """Returns the thumbnail data for a URL produced by PackThumbStore.url()"""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme != URL_SCHEME:
+        raise ValueError("Not a thumbnail URL: %s" % url)
+    store = find_store(parsed.netloc)
+    if not store:
+        raise KeyError("Unknown thumbnail store %s" % parsed.netloc)
+    data = store.read_key(parsed.path.lstrip("/"))
+    if data is None:
+        raise KeyError("Thumbnail not found: %s" % url)
+    return data
+
+
+def guess_mime_type(data):
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    elif data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    elif data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    else:
+        return "application/octet-stream"
+
+
+class ThumbStore:
+    backend = None
+
+    suffix = ".jpg"
+
+    ACCESS_RECORD = struct.Struct("<16sd")  # md5 digest of the key, last access time
+
+    def __init__(self, cache_dir, name):
+        self.cache_dir = cache_dir
+        self.name = name
+        self.access_path = os.path.join(cache_dir, name + ".access")
+        self.access_lock = threading.Lock()
+        self.access_times = None  # key -> last access time, loaded on first use
+        self.accessed = {}  # key -> last access time, not yet saved
+
+    def __reduce__(self):
+        # stores passed to other processes are reopened there
+        return open_store, (self.backend, self.cache_dir, self.name, self.suffix)
+
+    def get_key(self, filename, mtime=None):
+        if mtime is None:
+            mtime = os.path.getmtime(filename)
+        return get_thumb_key(filename, mtime)
+
+    def exists(self, filename, mtime=None):
+        raise NotImplementedError()
+
+    def cached_keys(self, folder):
+        """Returns the keys of all thumbnails cached for images in the folder"""
+        raise NotImplementedError()
+
+    def url(self, filename, mtime=None):
+        raise NotImplementedError()
+
+    def read(self, filename, mtime=None):
+        """Returns the thumbnail data, or None when not cached"""
+        raise NotImplementedError()
+
+    def write(self, filename, data, mtime=None):
+        raise NotImplementedError()
+
+    def remove(self, filename, mtime=None):
+        raise NotImplementedError()
+
+    def remove_keys(self, keys):
+        """Removes thumbnails given as a list of (key, source path)"""
+        raise NotImplementedError()
+
+    def entries(self):
+        """Returns a snapshot list of (key, source path, source mtime or None, length)"""
+        raise NotImplementedError()
+
+    def size(self):
+        """Returns (number of thumbnails, bytes taken on disk)"""
+        raise NotImplementedError()
+
+    def reclaim_space(self):
+        """Gives the space of removed thumbnails back to the file system"""
+        pass
+
+    def close(self):
+        """Releases the files held open, for stores not opened through open_store"""
+        pass
+
+    # Access tracking
+
+    def touch(self, key):
+        self.accessed[key] = time.time()
+
+    def _load_access_times(self):
+        times = {}
+        try:
+            with open(self.access_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return times
+        for digest, atime in self.ACCESS_RECORD.iter_unpack(
+            data[: len(data) - len(data) % self.ACCESS_RECORD.size]
+        ):
+            times[digest.hex()] = atime
+        return times
+
+    def get_access_time(self, key):
+        """Last time the thumbnail was used, 0 if unknown"""
+        atime = self.accessed.get(key)
+        if atime is not None:
+            return atime
+        with self.access_lock:
+            if self.access_times is None:
+                self.access_times = self._load_access_times()
+            return self.access_times.get(key, 0)
+
+    def save_access_times(self, live_keys=None):
+        """
+        Merges the access times recorded since the last save into the .access file
+        :param live_keys: if given, forget the access times of all other keys
+        """
+        with self.access_lock:
+            accessed, self.accessed = self.accessed, {}
+            if not accessed and live_keys is None:
+                return
+            # merge with what other processes saved in the meantime
+            times = self._load_access_times()
+            for key, atime in accessed.items():
+                if atime > times.get(key, 0):
+                    times[key] = atime
+            if live_keys is not None:
+                times = {k: t for k, t in times.items() if k in live_keys}
+            self.access_times = times
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=self.name + ".access.", dir=self.cache_dir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(
+                        b"".join(
+                            self.ACCESS_RECORD.pack(bytes.fromhex(k), t) for k, t in times.items()
+                        )
+                    )
+                os.replace(tmp_path, self.access_path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+
+class FileThumbStore(ThumbStore):
+    backend = "files"
+
+    def __init__(self, cache_dir, name, suffix=".jpg"):
+        super().__init__(cache_dir, name)
+        self.root = os.path.join(cache_dir, name)
+        self.suffix = suffix
+
+    def get_path(self, filename, mtime=None):
+        folder = os.path.dirname(filename)
+        if folder.startswith(os.sep):
+            folder = folder[1:]
+        return os.path.join(
+            self.root,  # cache folder root
+            folder,  # mirror the original directory structure
+            os.path.basename(filename) + "_" + self.get_key(filename, mtime) + self.suffix,
+        )  # filename + hash of the name & time
+
+    def exists(self, filename, mtime=None):
+        return os.path.exists(self.get_path(filename, mtime))
+
+    def cached_keys(self, folder):
+        if folder.startswith(os.sep):
+            folder = folder[1:]
+        try:
+            names = os.listdir(os.path.join(self.root, folder))
+        except FileNotFoundError:
+            return set()
+        # names are <image name>_<32 hex digits of key><suffix>
+        key_start = -32 - len(self.suffix)
+        return {
+            name[key_start : -len(self.suffix)]
+            for name in names
+            if name.endswith(self.suffix) and name[key_start - 1 : key_start] == "_"
+        }
+
+    def url(self, filename, mtime=None):
+        path = self.get_path(filename, mtime)
+        self.touch(path[-32 - len(self.suffix) : -len(self.suffix)])
+        return "file://" + urllib.request.pathname2url(path)
+
+    def read(self, filename, mtime=None):
+        try:
+            with open(self.get_path(filename, mtime), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, filename, data, mtime=None):
+        path = self.get_path(filename, mtime)
+        cache_dir = os.path.dirname(path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix="ojo_thumbnail_", dir=cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self.touch(self.get_key(filename, mtime))
+
+    def remove(self, filename, mtime=None):
+        path = self.get_path(filename, mtime)
+        if os.path.isfile(path) and path.startswith(self.root + os.sep):
+            os.unlink(path)
+
+    def remove_keys(self, keys):
+        folders = set()
+        for key, source in keys:
+            folder = os.path.dirname(source)
+            path = os.path.join(
+                self.root, folder.lstrip(os.sep), os.path.basename(source) + "_" + key + self.suffix
+            )
+            try:
+                os.unlink(path)
+                folders.add(os.path.dirname(path))
+            except FileNotFoundError:
+                pass
+        # don't leave the mirrored trees of deleted folders behind
+        for folder in sorted(folders, reverse=True):
+            while folder.startswith(self.root + os.sep):
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    break
+                folder = os.path.dirname(folder)
+
+    def _walk(self):
+        """Yields (key, source path, thumbnail size) for every thumbnail file"""
+        key_start = -32 - len(self.suffix)
+        stack = [self.root]
+        while stack:
+            folder = stack.pop()
+            try:
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(self.suffix) and entry.name[key_start - 1 : key_start] == "_":
+                    source = os.sep + os.path.join(
+                        os.path.relpath(folder, self.root), entry.name[: key_start - 1]
+                    )
+                    yield entry.name[key_start : -len(self.suffix)], os.path.normpath(
+                        source
+                    ), entry.stat(follow_symlinks=False).st_size
+
+    def entries(self):
+        return [(key, source, None, length) for key, source, length in self._walk()]
+
+    def size(self):
+        count = total = 0
+        for _, _, length in self._walk():
+            count += 1
+            total += length
+        return count, total
+
+
+class PackThumbStore(ThumbStore):
+    """
+    Thumbnails appended to <cache_dir>/<name>.pack, indexed by <cache_dir>/<name>.idx.
+
+    Every index record describes one write or removal:
+        md5 digest of the key, offset, length, source mtime, source path length, source path
+    A length of TOMBSTONE marks a removal. Records are only ever appended, so other processes
+    pick up new thumbnails by reading the tail of the index. Writers and compaction serialize
+    on an flock of <name>.lock; compaction replaces both files, which readers detect by the
+    changed inode of the pack file.
+    """
+
+    backend = "pack"
+
+    RECORD = struct.Struct("<16sQIdH")
+    TOMBSTONE = 0xFFFFFFFF
+
+    # compact when at least this many bytes are dead and they are at least half of the pack
+    COMPACT_MIN_GARBAGE = 16 * 1024 * 1024
+    COMPACT_GARBAGE_RATIO = 0.5
+
+    # how often (seconds) a lookup miss may re-read the index for writes from other processes
+    REFRESH_INTERVAL = 1
+
+    def __init__(self, cache_dir, name):
+        super().__init__(cache_dir, name)
+        self.pack_path = os.path.join(cache_dir, name + ".pack")
+        self.index_path = os.path.join(cache_dir, name + ".idx")
+        self.lock_path = os.path.join(cache_dir, name + ".lock")
+        self.lock = threading.RLock()
+        self.compacting = False
+        self.closed = False
+        self.pack_fd = None
+        self.index_fd = None
+        self.map = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self.lock, self._flock(fcntl.LOCK_SH):
+            self._reload()
+        self.maybe_compact()
+
+    # Locking & loading
+
+    @contextlib.contextmanager
+    def _flock(self, operation):
+        fcntl.flock(self.lock_fd, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def _close_files(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+        for fd in (self.pack_fd, self.index_fd):
+            if fd is not None:
+                os.close(fd)
+        self.pack_fd = self.index_fd = None
+
+    def _reload(self):
+        self._close_files()
+        self.pack_fd = os.open(self.pack_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.pack_ino = os.fstat(self.pack_fd).st_ino
+        self.index = {}  # key -> (offset, length, source path, source mtime)
+        self.by_folder = collections.defaultdict(set)  # source folder -> keys
+        self.index_pos = 0
+        self.live_bytes = 0
+        self.garbage_bytes = 0
+        self._read_index_tail()
+        self.last_refresh = time.time()
+
+    def _read_index_tail(self):
+        pack_size = os.fstat(self.pack_fd).st_size
+        os.lseek(self.index_fd, self.index_pos, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self.index_fd, 1024 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = b"".join(chunks)
+
+        pos = 0
+        header_size = self.RECORD.size
+        while pos + header_size <= len(data):
+            digest, offset, length, mtime, path_len = self.RECORD.unpack_from(data, pos)
+            if pos + header_size + path_len > len(data):
+                break  # incomplete record, a writer is still appending it
+            path = data[pos + header_size : pos + header_size + path_len].decode(
+                "utf8", "surrogateescape"
+            )
+            pos += header_size + path_len
+            self._apply_record(digest.hex(), offset, length, path, mtime, pack_size)
+        self.index_pos += pos
+
+    def _apply_record(self, key, offset, length, path, mtime, pack_size):
+        old = self.index.pop(key, None)
+        if old:
+            self.live_bytes -= old[1]
+            self.garbage_bytes += old[1]
+            self.by_folder[os.path.dirname(old[2])].discard(key)
+        if length == self.TOMBSTONE:
+            return
+        if offset + length > pack_size:
+            logging.warning("PackThumbStore %s: index points past end of pack, ignoring", self.name)
+            return
+        self.index[key] = (offset, length, path, mtime)
+        self.by_folder[os.path.dirname(path)].add(key)
+        self.live_bytes += length
+
+    def _refresh(self):
+        """Pick up writes and compactions done by other processes. Call with self.lock held."""
+        try:
+            changed = os.stat(self.pack_path).st_ino != self.pack_ino
+        except FileNotFoundError:
+            changed = True
+        if changed:
+            self._reload()
+        else:
+            self._read_index_tail()
+        self.last_refresh = time.time()
+
+    def _lookup(self, key):
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None and self._may_be_stale():
+                with self._flock(fcntl.LOCK_SH):
+                    self._refresh()
+                entry = self.index.get(key)
+            return entry
+
+    def _may_be_stale(self):
+        """
+        Whether other processes may have changed the store since the last refresh: records
+        appended to the index (as the thumbnail workers do) are seen at once, compactions
+        after REFRESH_INTERVAL. Call with self.lock held.
+        """
+        if time.time() - self.last_refresh > self.REFRESH_INTERVAL:
+            return True
+        try:
+            return os.fstat(self.index_fd).st_size > self.index_pos
+        except OSError:
+            return True
+
+    def _ensure_mapped(self, end):
+        if self.map is not None and len(self.map) >= end:
+            return
+        if self.map:
+            self.map.close()
+        self.map = mmap.mmap(self.pack_fd, 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def _write_all(fd, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+    def _append(self, key, data, path, mtime, tombstone=False):
+        """Call with self.lock and an exclusive flock held"""
+        offset = os.lseek(self.pack_fd, 0, os.SEEK_END)
+        if not tombstone:
+            self._write_all(self.pack_fd, data)
+        path_bytes = path.encode("utf8", "surrogateescape")
+        record = self.RECORD.pack(
+            bytes.fromhex(key),
+            offset,
+            self.TOMBSTONE if tombstone else len(data),
+            mtime,
+            len(path_bytes),
+        )
+        os.lseek(self.index_fd, 0, os.SEEK_END)
+        self._write_all(self.index_fd, record + path_bytes)
+        self._read_index_tail()
+
+    # Public interface
+
+    def url(self, filename, mtime=None):
+        key = self.get_key(filename, mtime)
+        self.touch(key)
+        return "%s://%s/%s" % (URL_SCHEME, self.name, key)
+
+    def exists(self, filename, mtime=None):
+        return self._lookup(self.get_key(filename, mtime)) is not None
+
+    def cached_keys(self, folder):
+        with self.lock:
+            if self._may_be_stale():
+                with self._flock(fcntl.LOCK_SH):
+                    self._refresh()
+            return set(self.by_folder.get(os.path.normpath(folder), ()))
+
+    def read(self, filename, mtime=None):
+        return self.read_key(self.get_key(filename, mtime))
+
+    def read_key(self, key):
+        with self.lock:
+            entry = self._lookup(key)
+            if entry is None:
+                return None
+            self.touch(key)
+            offset, length = entry[0], entry[1]
+            if not length:
+                return b""
+            self._ensure_mapped(offset + length)
+            return self.map[offset : offset + length]
+
+    def write(self, filename, data, mtime=None):
+        if mtime is None:
+            mtime = os.path.getmtime(filename)
+        key = self.get_key(filename, mtime)
+        with self.lock, self._flock(fcntl.LOCK_EX):
+            self._refresh()
+            self._append(key, data, filename, mtime)
+        self.touch(key)
+
+    def remove(self, filename, mtime=None):
+        if mtime is None:
+            mtime = os.path.getmtime(filename)
+        key = self.get_key(filename, mtime)
+        with self.lock, self._flock(fcntl.LOCK_EX):
+            self._refresh()
+            if key in self.index:
+                self._append(key, None, filename, mtime, tombstone=True)
+        self.maybe_compact()
+
+    def remove_keys(self, keys):
+        with self.lock, self._flock(fcntl.LOCK_EX):
+            self._refresh()
+            for key, source in keys:
+                if key in self.index:
+                    self._append(key, None, source, 0, tombstone=True)
+        self.maybe_compact()
+
+    def entries(self):
+        with self.lock:
+            return [(k, e[2], e[3], e[1]) for k, e in self.index.items()]
+
+    def size(self):
+        with self.lock:
+            return len(self.index), self.live_bytes + self.garbage_bytes
+
+    def reclaim_space(self):
+        if self.garbage_bytes:
+            self.compact()
+
+    # Compaction
+
+    def needs_compaction(self):
+        return (
+            self.garbage_bytes >= self.COMPACT_MIN_GARBAGE
+            and self.garbage_bytes >= self.COMPACT_GARBAGE_RATIO * (self.live_bytes + self.garbage_bytes)
+        )
+
+    def close(self):
+        """Closes the pack, index and lock files, after a running compaction is done"""
+        with self.lock:
+            self.closed = True
+            if self.compacting:
+                return  # the compaction closes the store when done
+            self._close_files()
+            if self.lock_fd is not None:
+                os.close(self.lock_fd)
+                self.lock_fd = None
+
+    def maybe_compact(self):
+        with self.lock:
+            if self.closed or self.compacting or not self.needs_compaction():
+                return
+            self.compacting = True
+
+        def _compact():
+            try:
+                self.compact()
+            except Exception:
+                logging.exception("PackThumbStore %s: compaction failed", self.name)
+            finally:
+                with self.lock:
+                    self.compacting = False
+                    if self.closed:
+                        self.close()
+
+        threading.Thread(target=_compact, name="ojo-compact-" + self.name, daemon=True).start()
+
+    def compact(self):
+        """
+        Rewrites the pack with only the live thumbnails. The bulk of the copying happens without
+        holding any locks - the pack is append-only, so the snapshotted entries can't change under us.
+        Only thumbnails written while copying are copied under the lock, just before the swap.
+        """
+        start = time.time()
+        with self.lock:
+            snapshot = dict(self.index)
+            old_size = self.live_bytes + self.garbage_bytes
+
+        fd, tmp_pack = tempfile.mkstemp(prefix=self.name + ".pack.", dir=self.cache_dir)
+        tmp_index = tmp_pack + ".idx"
+        try:
+            with os.fdopen(fd, "wb") as pack, open(tmp_index, "wb") as index, open(
+                self.pack_path, "rb"
+            ) as source:
+                source_map = None
+                if os.fstat(source.fileno()).st_size:
+                    source_map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+
+                def _copy(key, entry, source_map):
+                    offset, length, path, mtime = entry
+                    new_offset = pack.tell()
+                    pack.write(source_map[offset : offset + length])
+                    path_bytes = path.encode("utf8", "surrogateescape")
+                    index.write(
+                        self.RECORD.pack(bytes.fromhex(key), new_offset, length, mtime, len(path_bytes))
+                    )
+                    index.write(path_bytes)
+
+                try:
+                    for key, entry in snapshot.items():
+                        _copy(key, entry, source_map)
+
+                    with self.lock, self._flock(fcntl.LOCK_EX):
+                        self._refresh()
+                        if os.fstat(source.fileno()).st_ino != self.pack_ino:
+                            logging.info("PackThumbStore %s: compacted by another process", self.name)
+                            return
+                        # thumbnails written (or rewritten) while we were copying
+                        added = [(k, e) for k, e in self.index.items() if snapshot.get(k) != e]
+                        if added:
+                            self._ensure_mapped(max(e[0] + e[1] for k, e in added))
+                            for key, entry in added:
+                                _copy(key, entry, self.map)
+                        pack.flush()
+                        os.fsync(pack.fileno())
+                        index.flush()
+                        # thumbnails removed while we were copying were copied above as well,
+                        # drop them from the new index
+                        removed = set(snapshot) - set(self.index)
+                        if removed:
+                            self._drop_from_index_file(tmp_index, removed)
+                        os.replace(tmp_index, self.index_path)
+                        os.replace(tmp_pack, self.pack_path)
+                        self._reload()
+                        logging.info(
+                            "PackThumbStore %s: compacted %d to %d bytes in %.2fs",
+                            self.name,
+                            old_size,
+                            self.live_bytes,
+                            time.time() - start,
+                        )
+                finally:
+                    if source_map:
+                        source_map.close()
+        finally:
+            for path in (tmp_pack, tmp_index):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def _drop_from_index_file(self, index_path, keys):
+        with open(index_path, "rb") as f:
+            data = f.read()
+        out = []
+        pos = 0
+        header_size = self.RECORD.size
+        while pos + header_size <= len(data):
+            digest, _, _, _, path_len = self.RECORD.unpack_from(data, pos)
+            end = pos + header_size + path_len
+            if digest.hex() not in keys:
+                out.append(data[pos:end])
+            pos = end
+        with open(index_path, "wb") as f:
+            f.write(b"".join(out))
@@ -1,15 +1,28 @@
-from gi.repository import WebKit2, GObject
+from gi.repository import Gio, GLib, WebKit2
 
+import json
 import logging
-from ojo import util
-from ojo import ojoconfig
+import threading
+import time
+from collections import Counter
+from ojo import ojoconfig, thumbstore, util
+
+# Commands are sent to the page at most once per this many ms, all queued ones in one script
+FLUSH_INTERVAL = 16
+
+# browse.js posts its messages to window.webkit.messageHandlers.<MESSAGE_HANDLER>
+MESSAGE_HANDLER = "ojo"
 
 
 class WebView:
     def __init__(self):
         self.web_view = None
         self.is_loaded = False
-        self.js_queue = []
+        self.js_queue = []  # JS statements (str) and function calls ([name, args])
+        self.js_lock = threading.Lock()
+        self.flush_scheduled = False
+        self.on_action_fn = None
+        self.message_stats = Counter()
 
     def add_to(self, widget):
         if not self.web_view:
@@ -21,46 +34,85 @@ class WebView:
             self.web_view.grab_focus()
 
     def js(self, command=None, commands=None):
+        """Queues JS statements, they run with the next flush, in order. Safe from any thread."""
         all_commands = []
         if command:
             all_commands.append(command)
         if commands:
             all_commands += commands
+        self._enqueue(all_commands)
 
-        if self.is_loaded:
+    def call(self, function, *args):
+        """
+        Queues a call of the page's function with JSON-serializable args. Consecutive calls are
+        sent as one array and applied by browse.js in a single pass (apply_batch).
+        """
+        self._enqueue([[function, args]])
 
-            def _do_queue():
-                while self.js_queue:
-                    queued = self.js_queue.pop(0)
-                    self.web_view.run_javascript(queued, None, None, None)
-                for cmd in all_commands:
-                    self.web_view.run_javascript(cmd, None, None, None)
+    def _enqueue(self, commands):
+        with self.js_lock:
+            self.js_queue.extend(commands)
+            if self.flush_scheduled or not self.js_queue:
+                return
+            self.flush_scheduled = True
+        GLib.timeout_add(FLUSH_INTERVAL, self._flush)
 
-            GObject.idle_add(_do_queue)
-        else:
-            for cmd in all_commands:
-                logging.debug("Postponing js: " + cmd)
-                self.js_queue.append(cmd)
-            GObject.timeout_add(100, lambda: self.js())
+    def _flush(self):
+        if not self.is_loaded:
+            return True  # keep the commands until the page is loaded, try again later
+        with self.js_lock:
+            queue, self.js_queue = self.js_queue, []
+            self.flush_scheduled = False
+        if queue:
+            self.web_view.run_javascript(self.build_script(queue), None, None, None)
+        return False
 
-    def load(self, html_filename, on_load_fn=None, on_action_fn=None):
-        self.web_view = WebKit2.WebView()
-        self.web_view.set_can_focus(True)
+    @staticmethod
+    def build_script(queue):
+        """
+        :return: one script running the queued statements and calls in order, a failing
+        statement doesn't stop the ones after it
+        """
+        parts = []
+        calls = []
+        for command in queue:
+            if isinstance(command, str):
+                if calls:
+                    parts.append("apply_batch(%s);" % json.dumps(calls))
+                    calls = []
+                parts.append("try { %s; } catch (e) { console.error(e); }" % command)
+            else:
+                calls.append(command)
+        if calls:
+            parts.append("apply_batch(%s);" % json.dumps(calls))
+        return "\n".join(parts)
 
-        def nav(wv, dialog):
+    @staticmethod
+    def register_thumbs_scheme(context):
+        def _on_thumb_request(request):
             try:
-                command = dialog.get_message()
-                logging.debug("Received command: " + command)
-                if on_action_fn and command:
-                    command = command[command.index("|") + 1 :]
-                    index = command.index(":")
-                    action = command[:index]
-                    argument = command[index + 1 :]
-                    on_action_fn(action, argument)
-            finally:
-                return True
-
-        self.web_view.connect("script-dialog", nav)
+                data = thumbstore.read_url(request.get_uri())
+                stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(data))
+                request.finish(stream, len(data), thumbstore.guess_mime_type(data))
+            except Exception as e:
+                logging.warning("Could not load thumbnail %s: %s", request.get_uri(), e)
+                request.finish_error(
+                    GLib.Error.new_literal(
+                        Gio.io_error_quark(), str(e), Gio.IOErrorEnum.NOT_FOUND
+                    )
+                )
+
+        context.register_uri_scheme(thumbstore.URL_SCHEME, _on_thumb_request)
+        context.get_security_manager().register_uri_scheme_as_local(thumbstore.URL_SCHEME)
+
+    def load(self, html_filename, on_load_fn=None, on_action_fn=None):
+        self.on_action_fn = on_action_fn
+        manager = WebKit2.UserContentManager()
+        manager.register_script_message_handler(MESSAGE_HANDLER)
+        manager.connect("script-message-received::" + MESSAGE_HANDLER, self.on_script_message)
+        self.web_view = WebKit2.WebView.new_with_user_content_manager(manager)
+        self.register_thumbs_scheme(self.web_view.get_context())
+        self.web_view.set_can_focus(True)
 
         def _on_load(webview, event, *args):
             if event == WebKit2.LoadEvent.FINISHED:
@@ -73,3 +125,38 @@ class WebView:
 
         util.make_transparent(self.web_view)
         self.web_view.set_visible(True)
+
+    def on_script_message(self, manager, js_result):
+        """
+        Receives a batch of messages from browse.js, as JSON:
+        {"messages": [{"action": ..., "argument": ..., "time": ms since epoch}, ...],
+         "coalesced": number of messages dropped for a later one of the same action}
+        """
+        now = time.time() * 1000
+        try:
+            batch = json.loads(js_result.get_js_value().to_string())
+        except Exception:
+            logging.exception("Could not parse a message from the page")
+            return
+        stats = self.message_stats
+        stats["batches"] += 1
+        stats["coalesced"] += batch.get("coalesced", 0)
+        for message in batch["messages"]:
+            latency = max(0, now - message.get("time", now))
+            stats["messages"] += 1
+            stats["latency_ms_total"] += latency
+            stats["latency_ms_max"] = max(stats["latency_ms_max"], latency)
+            logging.debug("Received message: %s", message["action"])
+            if self.on_action_fn:
+                try:
+                    self.on_action_fn(message["action"], message["argument"])
+                except Exception:
+                    # the rest of the batch still gets handled
+                    logging.exception("Could not handle message %s", message["action"])
+
+    def get_message_stats(self):
+        """:return: counts of the messages received from the page and their latency"""
+        stats = dict(self.message_stats)
+        messages = stats.get("messages", 0)
+        stats["latency_ms_avg"] = stats.get("latency_ms_total", 0) / messages if messages else 0
+        return stats
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+"""
+Measures thumbnailing throughput of the "threads" and "processes" thumbs backends
+for a range of worker counts.
+
+Usage: thumbs_scaling.py <folder with images> [thumb height]
+
+Thumbnails are written to a temporary pack store, so every run is a cold one
+(the OS file cache of the source images is warmed up by the first run though).
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from ojo import config, imaging, thumbs, thumbstore
+
+
+def run(backend, workers, images, cache_dir, height):
+    store = thumbstore.open_store("pack", cache_dir, "%s_%d_%d" % (backend, workers, height))
+    kill_event = multiprocessing.Manager().Event()
+    if backend == "processes":
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=thumbs._init_process_worker,
+            initargs=(dict(config.options),),
+        )
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+    start = time.time()
+    futures = [
+        pool.submit(thumbs._safe_thumbnail, f, store, store, [], 3 * height, height, kill_event)
+        for f in images
+    ]
+    for future in futures:
+        future.result()
+    elapsed = time.time() - start
+    pool.shutdown(wait=True)
+    return elapsed
+
+
+def main():
+    folder = sys.argv[1]
+    height = int(sys.argv[2]) if len(sys.argv) > 2 else 180
+    config.load_options()
+    imaging.start_exiftool_process()
+    images = imaging.list_images(folder)
+    print("%d images in %s, thumb height %d" % (len(images), folder, height))
+
+    cpus = multiprocessing.cpu_count()
+    counts = sorted(c for c in {1, 2, 4, 8, cpus} if c <= cpus)
+    with tempfile.TemporaryDirectory(prefix="ojo_scaling_") as cache_dir:
+        for backend in thumbs.BACKENDS:
+            for workers in counts:
+                elapsed = run(backend, workers, images, cache_dir, height)
+                print(
+                    "%-10s %3d workers: %7.2fs, %7.1f images/s"
+                    % (backend, workers, elapsed, len(images) / elapsed)
+                )
+
+    imaging.stop_exiftool_process()
+
+
+if __name__ == "__main__":
+    main()
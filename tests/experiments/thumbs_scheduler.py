@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+"""
+Measures end-to-end throughput of the Thumbs scheduler: queueing, dispatching to the pool and
+completion callbacks, as when browsing a folder that has no cached thumbnails yet.
+
+Usage: thumbs_scheduler.py <folder with images> [thumb height]
+
+Thumbnails are written to a temporary cache folder, so every run is a cold one. Compare the
+output on the same folder before and after a scheduler change.
+"""
+
+import sys
+import tempfile
+import threading
+import time
+
+from ojo import config, imaging, thumbs
+
+
+class Host:
+    """The parts of Ojo that Thumbs talks to"""
+
+    def __init__(self, count):
+        self.mode = "folder"
+        self.last_action_time = 0
+        self.current_preparing = None
+        self.threads = []
+        self.remaining = count
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def _completed(self):
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.done.set()
+
+    def on_thumb_ready(self, img, thumb_url):
+        self._completed()
+
+    def on_thumb_failed(self, img, error_msg):
+        self._completed()
+
+
+def main():
+    folder = sys.argv[1]
+    height = int(sys.argv[2]) if len(sys.argv) > 2 else 180
+    config.load_options()
+    config.options["thumb_height"] = height
+    imaging.start_exiftool_process()
+    images = imaging.list_images(folder)
+    if not images:
+        sys.exit("No images in %s" % folder)
+    print(
+        "%d images in %s, thumb height %d, %s backend, %d workers"
+        % (len(images), folder, height, config.options["thumbs_backend"], thumbs.POOL_SIZE)
+    )
+
+    with tempfile.TemporaryDirectory(prefix="ojo_scheduler_") as cache_dir:
+        thumbs.Thumbs.get_cache_dir = staticmethod(lambda: cache_dir)
+        host = Host(len(images))
+        t = thumbs.Thumbs(ojo=host)
+        t.start(host)
+        t.thread.join()  # pool is ready
+
+        start = time.time()
+        t.priority_thumbs(images)
+        host.done.wait()
+        elapsed = time.time() - start
+        print("%.2fs, %.1f thumbnails/s" % (elapsed, len(images) / elapsed))
+        print("by source: %s" % dict(t.stats))
+        t.stop()
+
+    imaging.stop_exiftool_process()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import asyncio
+import os
+import shutil
+import unittest
+
+from ojo import asyncexiftool, exiftool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXECUTABLE = os.path.join(ROOT, "data", "ExifTool", "exiftool")
+IMAGES = os.path.join(ROOT, "data", "ExifTool", "t", "images")
+
+
+@unittest.skipUnless(shutil.which("perl"), "perl is needed to run the bundled exiftool")
+class TestAsyncExifTool(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.exiftool = asyncexiftool.AsyncExifTool(EXECUTABLE, timeout=30)
+        self.run_async(self.exiftool.start())
+
+    def tearDown(self):
+        self.run_async(self.exiftool.terminate())
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_concurrent_requests(self):
+        files = [os.path.join(IMAGES, name) for name in ("Canon.jpg", "Nikon.jpg", "Sony.jpg")]
+
+        async def _all():
+            return await asyncio.gather(*[self.exiftool.get_metadata(f) for f in files])
+
+        results = self.run_async(_all())
+        self.assertEqual(files, [r["SourceFile"] for r in results])
+        batch = self.run_async(self.exiftool.get_tags_batch(["Orientation#"], files[:2]))
+        self.assertEqual(1, batch[0]["Orientation"]["val"])
+
+    def test_extract_previews(self):
+        filename = os.path.join(IMAGES, "ExifTool.jpg")
+        previews = self.run_async(self.exiftool.extract_previews(filename))
+        self.assertEqual(["ThumbnailImage", "PreviewImage"], list(previews))
+        self.assertEqual(1558, len(previews["ThumbnailImage"]))
+        self.assertEqual(5777, len(previews["PreviewImage"]))
+
+    def test_cancellation(self):
+        filename = os.path.join(IMAGES, "Canon.jpg")
+
+        async def _cancel_one():
+            cancelled = asyncio.ensure_future(self.exiftool.get_metadata(filename))
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await cancelled
+            # the response of the cancelled request must not be taken for this one's
+            return await self.exiftool.execute("-ver")
+
+        version = self.run_async(_cancel_one())
+        self.assertRegex(version, r"^\d+\.\d+$")
+        self.assertFalse(self.exiftool.pending)
+
+    def test_dead_process(self):
+        self.exiftool.process.kill()
+        with self.assertRaises((exiftool.ExifToolError, ValueError)):
+            self.run_async(self.exiftool.execute("-ver"))
+        self.assertFalse(self.exiftool.running)
+
+
+if __name__ == "__main__":
+    unittest.main()
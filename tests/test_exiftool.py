@@ -0,0 +1,150 @@
+import json
+import os
+import shutil
+import threading
+import time
+import unittest
+
+from ojo import exiftool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXECUTABLE = os.path.join(ROOT, "data", "ExifTool", "exiftool")
+IMAGES = os.path.join(ROOT, "data", "ExifTool", "t", "images")
+
+
+@unittest.skipUnless(shutil.which("perl"), "perl is needed to run the bundled exiftool")
+class TestExifToolPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = exiftool.ExifToolPool(EXECUTABLE, size=2, timeout=30).start()
+
+    def tearDown(self):
+        self.pool.terminate()
+
+    def test_get_tags_batch(self):
+        files = [os.path.join(IMAGES, name) for name in ("Canon.jpg", "Nikon.jpg")]
+        result = self.pool.get_tags_batch(["ImageWidth", "Orientation#"], files)
+        self.assertEqual(files, [r["SourceFile"] for r in result])
+        self.assertEqual(1, result[0]["Orientation"]["val"])
+
+    def test_concurrent_requests(self):
+        results = []
+
+        def _request():
+            results.append(self.pool.execute("-ver"))
+
+        threads = [threading.Thread(target=_request) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(8, len(results))
+        self.assertEqual(1, len(set(results)))
+        stats = self.pool.get_stats()
+        self.assertEqual(8, stats["requests"])
+        self.assertEqual(0, stats["in_flight"])
+
+    def test_restarts_crashed_process(self):
+        instances = list(self.pool.instances)
+        for instance in instances:
+            instance._process.kill()
+        deadline = time.time() + 5
+        while any(instance.running for instance in instances) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(self.pool.execute("-ver"))
+        self.assertTrue(self.pool.execute("-ver"))
+        self.assertEqual(2, self.pool.get_stats()["restarts"])
+        self.assertEqual(2, len(self.pool.instances))
+
+    def test_timeout(self):
+        self.pool.terminate()
+        self.pool = exiftool.ExifToolPool(EXECUTABLE, size=1, timeout=0.0001).start()
+        with self.assertRaises(exiftool.ExifToolTimeout):
+            self.pool.get_metadata(os.path.join(IMAGES, "CanonRaw.cr2"))
+        self.assertEqual(1, self.pool.get_stats()["timeouts"])
+
+
+@unittest.skipUnless(shutil.which("perl"), "perl is needed to run the bundled exiftool")
+class TestPipelining(unittest.TestCase):
+    def setUp(self):
+        self.et = exiftool.ExifTool(EXECUTABLE, timeout=30).start()
+
+    def tearDown(self):
+        self.et.terminate()
+
+    def test_concurrent_requests_in_one_process(self):
+        files = sorted(
+            os.path.join(IMAGES, name) for name in os.listdir(IMAGES) if name.endswith(".jpg")
+        )
+        results = {}
+
+        def _request(f):
+            results[f] = self.et.get_tags(["ImageWidth"], f)["SourceFile"]
+
+        threads = [threading.Thread(target=_request, args=(f,)) for f in files]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual({f: f for f in files}, results)
+
+    def test_binary_output(self):
+        jpg = os.path.join(IMAGES, "ExifTool.jpg")
+        data = self.et.get_binary_tag("ThumbnailImage", jpg)
+        self.assertEqual(1558, len(data))
+        self.assertTrue(data.startswith(b"\xff\xd8"))
+        # the next responses are not affected by the newline after the sentinel
+        png = os.path.join(IMAGES, "PNG.png")
+        self.assertEqual(b"", self.et.get_binary_tag("ThumbnailImage", png))
+        self.assertEqual(data, self.et.get_binary_tag("ThumbnailImage", jpg))
+
+    def test_large_batch(self):
+        files = sorted(
+            os.path.join(IMAGES, name) for name in os.listdir(IMAGES) if name.endswith(".jpg")
+        )
+        result = self.et.get_metadata_batch(files * 5)
+        self.assertEqual(files * 5, [r["SourceFile"] for r in result])
+
+    def test_iter_json(self):
+        files = sorted(
+            os.path.join(IMAGES, name) for name in os.listdir(IMAGES) if name.endswith(".jpg")
+        )
+        streamed = list(self.et.iter_tags_batch(["ImageWidth", "Orientation#"], files * 3))
+        self.assertEqual(self.et.get_tags_batch(["ImageWidth", "Orientation#"], files * 3), streamed)
+        # stopping early doesn't disturb the next request
+        items = self.et.iter_json(*files)
+        self.assertEqual(files[0], next(items)["SourceFile"])
+        items.close()
+        self.assertEqual(files[:2], [r["SourceFile"] for r in self.et.get_metadata_batch(files[:2])])
+
+
+class TestJsonArrayDecoder(unittest.TestCase):
+    def test_split_anywhere(self):
+        items = [
+            {"SourceFile": "/a/{b}.jpg", "Comment": {"val": 'quote " and \\ backslash ]}'}},
+            {"SourceFile": "/c.jpg", "List": [1, [2, {"x": "}"}]], "Empty": {}},
+            {"SourceFile": "/été.jpg"},
+        ]
+        data = json.dumps(items, indent=2, ensure_ascii=False).encode("utf-8")
+        for size in (1, 2, 3, 7, 64, len(data)):
+            decoder = exiftool.JsonArrayDecoder()
+            decoded = []
+            for i in range(0, len(data), size):
+                decoded.extend(decoder.feed(data[i : i + size]))
+            self.assertEqual(items, decoded, "chunk size %d" % size)
+
+    def test_objects_come_as_soon_as_closed(self):
+        decoder = exiftool.JsonArrayDecoder()
+        self.assertEqual([{"a": 1}], decoder.feed(b'[{"a": 1}, {"b"'))
+        self.assertEqual([], decoder.feed(b': {"c": 2}'))
+        self.assertEqual([{"b": {"c": 2}}], decoder.feed(b"}, "))
+        self.assertEqual([], decoder.feed(b"]"))
+
+    def test_response_buffer_partial(self):
+        buf = exiftool.ResponseBuffer()
+        token = exiftool.sentinel % 12
+        buf.feed(b"[{}, {}]{rea")
+        partial = buf.pop_partial(token)
+        self.assertEqual(None, buf.pop(token))
+        buf.feed(b"dy12}\nnext")
+        self.assertEqual(b"[{}, {}]", partial + buf.pop(token))
+        self.assertEqual(b"next", bytes(buf.buf))
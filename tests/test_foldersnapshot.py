@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+
+from ojo.foldersnapshot import FolderSnapshot
+
+
+class TestFolderSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.folder = self.dir.name
+        for name, size, mtime in (("a.jpg", 10, 1000), ("b.PNG", 30, 3000), ("c.txt", 5, 5000)):
+            path = os.path.join(self.folder, name)
+            with open(path, "wb") as f:
+                f.write(b"x" * size)
+            os.utime(path, (mtime, mtime))
+        os.mkdir(os.path.join(self.folder, "sub"))
+        os.mkdir(os.path.join(self.folder, "folder.jpg"))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def test_listing(self):
+        snapshot = FolderSnapshot(self.folder, {".jpg", ".png"})
+        self.assertEqual({self.path("a.jpg"), self.path("b.PNG")}, set(snapshot.list_images()))
+        self.assertEqual({self.path("sub"), self.path("folder.jpg")}, set(snapshot.list_folders()))
+
+    def test_stats(self):
+        snapshot = FolderSnapshot(self.folder, {".jpg", ".png"})
+        self.assertEqual(30, snapshot.get_size(self.path("b.PNG")))
+        self.assertEqual(1000, snapshot.get_mtime(self.path("a.jpg")))
+        self.assertEqual(40, snapshot.total_size())
+        self.assertEqual(10, snapshot.total_size([self.path("a.jpg")]))
+        self.assertEqual(3000, snapshot.latest_mtime())
+        self.assertIsNone(snapshot.latest_mtime([]))
+        # files outside of the snapshot are stat-ed directly
+        self.assertEqual(5, snapshot.get_size(self.path("c.txt")))
+
+    def test_stat_is_taken_once(self):
+        snapshot = FolderSnapshot(self.folder, {".jpg"})
+        self.assertEqual(10, snapshot.get_size(self.path("a.jpg")))
+        with open(self.path("a.jpg"), "ab") as f:
+            f.write(b"more")
+        self.assertEqual(10, snapshot.get_size(self.path("a.jpg")))
+        self.assertEqual(14, FolderSnapshot(self.folder, {".jpg"}).get_size(self.path("a.jpg")))
+
+    def test_add_and_remove(self):
+        snapshot = FolderSnapshot(self.folder, {".jpg", ".png"})
+        path = self.path("d.jpg")
+        with open(path, "wb") as f:
+            f.write(b"x" * 7)
+        snapshot.add_image(path)
+        snapshot.remove_image(self.path("a.jpg"))
+        self.assertEqual({path, self.path("b.PNG")}, set(snapshot.list_images()))
+        self.assertEqual(37, snapshot.total_size())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+from collections import namedtuple
+
+from ojo import folderwatcher
+from ojo.folderwatcher import FolderWatcher
+
+# stand-ins for Gio.File and Gio.FileMonitorEvent, on_changed only uses these
+File = namedtuple("File", ["path"])
+File.get_path = lambda self: self.path
+Event = namedtuple("Event", ["value_nick"])
+
+FOLDER = "/photos"
+
+
+class TestFolderWatcher(unittest.TestCase):
+    def setUp(self):
+        self.deltas = []
+        self.watcher = FolderWatcher(lambda *delta: self.deltas.append(delta))
+        self.watcher.folder = FOLDER
+        self.watcher.monitor = self.monitor = object()
+        # a flush is pending, events are only collected until the test flushes
+        self.watcher.timeout_id = 1
+
+    def event(self, nick, name, other_name=None):
+        other = File(FOLDER + "/" + other_name) if other_name else None
+        self.watcher.on_changed(self.monitor, File(FOLDER + "/" + name), other, Event(nick))
+
+    def flush(self):
+        self.watcher._flush()
+        self.assertIsNone(self.watcher.timeout_id)
+        (folder, added, removed, changed), = self.deltas
+        self.assertEqual(FOLDER, folder)
+        return added, removed, changed
+
+    def test_new_file_is_added_when_written(self):
+        self.event(folderwatcher.CREATED, "a.jpg")
+        self.assertEqual(set(), self.watcher.added)
+        self.event(folderwatcher.CHANGES_DONE_HINT, "a.jpg")
+        self.event(folderwatcher.CHANGES_DONE_HINT, "b.jpg")
+        self.assertEqual(({FOLDER + "/a.jpg"}, set(), {FOLDER + "/b.jpg"}), self.flush())
+
+    def test_file_that_comes_and_goes(self):
+        self.event(folderwatcher.MOVED_IN, "a.jpg")
+        self.event(folderwatcher.DELETED, "a.jpg")
+        self.event(folderwatcher.CREATED, "b.jpg")
+        self.event(folderwatcher.DELETED, "b.jpg")
+        self.event(folderwatcher.MOVED_OUT, "c.jpg")
+        self.assertEqual((set(), {FOLDER + "/c.jpg"}, set()), self.flush())
+
+    def test_rename(self):
+        self.event(folderwatcher.RENAMED, "a.jpg", "b.jpg")
+        self.watcher.on_changed(
+            self.monitor, File(FOLDER + "/c.jpg"), File("/elsewhere/c.jpg"), Event("renamed")
+        )
+        self.assertEqual(
+            ({FOLDER + "/b.jpg"}, {FOLDER + "/a.jpg", FOLDER + "/c.jpg"}, set()), self.flush()
+        )
+
+    def test_events_of_an_old_monitor_are_ignored(self):
+        self.watcher.on_changed(object(), File(FOLDER + "/a.jpg"), None, Event("moved-in"))
+        self.assertEqual((set(), set(), set()), self.flush())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from ojo.imageheader import ImageHeader, is_supported, read_header
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = os.path.join(ROOT, "data", "ExifTool", "t", "images")
+
+
+class TestImageHeader(unittest.TestCase):
+    def read(self, name):
+        return read_header(os.path.join(IMAGES, name))
+
+    def test_jpeg(self):
+        self.assertEqual(ImageHeader("jpeg", 120, 80, 1, "2002:07:13 15:58:28"), self.read("GPS.jpg"))
+        self.assertEqual(6, self.read("MWG.jpg").orientation)
+        self.assertEqual(8, self.read("Pentax.jpg").orientation)
+        self.assertEqual(ImageHeader("jpeg", 8, 8, None, None), self.read("IPTC.jpg"))
+
+    def test_png_and_webp(self):
+        self.assertEqual(ImageHeader("png", 16, 16, None, None), self.read("PNG.png"))
+        self.assertEqual(ImageHeader("webp", 1, 1, None, None), self.read("RIFF.webp"))
+
+    def test_tiff_and_raw(self):
+        self.assertEqual((160, 120), self.read("ExifTool.tif")[1:3])
+        # the biggest IFD is the image, the others are previews
+        self.assertEqual(
+            ImageHeader("tiff", 3040, 2014, 1, "2004:06:09 16:02:35"), self.read("Nikon.nef")
+        )
+        self.assertEqual(
+            ImageHeader("tiff", 3516, 2328, 1, "2005:08:03 18:59:18"), self.read("DNG.dng")
+        )
+        self.assertEqual((1536, 1024), self.read("CanonRaw.cr2")[1:3])
+
+    def test_unsupported_and_malformed(self):
+        self.assertFalse(is_supported("a.svg"))
+        self.assertTrue(is_supported("a.NEF"))
+        self.assertIsNone(read_header("/nonexistent/a.jpg"))
+        with tempfile.TemporaryDirectory() as d:
+            truncated = os.path.join(d, "truncated.jpg")
+            with open(truncated, "wb") as f:
+                f.write(b"\xff\xd8\xff\xe1" + struct.pack(">H", 1000) + b"Exif\x00\x00II*\x00")
+            self.assertIsNone(read_header(truncated))
+
+            looping = os.path.join(d, "looping.tif")
+            with open(looping, "wb") as f:
+                # one IFD with no entries whose next IFD is itself
+                f.write(b"II*\x00" + struct.pack("<LHL", 8, 0, 8))
+            self.assertIsNone(read_header(looping))
+
+
+if __name__ == "__main__":
+    unittest.main()
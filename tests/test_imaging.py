@@ -0,0 +1,65 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from ojo import imaging
+from ojo.metarecord import MetaRecord, pack_tags
+
+
+def jpeg_bytes(width, height):
+    data = io.BytesIO()
+    Image.new("RGB", (width, height)).save(data, "JPEG")
+    return data.getvalue()
+
+
+class TestEmbeddedPil(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, "a.jpg")
+        with open(self.filename, "wb") as f:
+            f.write(jpeg_bytes(1200, 800))
+        self.thumbnail = jpeg_bytes(240, 160)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def record(self, exif):
+        return MetaRecord(
+            filename="a.jpg",
+            needs_rotation=False,
+            width=1200,
+            height=800,
+            orientation=None,
+            file_date=0,
+            file_size=0,
+            tags=pack_tags(exif),
+        )
+
+    def test_camera_jpeg_takes_fast_path_after_header_read(self):
+        header = self.record({})
+        full = self.record(
+            {"ThumbnailImage": {"val": "(Binary data %d bytes)" % len(self.thumbnail)}}
+        )
+        meta = mock.Mock()
+        meta.get_basic.return_value = header
+        meta.is_provisional.return_value = True
+        meta.get.return_value = full
+        pool = mock.Mock()
+        pool.get_binary_tag.return_value = self.thumbnail
+
+        with mock.patch.object(imaging, "metadata", meta), mock.patch.object(
+            imaging, "exiftool", pool
+        ):
+            pil_image = imaging.get_embedded_pil(self.filename, 200, 200)
+
+        self.assertEqual((240, 160), pil_image.size)
+        meta.get.assert_called_once_with(self.filename)
+        pool.get_binary_tag.assert_called_once_with("ThumbnailImage", self.filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
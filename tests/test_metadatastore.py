@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+
+from ojo.metadatastore import MetadataStore
+
+
+class TestMetadataStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "cache", "metadata.sqlite")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_put_get(self):
+        store = MetadataStore(self.path)
+        self.assertIsNone(store.get("/a/b.jpg"))
+        meta = {"width": 10, "height": 20, "exif": {"Model": {"val": "X"}}}
+        store.put_many([("/a/b.jpg", 100, 123456789, meta)])
+        self.assertEqual((100, 123456789, meta), store.get("/a/b.jpg"))
+
+        store.put_many([("/a/b.jpg", 200, 1, {"width": 1})])
+        self.assertEqual((200, 1, {"width": 1}), store.get("/a/b.jpg"))
+        store.close()
+
+    def test_load_folder_and_remove(self):
+        store = MetadataStore(self.path)
+        store.put_many(
+            [
+                ("/a/1.jpg", 1, 1, {"n": 1}),
+                ("/a/2.jpg", 2, 2, {"n": 2}),
+                ("/a/b/3.jpg", 3, 3, {"n": 3}),
+            ]
+        )
+        self.assertEqual(
+            {"/a/1.jpg": (1, 1, {"n": 1}), "/a/2.jpg": (2, 2, {"n": 2})}, store.load_folder("/a/")
+        )
+        store.remove_many(["/a/1.jpg"])
+        self.assertEqual(["/a/2.jpg"], list(store.load_folder("/a")))
+        store.close()
+
+        # persisted across instances
+        reopened = MetadataStore(self.path)
+        self.assertEqual((3, 3, {"n": 3}), reopened.get("/a/b/3.jpg"))
+        reopened.close()
@@ -0,0 +1,56 @@
+import unittest
+
+from ojo.metarecord import MetaRecord, pack_tags
+
+
+class TestMetaRecord(unittest.TestCase):
+    def setUp(self):
+        self.exif = {
+            "SourceFile": {"desc": "Source File", "val": "/a/b.jpg"},
+            "ImageWidth": {"desc": "Image Width", "val": 6000},
+            "ImageHeight": {"desc": "Image Height", "val": 4000},
+            "Orientation": {"desc": "Orientation", "val": 6},
+            "ISO": {"desc": "ISO", "val": 100},
+            "MakerNoteUnknown": {"desc": "Unknown", "val": "dropped"},
+        }
+        self.record = MetaRecord(
+            filename="b.jpg",
+            needs_rotation=True,
+            width=4000,
+            height=6000,
+            orientation=6,
+            file_date=1.5,
+            file_size=123,
+            tags=pack_tags(self.exif),
+        )
+
+    def test_dict_access(self):
+        self.assertEqual(4000, self.record["width"])
+        self.assertEqual(6, self.record.get("orientation"))
+        self.assertIsNone(self.record.get("missing"))
+        with self.assertRaises(KeyError):
+            self.record["missing"]
+        self.assertEqual(100, self.record.get_tag("ISO"))
+        self.assertIsNone(self.record.get_tag("Model"))
+        self.assertFalse(hasattr(self.record, "__dict__"))
+
+    def test_exif_keeps_only_fast_tags(self):
+        exif = self.record["exif"]
+        self.assertEqual({"desc": "Image Width", "val": 6000}, exif["ImageWidth"])
+        self.assertEqual(["ImageWidth", "ImageHeight", "Orientation", "ISO"], list(exif))
+
+    def test_dict_round_trip(self):
+        d = self.record.to_dict()
+        copy = MetaRecord.from_dict(d)
+        self.assertEqual(d, copy.to_dict())
+        self.assertEqual(self.record.tags, copy.tags)
+
+    def test_no_tags(self):
+        record = MetaRecord.from_dict({"filename": "x.svg", "width": 10, "height": 20})
+        self.assertIsNone(record.tags)
+        self.assertEqual({}, record.exif)
+        self.assertIsNone(record.get_tag("ISO"))
+
+
+if __name__ == "__main__":
+    unittest.main()
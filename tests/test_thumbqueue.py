@@ -0,0 +1,60 @@
+import unittest
+
+from ojo import thumbqueue
+from ojo.thumbqueue import FOLDER, NEAR, OFFSCREEN, VISIBLE
+
+
+def drain(queue):
+    files = []
+    while True:
+        f = queue.pop()
+        if f is None:
+            return files
+        files.append(f)
+
+
+class TestThumbQueue(unittest.TestCase):
+    def test_enqueue_keeps_order_and_deduplicates(self):
+        queue = thumbqueue.ThumbQueue()
+        queue.enqueue(["a", "b", "c"])
+        queue.enqueue(["b", "d"])
+        self.assertEqual(4, len(queue))
+        self.assertEqual(["a", "b", "c", "d"], drain(queue))
+        self.assertEqual(0, len(queue))
+
+    def test_prioritize_moves_to_front(self):
+        queue = thumbqueue.ThumbQueue()
+        queue.enqueue(["a", "b", "c", "d"])
+        queue.prioritize(["c", "d"], OFFSCREEN)
+        queue.prioritize(["b"], OFFSCREEN)
+        self.assertEqual(["b", "c", "d", "a"], drain(queue))
+
+    def test_classes(self):
+        queue = thumbqueue.ThumbQueue()
+        queue.enqueue(["folder"], FOLDER)
+        queue.enqueue(["far"])
+        queue.prioritize(["near"], NEAR)
+        queue.prioritize(["visible", "near"], VISIBLE)
+        queue.enqueue(["visible"], OFFSCREEN)  # already queued, keeps its place
+        self.assertEqual(["visible", "near", "far", "folder"], drain(queue))
+
+    def test_remove_and_clear(self):
+        queue = thumbqueue.ThumbQueue()
+        queue.enqueue(["a", "b", "c"])
+        queue.remove("b")
+        queue.remove("x")
+        self.assertNotIn("b", queue)
+        self.assertIn("c", queue)
+        self.assertEqual(["a", "c"], drain(queue))
+        queue.enqueue(["a"])
+        queue.clear()
+        self.assertIsNone(queue.pop())
+
+    def test_large_folder(self):
+        queue = thumbqueue.ThumbQueue()
+        files = ["%05d.jpg" % i for i in range(20000)]
+        queue.enqueue(files)
+        for start in range(0, 20000, 50):
+            queue.prioritize(files[start : start + 50])
+        self.assertEqual(files[-50:], [queue.pop() for _ in range(50)])
+        self.assertEqual(19950, len(queue))
@@ -0,0 +1,200 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+from ojo import thumbstore
+
+
+class TestPackThumbStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.dir.name, "cache")
+        self.source = os.path.join(self.dir.name, "a.jpg")
+        with open(self.source, "wb") as f:
+            f.write(b"source")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_write_read_remove(self):
+        store = thumbstore.PackThumbStore(self.cache_dir, "180")
+        self.assertFalse(store.exists(self.source))
+        self.assertIsNone(store.read(self.source))
+
+        store.write(self.source, b"thumb")
+        self.assertTrue(store.exists(self.source))
+        self.assertEqual(b"thumb", store.read(self.source))
+
+        store.remove(self.source)
+        self.assertFalse(store.exists(self.source))
+        self.assertEqual(5, store.garbage_bytes)
+
+    def test_cached_keys(self):
+        store = thumbstore.PackThumbStore(self.cache_dir, "180")
+        store.write(self.source, b"thumb")
+        self.assertEqual({store.get_key(self.source)}, store.cached_keys(self.dir.name))
+        store.remove(self.source)
+        self.assertEqual(set(), store.cached_keys(self.dir.name))
+
+    def test_changed_mtime_is_a_different_thumbnail(self):
+        store = thumbstore.PackThumbStore(self.cache_dir, "180")
+        store.write(self.source, b"thumb")
+        os.utime(self.source, (1000, 1000))
+        self.assertFalse(store.exists(self.source))
+
+    def test_reopen_and_url(self):
+        store = thumbstore.PackThumbStore(self.cache_dir, "180")
+        store.write(self.source, b"thumb")
+        store.write(self.source, b"thumb2")
+
+        reopened = thumbstore.PackThumbStore(self.cache_dir, "180")
+        self.assertEqual(b"thumb2", reopened.read(self.source))
+        self.assertEqual(5, reopened.garbage_bytes)
+
+        url = store.url(self.source)
+        self.assertTrue(url.startswith(thumbstore.URL_SCHEME + "://180/"))
+        key = url[url.rfind("/") + 1 :]
+        self.assertEqual(b"thumb2", reopened.read_key(key))
+
+    def test_sees_writes_from_other_instances(self):
+        reader = thumbstore.PackThumbStore(self.cache_dir, "180")
+        writer = thumbstore.PackThumbStore(self.cache_dir, "180")
+        self.assertFalse(reader.exists(self.source))
+        writer.write(self.source, b"thumb")
+        reader.last_refresh = 0
+        self.assertEqual(b"thumb", reader.read(self.source))
+
+    def test_sees_appended_writes_at_once(self):
+        reader = thumbstore.PackThumbStore(self.cache_dir, "180")
+        writer = thumbstore.PackThumbStore(self.cache_dir, "180")
+        self.assertFalse(reader.exists(self.source))
+        writer.write(self.source, b"thumb")
+        # within REFRESH_INTERVAL of the last refresh
+        self.assertTrue(reader.exists(self.source))
+        self.assertEqual(b"thumb", reader.read(self.source))
+
+    def test_close(self):
+        store = thumbstore.PackThumbStore(self.cache_dir, "180")
+        store.write(self.source, b"thumb")
+        store.read(self.source)
+        store.close()
+        self.assertIsNone(store.map)
+        self.assertIsNone(store.pack_fd)
+        self.assertIsNone(store.lock_fd)
+
+    def test_compact(self):
+        store = thumbstore.PackThumbStore(self.cache_dir, "180")
+        other = os.path.join(self.dir.name, "b.jpg")
+        with open(other, "wb") as f:
+            f.write(b"source")
+        store.write(self.source, b"x" * 1000)
+        store.write(other, b"y" * 10)
+        store.remove(self.source)
+
+        reader = thumbstore.PackThumbStore(self.cache_dir, "180")
+        store.compact()
+        self.assertEqual(0, store.garbage_bytes)
+        self.assertEqual(10, os.path.getsize(store.pack_path))
+        self.assertEqual(b"y" * 10, store.read(other))
+
+        # other instances notice the pack was replaced
+        reader.last_refresh = 0
+        store.write(self.source, b"z")
+        reader.last_refresh = 0
+        self.assertEqual(b"z", reader.read(self.source))
+        self.assertEqual(b"y" * 10, reader.read(other))
+
+
+class TestFileThumbStore(unittest.TestCase):
+    def test_mirrored_layout(self):
+        with tempfile.TemporaryDirectory() as d:
+            source = os.path.join(d, "a.jpg")
+            with open(source, "wb") as f:
+                f.write(b"source")
+            store = thumbstore.FileThumbStore(os.path.join(d, "cache"), "180")
+            path = store.get_path(source)
+            self.assertTrue(path.startswith(os.path.join(d, "cache", "180", d[1:], "a.jpg_")))
+            store.write(source, b"thumb")
+            self.assertEqual(b"thumb", store.read(source))
+            self.assertEqual("file://" + path, store.url(source))
+            store.remove(source)
+            self.assertFalse(store.exists(source))
+
+    def test_cached_keys(self):
+        with tempfile.TemporaryDirectory() as d:
+            source = os.path.join(d, "a_b.jpg")
+            with open(source, "wb") as f:
+                f.write(b"source")
+            store = thumbstore.FileThumbStore(os.path.join(d, "cache"), "180")
+            self.assertEqual(set(), store.cached_keys(d))
+            store.write(source, b"thumb")
+            self.assertEqual({store.get_key(source)}, store.cached_keys(d))
+
+
+class TestOpenStore(unittest.TestCase):
+    def test_shared_and_picklable(self):
+        with tempfile.TemporaryDirectory() as d:
+            store = thumbstore.open_store("pack", d, "test_shared")
+            self.assertIs(store, thumbstore.open_store("pack", d, "test_shared"))
+            self.assertIs(store, pickle.loads(pickle.dumps(store)))
+            self.assertIs(store, thumbstore.find_store("test_shared"))
+
+    def test_replaced_store_is_closed(self):
+        with tempfile.TemporaryDirectory() as d:
+            store = thumbstore.open_store("pack", d, "test_replaced")
+            other = thumbstore.open_store("files", d, "test_replaced")
+            self.assertIsNot(store, other)
+            self.assertIsNone(store.lock_fd)
+            self.assertIsNone(store.index_fd)
+
+
+class TestCollectGarbage(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.dir.name, "cache")
+        self.sources = []
+        for name in ("a.jpg", "b.jpg", "c.jpg"):
+            path = os.path.join(self.dir.name, name)
+            with open(path, "wb") as f:
+                f.write(b"source")
+            self.sources.append(path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def check_store(self, store):
+        a, b, c = self.sources
+        for source in self.sources:
+            store.write(source, b"x" * 100)
+        store.accessed[store.get_key(a)] = 300
+        store.accessed[store.get_key(b)] = 100
+        store.accessed[store.get_key(c)] = 200
+        os.unlink(c)
+
+        removed, freed = thumbstore.collect_garbage([store], 150)
+        self.assertEqual((2, 200), (removed, freed))
+        self.assertTrue(store.exists(a))
+        self.assertFalse(store.exists(b))
+        self.assertEqual((1, 100), store.size())
+        self.assertEqual({store.get_key(a)}, set(store._load_access_times()))
+
+    def test_pack_store(self):
+        self.check_store(thumbstore.PackThumbStore(self.cache_dir, "180"))
+
+    def test_file_store(self):
+        store = thumbstore.FileThumbStore(self.cache_dir, "180")
+        self.check_store(store)
+        a = self.sources[0]
+        self.assertEqual([(store.get_key(a), a, None, 100)], store.entries())
+        self.assertEqual([("files", "180")], thumbstore.list_stores(self.cache_dir))
+
+        # mirrored folders of removed thumbnails are cleaned up
+        store.remove_keys([(store.get_key(a), a)])
+        self.assertEqual([], os.listdir(store.root))
+
+    def test_changed_source_is_orphan(self):
+        store = thumbstore.PackThumbStore(self.cache_dir, "180")
+        store.write(self.sources[0], b"x")
+        os.utime(self.sources[0], (1000, 1000))
+        self.assertEqual((1, 1), thumbstore.collect_garbage([store], 1000))